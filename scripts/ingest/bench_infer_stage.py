@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the governance classification engine (infer_stage.py)
+
+Runs offline on a seeded synthetic governance corpus and measures, section
+by section:
+  patterns  - quick_classify throughput (compiled PatternEngine vs the
+              original sequential re.search loop)
+  startup   - interpreter + module import time, and model load time of a
+              fresh infer_stage.py process
+  nli       - NLI items/sec for several batch sizes and text lengths
+  memory    - peak RSS of the benchmark process and of a fresh classifier run,
+              and of a --patterns-only run over many plain items with and
+              without thread tracking (thread_state_mb: the difference)
+
+Usage: python3 bench_infer_stage.py [--sections patterns,startup,nli,memory]
+           [--model PATH] [--items N] [--seed S] [--repeat R]
+           [--output results.json] [--baseline baseline.json] [--threshold 0.15]
+
+Results are printed as JSON to stdout (and written to --output). With
+--baseline, every metric is compared against the stored results: a metric
+that is worse by more than --threshold (relative) is a regression and the
+exit code is 1. Metrics ending in _per_sec are higher-is-better; metrics
+ending in _seconds or _mb are lower-is-better; others are informational.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import time
+
+# Benchmarks never reach the network: the model must be a local path or
+# already in the Hugging Face cache
+os.environ.setdefault("HF_HUB_OFFLINE", "1")
+os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
+
+import infer_stage
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "infer_stage.py")
+
+SECTIONS = ["patterns", "startup", "nli", "memory"]
+NLI_BATCH_SIZES = [1, 8, 16, 32]
+NLI_LENGTHS = {"subject": 0, "short": 40, "long": 400}  # Body words per item
+NLI_ITEMS = 64
+THREAD_STATE_ITEMS = 300000  # Plain items for the thread-state memory check
+THRESHOLD = 0.15
+
+SUBJECTS = [
+    "CIP-{n:04d}: {topic}",
+    "CIP-{n:04d} Vote Proposal - {topic}",
+    "Re: CIP Discuss - {topic}",
+    "CIP-{n:04d} approved: {topic}",
+    "New Featured App Request: {name}",
+    "Featured app approved - {name}",
+    "Validator Operators Approved - {name}",
+    "Super Validator onboarding request: {name}",
+    "SV Announcement: {topic}",
+    "Tokenomics update: {topic}",
+    "Weekly sync notes",
+    "Question about {topic}",
+    "Re: [governance] {topic}",
+    "Meeting reschedule",
+]
+
+TOPICS = ["traffic fees", "reward weights", "node onboarding", "governance process", "amulet pricing",
+          "validator liveness", "featured app rewards", "round timing"]
+NAMES = ["Acme Wallet", "Foo Exchange", "Bar Node", "Baz Custody", "Qux Labs"]
+FILLER = "the proposal was discussed on the call and participants shared feedback".split()
+BODY_SENTENCES = [
+    "We propose to adjust the {topic} starting next round.",
+    "Please review and vote before the deadline.",
+    "The committee discussed {topic} and asked for more data.",
+    "{name} has requested featured app status.",
+    "Super validators should upgrade their nodes this week.",
+    "Thanks everyone for the feedback so far.",
+]
+
+
+def synthetic_corpus(items, seed, body_words=None):
+    """
+    Seeded mix of governance subjects followed by bodies. Bodies are empty,
+    short or long at random unless `body_words` fixes their length.
+    """
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(items):
+        fill = dict(n=rng.randrange(10000), topic=rng.choice(TOPICS), name=rng.choice(NAMES))
+        subject = rng.choice(SUBJECTS).format(**fill)
+        length = rng.choice([0, 0, 40, 400]) if body_words is None else body_words
+        words = []
+        while len(words) < length:
+            words.extend(rng.choice(BODY_SENTENCES).format(**fill).split() if rng.random() < 0.3
+                         else [rng.choice(FILLER)])
+        corpus.append(f"{subject}\n{' '.join(words[:length])}".strip())
+    return corpus
+
+
+def sequential_quick_classify(text):
+    """The pre-PatternEngine implementation, kept as the comparison baseline"""
+    text_lower = text.lower()
+    for pattern, stage, confidence, *_ in infer_stage.PATTERN_RULES:
+        if re.search(pattern, text_lower):
+            return (stage, confidence)
+    return None
+
+
+def time_best(fn, corpus, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(corpus)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_patterns(corpus, repeat):
+    sequential = time_best(lambda texts: [sequential_quick_classify(t) for t in texts], corpus, repeat)
+    compiled = time_best(infer_stage.classify_many, corpus, repeat)
+    return {
+        "items": len(corpus),
+        "sequential_items_per_sec": round(len(corpus) / sequential),
+        "compiled_items_per_sec": round(len(corpus) / compiled),
+        "speedup": round(sequential / compiled, 2),
+    }
+
+
+def run_classifier(model, items, extra_args=()):
+    """Run infer_stage.py with --telemetry; returns (wall seconds, final telemetry report)"""
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, SCRIPT, "--model", model, "--no-cache", "--telemetry", *extra_args],
+        input="".join(json.dumps({"id": str(i), "text": text}) + "\n" for i, text in enumerate(items)),
+        capture_output=True, text=True, check=True,
+    )
+    elapsed = time.perf_counter() - start
+    reports = [json.loads(line) for line in proc.stderr.splitlines() if line.startswith('{"event": "telemetry_final"')]
+    return elapsed, reports[-1]
+
+
+def bench_startup(model, repeat):
+    import_times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "import infer_stage"], check=True,
+                       cwd=os.path.dirname(SCRIPT))
+        import_times.append(time.perf_counter() - start)
+
+    runs = [run_classifier(model, ["warm up"]) for _ in range(repeat)]
+    return {
+        "import_seconds": round(min(import_times), 3),
+        "model_load_seconds": round(min(report["phases_seconds"]["model_load"] for _, report in runs), 3),
+        "first_result_seconds": round(min(elapsed for elapsed, _ in runs), 3),
+    }
+
+
+def bench_nli(model, seed, repeat):
+    engine = infer_stage.NLIEngine.load(model)
+    engine.warm_up()
+    results = {}
+    for length_name, body_words in NLI_LENGTHS.items():
+        corpus = synthetic_corpus(NLI_ITEMS, seed, body_words=body_words)
+        for batch_size in NLI_BATCH_SIZES:
+            engine.batch_size = batch_size
+            seconds = time_best(engine.classify, corpus, repeat)
+            results[f"{length_name}_batch{batch_size}_items_per_sec"] = round(len(corpus) / seconds, 1)
+    return results
+
+
+def bench_memory(model, seed):
+    _, report = run_classifier(model, synthetic_corpus(NLI_ITEMS, seed))
+    plain = [f"Weekly sync notes {i}" for i in range(THREAD_STATE_ITEMS)]
+    _, threaded = run_classifier(model, plain, ["--patterns-only"])
+    _, unthreaded = run_classifier(model, plain, ["--patterns-only", "--ignore-threads"])
+    return {
+        "classifier_peak_rss_mb": report["peak_rss_mb"],
+        "patterns_only_peak_rss_mb": threaded["peak_rss_mb"],
+        "thread_state_mb": round(threaded["peak_rss_mb"] - unthreaded["peak_rss_mb"], 1),
+        "bench_peak_rss_mb": infer_stage.peak_rss_mb(),
+    }
+
+
+def flatten(results, prefix=""):
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{name}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare_to_baseline(results, baseline, threshold=THRESHOLD):
+    """
+    List of regressions: {"metric", "baseline", "current", "change"} for every
+    directional metric that is worse than the baseline by more than `threshold`.
+    """
+    current = flatten(results)
+    regressions = []
+    for metric, base in flatten(baseline).items():
+        if metric not in current or not base:
+            continue
+        change = (current[metric] - base) / base
+        if metric.endswith("_per_sec"):
+            worse = change < -threshold
+        elif metric.endswith("_seconds") or metric.endswith("_mb"):
+            worse = change > threshold
+        else:
+            continue
+        if worse:
+            regressions.append({"metric": metric, "baseline": base, "current": current[metric],
+                                "change": round(change, 3)})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the governance classification engine")
+    parser.add_argument("--sections", default=",".join(SECTIONS),
+                        help=f"Comma-separated sections to run (default: {','.join(SECTIONS)})")
+    parser.add_argument("--model", default=infer_stage.MODEL_ID,
+                        help="Local path or cached hub name of the NLI model")
+    parser.add_argument("--items", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", default=None, help="Also write the results JSON to this file")
+    parser.add_argument("--baseline", default=None, help="Stored results JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help=f"Relative change counted as a regression (default: {THRESHOLD})")
+    args = parser.parse_args(argv)
+
+    sections = [section.strip() for section in args.sections.split(",") if section.strip()]
+    unknown = set(sections) - set(SECTIONS)
+    if unknown:
+        parser.error(f"unknown sections: {', '.join(sorted(unknown))}")
+
+    results = {
+        "meta": {
+            "seed": args.seed,
+            "items": args.items,
+            "model": args.model,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+        },
+    }
+    if "patterns" in sections:
+        results["patterns"] = bench_patterns(synthetic_corpus(args.items, args.seed), args.repeat)
+    if "startup" in sections:
+        results["startup"] = bench_startup(args.model, min(args.repeat, 3))
+    if "nli" in sections:
+        results["nli"] = bench_nli(args.model, args.seed, min(args.repeat, 3))
+    if "memory" in sections:
+        results["memory"] = bench_memory(args.model, args.seed)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        results["regressions"] = compare_to_baseline(results, baseline, args.threshold)
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    return 1 if results.get("regressions") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
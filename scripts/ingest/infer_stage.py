@@ -6,16 +6,194 @@ Hybrid pattern-matching + zero-shot NLI classification of governance messages.
 Uses explicit subject line patterns for high-confidence cases, falls back to
 NLI for ambiguous cases.
 
-Input: JSONL via stdin - each line is {"id": "...", "text": "..."}
-Output: JSONL to stdout - each line is {"id": "...", "stage": "...", "confidence": 0.XX}
+Input: JSONL via stdin - each line is {"id": "...", "text": "..."}, optionally
+       with "thread_id" / "parent_id" (replies then inherit their root's stage)
+       (--framing length: 4-byte big-endian length prefix + JSON per message,
+       on both stdin and stdout)
+Output: JSONL to stdout - each line is {"id": "...", "stage": "...", "confidence": 0.XX,
+        "tier": "pattern" | "linear" | "nli" | "knn" | "distilled" | "thread",
+        "rules": "<fingerprint>"}
+        (model decisions also carry "premise": the premise strategy used, and
+        "model": the model/descriptions fingerprint; with --patterns-only,
+        unmatched items are {"stage": null, "tier": "needs_nli", "needs_nli": true})
+
+With --reclassify PREVIOUS, stdin is the corpus of an earlier run whose
+output is PREVIOUS: only items whose result the current rules, descriptions
+or model could change are classified again, the rest are copied.
+
+With --run-dir, results are also journalled (with periodic fsync'd
+checkpoints); --resume answers items already in the journal from it, so a
+run killed part-way continues where it stopped instead of starting over.
+A run that reaches the end of its input drops its own items from the
+journal (other input sets' unfinished results are kept).
+
+With --engine knn, items the patterns leave are embedded once and labelled
+by their nearest neighbours in an index of labelled examples (golden-set
+items, previous labels, confident pattern matches) that --build-index
+creates and extends, instead of by seven NLI passes. --engine distilled
+uses one encoder pass and a 7-logit head trained by --train-distilled.
 
 All logs go to stderr. Output is machine-parsable JSONL only.
 """
 
 import sys
+import os
 import json
 import re
-from transformers import pipeline
+import time
+import warnings
+
+try:
+    import orjson as _orjson  # Optional faster JSON codec for the stdin/stdout protocol
+except ImportError:
+    _orjson = None
+
+try:
+    import re._parser as _sre_parse
+    import re._constants as _sre_constants
+except ImportError:  # Python < 3.11
+    import sre_parse as _sre_parse
+    import sre_constants as _sre_constants
+
+MODEL_ID = "typeform/distilbert-base-uncased-mnli"
+HYPOTHESIS_TEMPLATE = "This governance forum post is {}."
+
+BATCH_SIZE = 512  # Max items per mini-batch when writing to a file
+STREAM_BATCH_SIZE = 32  # ... when writing to a pipe: results are written per mini-batch
+BATCH_TOKENS = 16384  # Estimated tokens per mini-batch (adapted under --max-rss-mb)
+NLI_BATCH_SIZE = 16  # Premise/hypothesis pairs per forward pass
+SERVE_MAX_BATCH_ITEMS = 100  # NLI items coalesced per --serve inference batch
+
+# Memory budget (--max-rss-mb): near the limit, collect garbage and halve the
+# batch token budget; well below it, grow the budget back
+CHARS_PER_TOKEN = 4  # Rough chars per wordpiece, for sizing batches before tokenizing
+ITEM_MAX_TOKENS = 512  # Premises are truncated at the model limit anyway
+MIN_BATCH_TOKENS = 512
+MEMORY_BACKOFF = 0.85  # Fraction of the budget that triggers a back-off
+MEMORY_GROW = 0.6  # Fraction below which the batch token budget grows again
+
+# Premise strategies (--premise-strategy): what part of a post the NLI model sees
+PREMISE_STRATEGIES = ["full", "budget", "subject", "sentences", "keywords"]
+PREMISE_TOKENS = 128  # Default token budget for the "budget" strategy
+PREMISE_SENTENCES = 3
+PREMISE_KEYWORD_WINDOW = 12  # Words kept either side of a keyword hit
+PREMISE_MAX_WINDOWS = 5
+
+# Governance terms that anchor keyword windows
+PREMISE_KEYWORDS = re.compile(
+    r'\b(cips?|votes?|voting|validators?|weights?|featured|approv\w*|tokenomics|svs?|'
+    r'super\s*validators?|announc\w*|proposals?|rewards?)\b',
+    re.IGNORECASE,
+)
+
+# --prune-labels: NLI hypotheses limited to the label families (cip,
+# tokenomics, sv) whose PATTERN_RULES keywords a text contains, plus "other"
+PRUNE_STOPWORDS = {"add", "by", "new", "on", "to"}
+PRUNE_CHECK_RATE = 0.02  # Default share of items --prune-check also scores on every label
+
+# stdin/stdout protocol: "lines" (JSONL) or "length" (4-byte big-endian
+# length prefix + JSON payload per message, see --framing)
+FRAMINGS = ["lines", "length"]
+READ_CHUNK_BYTES = 1 << 16  # Input read per bulk decode in batch mode
+OUTPUT_BUFFER_BYTES = 1 << 16  # Output buffered before a forced write
+FLUSH_INTERVAL = 0.05  # Seconds a buffered result may wait before it is flushed
+
+# In-run dedup of NLI work, keyed by the canonical form of each text
+# (patterns and the premise always see the text as posted)
+CANONICALIZE = True  # Cleared by --no-canonicalize
+DEDUP_MAX_ENTRIES = 100000  # Distinct NLI texts remembered per run
+REPLY_PREFIX = re.compile(r'^(?:(?:re|fwd?)\s*(?:\[\d+\])?\s*:\s*)+', re.IGNORECASE)
+# Mailing-list tags ("[sv-announce]"); a tag naming a CIP or matched by a
+# pattern rule ("[CIP-0042]", "[cip-discuss]") is content and is kept
+LIST_TAG = re.compile(r'^\[([a-z][a-z0-9_.-]{0,39})\]\s*', re.IGNORECASE)
+
+# Thread propagation: replies held back waiting for their thread root
+THREAD_MAX_WAITING = 10000
+THREAD_MAX_ROOTS = 50000  # Root stages (and thread links) remembered for later replies
+
+# --pipeline: mini-batches allowed to wait between pipeline stages
+PIPELINE_DEPTH = 4
+
+# Output fingerprints ("rules" on every record, "model" on NLI decisions),
+# compared by --reclassify to find the items a change could affect
+FINGERPRINT_CHARS = 12
+
+# Persistent NLI result cache (same data dir convention as server/inference)
+BASE_DATA_DIR = os.environ.get('DATA_DIR') or os.path.join(os.getcwd(), 'data')
+CACHE_PATH = os.path.join(BASE_DATA_DIR, 'cache', 'nli-results.sqlite3')
+CACHE_MAX_ENTRIES = 200000
+
+# Resumable runs (--run-dir / --resume): journal of completed results
+RUN_DIR = os.path.join(BASE_DATA_DIR, 'cache', 'inference-run')
+CHECKPOINT_EVERY = 100  # Results between fsync'd checkpoints
+
+# Exported ONNX models (--backend onnx), reused across runs
+ONNX_DIR = os.path.join(BASE_DATA_DIR, 'cache', 'onnx')
+
+# Managed model store: pinned local safetensors snapshots written once by
+# --prepare-model and loaded offline afterwards
+MODEL_STORE_DIR = os.path.join(BASE_DATA_DIR, 'models')
+SNAPSHOT_MANIFEST = 'snapshot.json'
+
+# --low-memory: bfloat16 torch weights, kept only when they pass an accuracy
+# check against float32 on the reference corpus (verdicts cached per model)
+PRECISION_CHECKS_PATH = os.path.join(BASE_DATA_DIR, 'cache', 'precision-checks.json')
+BF16_MAX_CONFIDENCE_DELTA = 0.05
+
+# Cascade first stage (--cascade): hashed n-gram linear model trained from past
+# pattern/NLI outputs; items below the top-1/top-2 margin escalate to NLI
+CASCADE_MODEL_PATH = os.path.join(BASE_DATA_DIR, 'cache', 'cascade-model.npz')
+CASCADE_MARGIN = 0.4
+CASCADE_FEATURES = 2 ** 18
+CASCADE_MAX_WORDS = 256  # Words hashed per item; long bodies rarely add signal
+CASCADE_TOKEN = re.compile(r"[a-z0-9]+(?:-[0-9]+)?")
+
+# Embedding kNN engine (--engine knn): each premise is embedded once and takes
+# the similarity-weighted vote of its nearest labelled examples in a
+# memory-mapped vector index (built and extended with --build-index)
+EMBED_MODEL_ID = "sentence-transformers/all-MiniLM-L6-v2"
+EMBED_BATCH_SIZE = 64  # Premises per encoder forward pass
+KNN_INDEX_DIR = os.path.join(BASE_DATA_DIR, 'cache', 'knn-index')
+KNN_NEIGHBOURS = 10
+KNN_SEARCH_ROWS = 65536  # Index rows scored per matrix multiply
+
+# Distilled classifier (--engine distilled): a 7-logit softmax head over the
+# frozen sentence embeddings, trained by --train-distilled
+DISTILLED_MODEL_PATH = os.path.join(BASE_DATA_DIR, 'cache', 'distilled-model.npz')
+DISTILL_EPOCHS = 500
+DISTILL_LEARNING_RATE = 0.5
+DISTILL_L2 = 1e-3
+
+# Labelled examples for --build-index and --train-distilled
+LABEL_MIN_CONFIDENCE = 0.9  # Pattern matches (and pattern-tier labels) below this are not used
+# Tiers usable as labels, and their confidence floor: NLI spreads its
+# confidence over all stages, so any NLI answer but a failed item (0.0) is
+# used; None is a stage given without a tier (a hand label). Derived tiers
+# (linear, thread, knn, distilled) are never used, so no model learns from
+# its own or a cheaper model's predictions
+LABEL_TIER_FLOORS = {"pattern": LABEL_MIN_CONFIDENCE, "nli": 0.0, "golden": 0.0, None: 0.0}
+GOLDEN_SET_PATH = os.path.join(BASE_DATA_DIR, 'cache', 'golden-set', 'golden-items.json')
+
+# Structured stderr telemetry (--telemetry)
+TELEMETRY_INTERVAL = 30.0  # Seconds between periodic reports
+LATENCY_BUCKETS_MS = [0.1, 1, 10, 100, 1000, 10000]
+
+# Reference corpus for --verify-backend: one text per stage flavour, plus
+# texts the pattern rules do not catch (those are what reach NLI)
+REFERENCE_CORPUS = [
+    "Proposal to adjust traffic fees for the next release",
+    "Feedback wanted on the new reward distribution mechanism",
+    "Results of the vote on the migration schedule",
+    "Welcome our newest super validator node operator",
+    "Featured status confirmed for the payments app",
+    "Weekly governance call notes and action items",
+    "Should validators be paid for liveness or for traffic?",
+    "Announcing the approved changes to the amulet conversion rate",
+    "Discussion: governance process improvements for 2025",
+    "Reminder: please cast your ballot before Friday",
+    "Node maintenance window this weekend",
+    "Request for comments on minting curve parameters",
+]
 
 # Fixed set of allowed stages - model can ONLY choose from these
 ALLOWED_STAGES = [
@@ -41,6 +219,11 @@ STAGE_DESCRIPTIONS = {
 
 # High-confidence pattern matching for unambiguous subject lines
 # Order matters - more specific patterns should come first
+# A rule may name its scope as a 4th element: "subject" (first line), N
+# (first N characters) or "text" (the whole post). The default reads the
+# whole post: '.*' chains run in linear time (see _chain_search()), so a
+# long body costs a scan, not a blow-up
+PATTERN_DEFAULT_SCOPE = "text"
 PATTERN_RULES = [
     # ========== TOKENOMICS ANNOUNCE (most specific first) ==========
     # Validator/Operator approvals
@@ -82,7 +265,7 @@ PATTERN_RULES = [
     # ========== CIP VOTE ==========
     (r'vote\s+proposal\s+to\s+add', 'cip-vote', 0.95),  # "Vote Proposal to add X weight" is CIP vote
     (r'vote\s+proposal', 'cip-vote', 0.95),
-    (r'cip[-\s]*\d+\s*:?\s*vote', 'cip-vote', 0.95),
+    (r'cip[-\s]*\d+\s*(?::\s*)?vote', 'cip-vote', 0.95),  # Not \s*:?\s* - two adjacent \s* backtrack quadratically
     (r'cip\s+vote', 'cip-vote', 0.95),
     (r'voting\s+on\s+cip', 'cip-vote', 0.90),
     (r'cip[-\s]*\d+.*\bvote\b', 'cip-vote', 0.85),
@@ -104,143 +287,3979 @@ PATTERN_RULES = [
     (r'sv\s+weight\s+assignment', 'sv-announce', 0.90),
 ]
 
+def _required_literals(pattern):
+    """
+    Literal runs that every match of `pattern` must contain.
+
+    Only top-level literal sequences are collected (anything optional,
+    repeated or alternated ends a run), so the result is a necessary
+    condition for a match and can be used as a cheap substring prefilter.
+    """
+    runs = []
+    current = []
+    for op, av in _sre_parse.parse(pattern):
+        if op is _sre_constants.LITERAL:
+            current.append(chr(av))
+            continue
+        if current:
+            runs.append("".join(current))
+            current = []
+    if current:
+        runs.append("".join(current))
+    return [run for run in runs if len(run) >= 2]
+
+def _chain_search(pattern):
+    """
+    Linear-time search function for a pattern whose top level is segments
+    joined by '.*' (e.g. 'outcome.*tokenomics'), or None for other patterns.
+
+    re.search() retries the rest of the pattern from every partial match,
+    so a long line full of first segments without a completion costs
+    quadratic time or worse (one factor per '.*'). Here the first segment's
+    matches are visited left to right, and each later segment is found as
+    its leftmost start on the current line ('.' does not match a newline)
+    after the previous segment. Each segment remembers its last answer and
+    the range of start positions it holds for, so a line is scanned once
+    per segment instead of once per candidate. That is exact as long as a
+    segment cannot start inside the previous segment's match, which holds
+    for rules made of literals (the pattern tests check it against re.search).
+    """
+    gaps = sum(
+        1 for op, av in _sre_parse.parse(pattern)
+        if op is _sre_constants.MAX_REPEAT and av[:2] == (0, _sre_constants.MAXREPEAT)
+        and list(av[2]) == [(_sre_constants.ANY, None)]
+    )
+    segments = pattern.split(".*")
+    if not gaps or gaps != len(segments) - 1 or not all(segments):
+        return None
+    
+    first = re.compile(segments[0]).search
+    # Group 1 is the leftmost segment start on the current line
+    rest = [re.compile(r"[^\n]*?(" + segment + ")").match for segment in segments[1:]]
+
+    def search(text):
+        # Per later segment: (from, to, end) - searching from any position in
+        # [from, to] finds the match ending at `end` (None: no match on that line)
+        known = [None] * len(rest)
+        pos = 0
+        while True:
+            match = first(text, pos)
+            if match is None:
+                return False
+            end = match.end()
+            for i, segment in enumerate(rest):
+                answer = known[i]
+                if answer is None or not answer[0] <= end <= answer[1]:
+                    found = segment(text, end)
+                    if found is not None:
+                        answer = (end, found.start(1), found.end())
+                    else:
+                        line_end = text.find("\n", end)
+                        answer = (end, len(text) if line_end < 0 else line_end, None)
+                    known[i] = answer
+                end = answer[2]
+                if end is None:
+                    break
+            else:
+                return True
+            pos = match.start() + 1
+    
+    return search
+
+class PatternEngine:
+    """
+    Compiled form of an ordered (pattern, stage, confidence[, scope]) rule list.
+
+    Built once: every pattern is precompiled (segments joined by '.*' as a
+    linear-time _chain_search()) and tagged with the literal substrings it
+    cannot match without. At classification time each scope of the text a
+    rule looks at (see PATTERN_DEFAULT_SCOPE) is cut and lowercased at most
+    once, so long bodies are never lowercased for subject rules, each
+    distinct literal is looked up at most once per scope, and a rule's
+    regex only runs when all of its literals are present. Rules are still
+    visited in list order, so the result is exactly that of the sequential
+    re.search loop over each rule's scope: the first rule in priority order
+    that matches.
+    """
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        literal_ids = {}
+        self._compiled = []
+        for index, (pattern, stage, confidence, *scope) in enumerate(self.rules):
+            scope = scope[0] if scope else PATTERN_DEFAULT_SCOPE
+            if scope not in ("subject", "text") and not (isinstance(scope, int) and scope > 0):
+                raise ValueError(f"Rule {pattern!r}: scope must be 'subject', 'text' or a character count")
+            ids = tuple(
+                literal_ids.setdefault(literal, len(literal_ids))
+                for literal in _required_literals(pattern)
+            )
+            search = _chain_search(pattern) or re.compile(pattern).search
+            self._compiled.append((search, ids, (stage, confidence), index, scope))
+        self._literals = sorted(literal_ids, key=literal_ids.get)
+        self.hits = [0] * len(self.rules)  # Matches per rule, for telemetry
+
+    def classify(self, text):
+        """Returns (stage, confidence) of the first matching rule, or None"""
+        literals = self._literals
+        # Scope -> end offset, and end offset -> (lowercased text, literal hits);
+        # scopes that cut the text at the same place share one view
+        ends = {"text": len(text)}
+        views = {}
+        
+        for search, ids, result, index, scope in self._compiled:
+            end = ends.get(scope)
+            if end is None:
+                if scope == "subject":
+                    end = text.find("\n")
+                    end = len(text) if end < 0 else end
+                else:
+                    end = min(scope, len(text))
+                ends[scope] = end
+            view = views.get(end)
+            if view is None:
+                view = views[end] = (text[:end].lower(), [None] * len(literals))
+            text_lower, present = view
+            
+            for i in ids:
+                found = present[i]
+                if found is None:
+                    found = present[i] = literals[i] in text_lower
+                if not found:
+                    break
+            else:
+                if search(text_lower):
+                    self.hits[index] += 1
+                    return result
+        
+        return None
+
+    def classify_many(self, texts):
+        """Bulk form of classify() - one result per input text, in order"""
+        classify = self.classify
+        return [classify(text) for text in texts]
+
+PATTERN_ENGINE = PatternEngine(PATTERN_RULES)
+
 def quick_classify(text):
     """
     Pattern-based pre-classification for high-confidence cases.
     Returns (stage, confidence) or None if no pattern matches.
     """
-    text_lower = text.lower()
-    
-    for pattern, stage, confidence in PATTERN_RULES:
-        if re.search(pattern, text_lower):
-            return (stage, confidence)
-    
-    return None
+    return PATTERN_ENGINE.classify(text)
+
+def classify_many(texts):
+    """Pattern-classify many texts at once; see quick_classify()"""
+    return PATTERN_ENGINE.classify_many(texts)
+
+def canonicalize(text):
+    """
+    Canonical form of a post, used as the in-run dedup key: Unicode NFKC,
+    leading reply/forward prefixes and mailing-list tags (see
+    _is_list_tag()) stripped from the subject, runs of spaces collapsed and
+    blank lines dropped. Line breaks are kept (the first line is the
+    subject). CIP and stage tags are kept, so posts about different CIPs
+    never share a key.
+    """
+    import unicodedata
+
+    text = unicodedata.normalize("NFKC", text)
+    lines = [" ".join(line.split()) for line in text.splitlines()]
+    lines = [line for line in lines if line]
+    if lines:
+        subject = lines[0]
+        while True:
+            stripped = REPLY_PREFIX.sub("", subject)
+            tag = LIST_TAG.match(stripped)
+            if tag and _is_list_tag(tag.group(1)):
+                stripped = stripped[tag.end():]
+            if stripped == subject:
+                break
+            subject = stripped
+        lines[0] = subject or lines[0]
+    return "\n".join(lines)
+
+_LIST_TAGS = {}
+
+def _is_list_tag(name):
+    """Whether a bracketed subject tag is list noise rather than a CIP or stage tag"""
+    name = name.lower()
+    found = _LIST_TAGS.get(name)
+    if found is None:
+        found = _LIST_TAGS[name] = not (name.startswith("cip")
+                                        or any(re.search(pattern, name) for pattern, *_ in PATTERN_RULES))
+    return found
+
+_RULES_FINGERPRINTS = {}
+
+def rules_fingerprint():
+    """
+    Short hash of everything that decides the pattern pass: PATTERN_RULES
+    (order included - the earliest match wins) and the default rule scope.
+    """
+    fingerprint = _RULES_FINGERPRINTS.get("rules")
+    if fingerprint is None:
+        import hashlib
+
+        fingerprint = _RULES_FINGERPRINTS["rules"] = hashlib.sha256(json.dumps({
+            "rules": PATTERN_RULES,
+            "scope": PATTERN_DEFAULT_SCOPE,
+        }).encode("utf-8")).hexdigest()[:FINGERPRINT_CHARS]
+    return fingerprint
+
+def nli_fingerprint(model_id, premise=None, precision=None, pruned=False):
+    """
+    Short hash of everything that decides an NLI answer: the model and its
+    weight precision, the label descriptions, the hypothesis template, the
+    premise settings and label pruning.
+    """
+    import hashlib
+
+    return hashlib.sha256(json.dumps({
+        "model": model_id,
+        "precision": precision or "float32",
+        "stages": ALLOWED_STAGES,
+        "descriptions": STAGE_DESCRIPTIONS,
+        "template": HYPOTHESIS_TEMPLATE,
+        "premise": (premise or PremiseBuilder()).settings(),
+        "pruned": pruned,
+    }, sort_keys=True).encode("utf-8")).hexdigest()[:FINGERPRINT_CHARS]
+
+def knn_fingerprint(model_id, index_version, k=KNN_NEIGHBOURS, premise=None):
+    """
+    Short hash of everything that decides a kNN answer: the embedding model,
+    the index contents (VectorIndex.version), k and the premise settings.
+    """
+    import hashlib
+
+    return hashlib.sha256(json.dumps({
+        "engine": "knn",
+        "model": model_id,
+        "index": index_version,
+        "k": k,
+        "stages": ALLOWED_STAGES,
+        "premise": (premise or PremiseBuilder()).settings(),
+    }, sort_keys=True).encode("utf-8")).hexdigest()[:FINGERPRINT_CHARS]
+
+def distilled_fingerprint(path, premise=None):
+    """
+    Short hash of everything that decides a distilled-model answer: the
+    trained model file's contents (None if it is missing) and the premise settings.
+    """
+    import hashlib
+
+    if not os.path.exists(path):
+        return None
+    return hashlib.sha256(json.dumps({
+        "engine": "distilled",
+        "model": _file_sha256(path),
+        "premise": (premise or PremiseBuilder()).settings(),
+    }, sort_keys=True).encode("utf-8")).hexdigest()[:FINGERPRINT_CHARS]
+
+def cascade_fingerprint(path, margin):
+    """
+    Short hash of everything that decides a cascade first-stage answer: the
+    trained model file's contents (None if it is missing) and the margin.
+    """
+    import hashlib
+
+    if not os.path.exists(path):
+        return None
+    return hashlib.sha256(json.dumps({
+        "engine": "cascade",
+        "model": _file_sha256(path),
+        "margin": margin,
+    }, sort_keys=True).encode("utf-8")).hexdigest()[:FINGERPRINT_CHARS]
 
 def log(msg):
     """Log to stderr only - stdout is reserved for JSON output"""
     print(msg, file=sys.stderr, flush=True)
 
-def main():
-    import gc
-    import os
-    
-    # Memory optimization settings
-    os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'max_split_size_mb:128')
-    os.environ.setdefault('TRANSFORMERS_CACHE', '/tmp/hf_cache')
-    
-    log("Loading NLI classification model...")
-    
-    # Load zero-shot classification pipeline
-    # Using DistilBERT-MNLI for memory efficiency (~250MB vs ~1.6GB)
+def peak_rss_mb():
+    """Peak resident set size of this process in MB (None where unsupported)"""
+    # VmHWM starts over at exec(); ru_maxrss keeps the forking parent's peak
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except (OSError, ValueError, IndexError):
+        pass
     try:
-        classifier = pipeline(
-            "zero-shot-classification",
-            model="typeform/distilbert-base-uncased-mnli",
-            device=-1,  # CPU for determinism
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KB on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def current_rss_mb():
+    """Current resident set size of this process in MB (peak RSS where /proc is unavailable)"""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return round(pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024), 1)
+    except (OSError, ValueError, AttributeError, IndexError):
+        return peak_rss_mb()
+
+def memory_report():
+    """
+    Resident memory of this process in MB: RSS, and where the kernel reports
+    it, the proportional (PSS), private and shared parts - model weights
+    inherited copy-on-write from a parent show up as shared.
+    """
+    report = {"rss_mb": current_rss_mb()}
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            kb = {}
+            for line in f:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == "kB":
+                    kb[parts[0].rstrip(":")] = int(parts[1])
+    except (OSError, ValueError):
+        return report
+    report["pss_mb"] = round(kb.get("Pss", 0) / 1024, 1)
+    report["private_mb"] = round((kb.get("Private_Clean", 0) + kb.get("Private_Dirty", 0)) / 1024, 1)
+    report["shared_mb"] = round((kb.get("Shared_Clean", 0) + kb.get("Shared_Dirty", 0)) / 1024, 1)
+    return report
+
+def memory_summary(report):
+    """One-line form of a memory_report()"""
+    text = f"RSS {report['rss_mb']}MB"
+    if "pss_mb" in report:
+        text += f" (PSS {report['pss_mb']}MB, private {report['private_mb']}MB, shared {report['shared_mb']}MB)"
+    return text
+
+def estimate_tokens(item):
+    """Cheap pre-tokenization estimate of what an input item costs to classify"""
+    return min(len(item.get("text", "")) // CHARS_PER_TOKEN + 1, ITEM_MAX_TOKENS)
+
+class MemoryBudget:
+    """
+    Sizes mini-batches by estimated token count rather than item count, and
+    keeps the process under an optional RSS budget (--max-rss-mb).
+
+    read_batches() closes a batch at `tokens` estimated tokens or
+    `max_items` items, whichever comes first. check(), called after each
+    batch, samples RSS: above MEMORY_BACKOFF of the budget it runs a full
+    garbage collection, and halves `tokens` (down to MIN_BATCH_TOKENS) if
+    that did not bring RSS back under; below MEMORY_GROW it grows `tokens`
+    by a quarter, up to the configured size. Garbage collection is
+    otherwise left to the runtime. Without a budget, check() does nothing.
+    """
+
+    def __init__(self, max_rss_mb=None, tokens=BATCH_TOKENS, max_items=BATCH_SIZE):
+        self.max_rss_mb = max_rss_mb or None
+        self.max_tokens = max(MIN_BATCH_TOKENS, tokens)
+        self.tokens = self.max_tokens
+        self.max_items = max(1, max_items)
+        self.batches = 0
+        self.items = 0
+        self.collections = 0
+        self.backoffs = 0
+
+    def check(self):
+        if not self.max_rss_mb:
+            return
+        rss = current_rss_mb()
+        if rss is None:
+            return
+        if rss > self.max_rss_mb * MEMORY_BACKOFF:
+            import gc
+
+            with TELEMETRY.phase("gc"):
+                gc.collect()
+            self.collections += 1
+            rss = current_rss_mb()
+            if rss > self.max_rss_mb * MEMORY_BACKOFF and self.tokens > MIN_BATCH_TOKENS:
+                self.tokens = max(MIN_BATCH_TOKENS, self.tokens // 2)
+                self.backoffs += 1
+                log(f"RSS {rss:.0f}MB near the {self.max_rss_mb}MB budget, batches cut to {self.tokens} tokens")
+        elif rss < self.max_rss_mb * MEMORY_GROW and self.tokens < self.max_tokens:
+            self.tokens = min(self.max_tokens, self.tokens + self.tokens // 4)
+
+    def summary(self):
+        average = self.items / self.batches if self.batches else 0.0
+        text = f"batches: {self.batches} (avg {average:.1f} items)"
+        if self.max_rss_mb:
+            text += f", memory: {self.collections} pressure GCs, {self.backoffs} back-offs, {self.tokens} tokens/batch"
+        return text
+
+class _Phase:
+    """Context manager adding its elapsed time to one Telemetry phase"""
+
+    __slots__ = ("telemetry", "name", "start")
+
+    def __init__(self, telemetry, name):
+        self.telemetry = telemetry
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.telemetry.add(self.name, time.perf_counter() - self.start)
+
+class _NoPhase:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+_NO_PHASE = _NoPhase()
+
+class Telemetry:
+    """
+    Structured run telemetry (--telemetry), emitted to stderr as one JSON
+    line per report: periodically while work is flowing and once at exit.
+
+    Reports cumulative seconds per phase (model_load, decode, patterns,
+    tokenize, forward, output, gc), per-item latency histograms by decision path
+    (pattern / linear / nli, in ms buckets), PATTERN_RULES hit counts,
+    items/sec and peak RSS. Disabled (the default) every hook is a no-op.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.interval = TELEMETRY_INTERVAL
+        self.started = time.perf_counter()
+        self.last_emit = self.started
+        self.items = 0
+        self.phases = {}
+        self.histograms = {}
+
+    def enable(self, interval=TELEMETRY_INTERVAL):
+        self.enabled = True
+        self.interval = interval
+        self.started = self.last_emit = time.perf_counter()
+
+    def phase(self, name):
+        return _Phase(self, name) if self.enabled else _NO_PHASE
+
+    def add(self, name, seconds):
+        if self.enabled:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def observe(self, path, seconds, count=1):
+        """Record `count` items that took `seconds` each on `path`"""
+        if not self.enabled:
+            return
+        histogram = self.histograms.setdefault(path, [0] * (len(LATENCY_BUCKETS_MS) + 1))
+        ms = seconds * 1000
+        bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS_MS) if ms <= bound), len(LATENCY_BUCKETS_MS))
+        histogram[bucket] += count
+        self.items += count
+
+    def snapshot(self, event="telemetry", **extra):
+        elapsed = time.perf_counter() - self.started
+        labels = [f"<={bound}ms" for bound in LATENCY_BUCKETS_MS] + [f">{LATENCY_BUCKETS_MS[-1]}ms"]
+        return dict({
+            "event": event,
+            "pid": os.getpid(),
+            "elapsed_seconds": round(elapsed, 3),
+            "items": self.items,
+            "items_per_sec": round(self.items / elapsed, 1) if elapsed else 0.0,
+            "phases_seconds": {name: round(seconds, 4) for name, seconds in self.phases.items()},
+            "latency_ms": {
+                path: dict(zip(labels, histogram)) for path, histogram in self.histograms.items()
+            },
+            "rule_hits": {
+                f"{index}:{stage}": hits
+                for index, ((_, stage, *_), hits) in enumerate(zip(PATTERN_ENGINE.rules, PATTERN_ENGINE.hits))
+                if hits
+            },
+            "peak_rss_mb": peak_rss_mb(),
+            "memory": memory_report(),
+        }, **extra)
+
+    def emit(self, event="telemetry", **extra):
+        if self.enabled:
+            self.last_emit = time.perf_counter()
+            log(json.dumps(self.snapshot(event, **extra)))
+
+    def maybe_emit(self, **extra):
+        """Periodic report, at most once per interval"""
+        if self.enabled and self.interval and time.perf_counter() - self.last_emit >= self.interval:
+            self.emit(**extra)
+
+TELEMETRY = Telemetry()
+
+class PremiseBuilder:
+    """
+    Chooses what part of a post is fed to the NLI model as the premise.
+
+    Attention cost grows quadratically with length and the subject usually
+    carries the signal, so shorter premises trade a little accuracy for a
+    lot of latency:
+      full       - subject + body, truncated only at the model limit (default)
+      budget     - subject + body, truncated to `max_tokens` tokens
+      subject    - the subject line only
+      sentences  - subject + the first `sentences` body sentences
+      keywords   - subject + word windows around governance keywords
+                   (CIP, vote, validator, weight, ...), falling back to
+                   the first sentences when the body has none
+    `max_tokens` additionally caps every strategy when set.
+    """
+
+    def __init__(self, strategy="full", max_tokens=None, sentences=PREMISE_SENTENCES,
+                 window=PREMISE_KEYWORD_WINDOW):
+        if strategy not in PREMISE_STRATEGIES:
+            raise ValueError(f"Unknown premise strategy: {strategy}")
+        if strategy == "budget" and not max_tokens:
+            max_tokens = PREMISE_TOKENS
+        self.strategy = strategy
+        self.max_tokens = max_tokens
+        self.sentences = sentences
+        self.window = window
+
+    def settings(self):
+        return {
+            "strategy": self.strategy,
+            "max_tokens": self.max_tokens,
+            "sentences": self.sentences,
+            "window": self.window,
+        }
+
+    def build(self, text):
+        if self.strategy in ("full", "budget"):
+            return text
+        
+        subject, _, body = text.partition("\n")
+        subject = subject.strip()
+        body = body.strip()
+        if not body:
+            return text
+        if not subject:
+            subject, _, body = body.partition("\n")
+        
+        if self.strategy == "subject":
+            return subject
+        if self.strategy == "keywords":
+            windows = self._keyword_windows(body)
+            if windows:
+                return subject + "\n" + " ... ".join(windows)
+        return subject + "\n" + " ".join(self._first_sentences(body))
+
+    def _first_sentences(self, body):
+        return re.split(r'(?<=[.!?])\s+', body, maxsplit=self.sentences)[:self.sentences]
+
+    def _keyword_windows(self, body):
+        words = body.split()
+        spans = []
+        for index, word in enumerate(words):
+            if PREMISE_KEYWORDS.search(word):
+                start, end = max(0, index - self.window), index + self.window + 1
+                if spans and start <= spans[-1][1]:
+                    spans[-1][1] = end
+                else:
+                    if len(spans) == PREMISE_MAX_WINDOWS:
+                        break
+                    spans.append([start, end])
+        return [" ".join(words[start:end]) for start, end in spans]
+
+def best_label(row):
+    """Index of the top score in `row`; ties go to the later label, as with the pipeline's reversed argsort"""
+    return len(row) - 1 - int(row[::-1].argmax())
+
+class LabelPruner:
+    """
+    Candidate-label shortlists that cut the NLI hypotheses scored per item.
+
+    Each word of a PATTERN_RULES literal (less PRUNE_STOPWORDS) is a keyword
+    of its rule's label family, the stage name up to the first '-' (cip,
+    tokenomics, sv). A text is scored only on the families whose keywords
+    it contains, plus "other"; a text without any keyword keeps every
+    label. Keywords match as word prefixes ("announc" in "announcement"),
+    which can only widen a shortlist. Confidences are the softmax over the
+    shortlist.
+
+    Safety check: a deterministic `check_rate` sample of texts (by content
+    hash) is scored on every label, and the argmax over all labels is
+    compared with the argmax over the shortlist, which is what is returned.
+    """
+
+    def __init__(self, rules=PATTERN_RULES, check_rate=0.0):
+        families = {}
+        for index, stage in enumerate(ALLOWED_STAGES):
+            families.setdefault(stage.split("-")[0], []).append(index)
+        self.keywords = {}  # keyword -> label indices of its families
+        for pattern, stage, *_ in rules:
+            for literal in _required_literals(pattern):
+                for word in re.findall(r"[a-z0-9]{2,}", literal):
+                    if word not in PRUNE_STOPWORDS:
+                        self.keywords.setdefault(word, set()).update(families[stage.split("-")[0]])
+        self._search = re.compile(
+            r"\b(?:" + "|".join(sorted(map(re.escape, self.keywords), key=len, reverse=True)) + ")"
         )
-    except Exception as e:
-        log(f"Error loading model: {e}")
-        sys.exit(1)
-    
-    log("Model loaded. Processing JSONL input from stdin...")
-    
-    # Create candidate labels with descriptions for better matching
-    candidate_labels = [STAGE_DESCRIPTIONS[stage] for stage in ALLOWED_STAGES]
-    
-    # Buffer items and process in mini-batches for memory efficiency
-    BATCH_SIZE = 10  # Process 10 at a time, then GC
-    buffer = []
-    processed = 0
-    pattern_hits = 0
-    nli_hits = 0
-    
-    def process_batch(items):
-        """Process a mini-batch and free memory"""
-        nonlocal processed, pattern_hits, nli_hits
-        for item in items:
-            item_id = item.get("id", "unknown")
-            text = item.get("text", "").strip()
-            
-            if not text:
-                print(json.dumps({"id": item_id, "stage": "other", "confidence": 0.0}), flush=True)
-                processed += 1
-                continue
-            
-            # Try pattern-based classification first (high confidence)
-            pattern_result = quick_classify(text)
-            if pattern_result:
-                stage, confidence = pattern_result
-                print(json.dumps({
-                    "id": item_id,
-                    "stage": stage,
-                    "confidence": round(confidence, 4)
-                }), flush=True)
-                processed += 1
-                pattern_hits += 1
+        self.all_labels = tuple(range(len(ALLOWED_STAGES)))
+        self.other = ALLOWED_STAGES.index("other")
+        self.check_rate = check_rate
+        self.items = 0
+        self.hypotheses = 0
+        self.checked = 0
+        self.mismatches = 0
+
+    def candidates(self, text):
+        """Sorted label indices to score `text` on"""
+        labels = {self.other}
+        for match in self._search.finditer(text.lower()):
+            labels.update(self.keywords[match.group()])
+            if len(labels) == len(self.all_labels):
+                break
+        return tuple(sorted(labels)) if len(labels) > 1 else self.all_labels
+
+    def _sampled(self, text):
+        import hashlib
+
+        digest = hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "big") < self.check_rate * 2 ** 64
+
+    def plan(self, texts):
+        """(label indices to score, shortlist) per text; sampled texts are scored on every label"""
+        shortlists = [self.candidates(text) for text in texts]
+        scored = [
+            self.all_labels if self.check_rate and self._sampled(text) else shortlist
+            for text, shortlist in zip(texts, shortlists)
+        ]
+        self.items += len(texts)
+        self.hypotheses += sum(len(labels) for labels in scored)
+        return scored, shortlists
+
+    def check(self, logits, scored, shortlists):
+        """
+        Restrict rows scored on every label for the safety check to their
+        shortlist (in place), counting those whose argmax that changes
+        """
+        import numpy as np
+
+        for row, labels, shortlist in zip(logits, scored, shortlists):
+            if len(labels) == len(shortlist):
                 continue
-            
-            try:
-                # Fall back to NLI for ambiguous cases
-                result = classifier(
-                    text,
-                    candidate_labels,
-                    hypothesis_template="This governance forum post is {}.",
-                    multi_label=False
-                )
-                
-                # Map back from description to stage label
-                best_description = result["labels"][0]
-                best_score = result["scores"][0]
-                
-                best_stage = "other"
-                for stage, desc in STAGE_DESCRIPTIONS.items():
-                    if desc == best_description:
-                        best_stage = stage
-                        break
-                
-                print(json.dumps({
-                    "id": item_id,
-                    "stage": best_stage,
-                    "confidence": round(best_score, 4)
-                }), flush=True)
-                nli_hits += 1
-                
-            except Exception as e:
-                log(f"Classification error for {item_id}: {e}")
-                print(json.dumps({"id": item_id, "stage": "other", "confidence": 0.0}), flush=True)
-            
-            processed += 1
-            if processed % 50 == 0:
-                log(f"Processed {processed} items...")
-        
-        # Force garbage collection after each batch
-        gc.collect()
+            full = best_label(row)
+            mask = np.full(len(row), True)
+            mask[list(shortlist)] = False
+            row[mask] = -np.inf
+            self.checked += 1
+            if best_label(row) != full:
+                self.mismatches += 1
+                log(f"Label pruning changed the argmax: {ALLOWED_STAGES[full]} -> {ALLOWED_STAGES[best_label(row)]}")
+
+    def summary(self):
+        average = self.hypotheses / self.items if self.items else 0.0
+        text = f"pruning: {average:.2f} hypotheses/item (of {len(self.all_labels)})"
+        if self.check_rate:
+            text += f", {self.checked} checked, {self.mismatches} argmax changes"
+        return text
+
+def _pair_template(tokenizer):
+    """
+    Work out how the tokenizer wraps a (premise, hypothesis) pair.
+
+    Encodes a sentinel pair once and locates both halves in the result, so
+    pairs can later be assembled by concatenating token id lists instead of
+    re-tokenizing. Returns {"prefix", "middle", "suffix"} id lists plus the
+    token type ids to use for each part (None if the model takes none).
+    """
+    premise = tokenizer("a", add_special_tokens=False)["input_ids"]
+    hypothesis = tokenizer("b", add_special_tokens=False)["input_ids"]
+    encoded = tokenizer("a", "b")
+    full = list(encoded["input_ids"])
     
-    # Read and buffer items
-    for line in sys.stdin:
-        line = line.strip()
-        if not line:
-            continue
+    p_start = next(i for i in range(len(full)) if full[i:i + len(premise)] == premise)
+    p_end = p_start + len(premise)
+    h_start = next(i for i in range(p_end, len(full)) if full[i:i + len(hypothesis)] == hypothesis)
+    h_end = h_start + len(hypothesis)
+    
+    template = {
+        "prefix": full[:p_start],
+        "middle": full[p_end:h_start],
+        "suffix": full[h_end:],
+        "types": None,
+    }
+    if "token_type_ids" in encoded and "token_type_ids" in tokenizer.model_input_names:
+        types = list(encoded["token_type_ids"])
+        template["types"] = {
+            "prefix": types[:p_start],
+            "premise": types[p_start],
+            "middle": types[p_end:h_start],
+            "hypothesis": types[h_start],
+            "suffix": types[h_end:],
+        }
+    return template
+
+class TorchBackend:
+    """Eager PyTorch forward pass (CPU)"""
+
+    name = "torch"
+
+    def __init__(self, model):
+        self.model = model
+
+    def __call__(self, inputs):
+        """Run one padded batch of int64 numpy arrays; returns numpy logits"""
+        import torch
+
+        with torch.inference_mode():
+            tensors = {name: torch.from_numpy(array) for name, array in inputs.items()}
+            return self.model(**tensors).logits.float().numpy()
+
+class OnnxBackend:
+    """
+    ONNX Runtime forward pass with full CPU graph optimizations.
+
+    The model is exported once to `path` and the file is reused by later
+    runs; thread counts of 0 leave the choice to ONNX Runtime.
+    """
+
+    name = "onnx"
+
+    def __init__(self, path, input_names, intra_op_threads=0, inter_op_threads=0):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        if inter_op_threads > 1:
+            options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+        self.path = path
+        self.input_names = list(input_names)
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+    @staticmethod
+    def export(model, path, input_names):
+        """Export a sequence classification model with dynamic batch/sequence axes"""
+        import torch
+
+        class LogitsOnly(torch.nn.Module):
+            def __init__(self, wrapped):
+                super().__init__()
+                self.wrapped = wrapped
+
+            def forward(self, *args):
+                return self.wrapped(**dict(zip(input_names, args))).logits
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Padded sample so the traced graph keeps the attention-mask path
+        sample = {name: torch.ones((2, 8), dtype=torch.long) for name in input_names}
+        sample["attention_mask"][1, 5:] = 0
+        dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+        dynamic_axes["logits"] = {0: "batch"}
+        export_args = dict(
+            input_names=list(input_names), output_names=["logits"],
+            dynamic_axes=dynamic_axes, opset_version=17,
+        )
         
+        # Export next to the target and rename, so concurrent runs never
+        # load a half-written file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
         try:
-            item = json.loads(line)
-            buffer.append(item)
+            with torch.inference_mode(), warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                wrapped = LogitsOnly(model).eval()
+                args = tuple(sample[name] for name in input_names)
+                try:
+                    # Newer torch defaults to the dynamo exporter; the
+                    # TorchScript one handles dynamic_axes directly
+                    torch.onnx.export(wrapped, args, tmp_path, dynamo=False, **export_args)
+                except TypeError:
+                    torch.onnx.export(wrapped, args, tmp_path, **export_args)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def __call__(self, inputs):
+        return self.session.run(["logits"], {name: inputs[name] for name in self.input_names})[0]
+
+def _model_slug(model_id):
+    """Filesystem-safe, collision-free name for a model id or path"""
+    import hashlib
+
+    digest = hashlib.sha256(os.path.abspath(model_id).encode("utf-8") if os.path.isdir(model_id)
+                            else model_id.encode("utf-8")).hexdigest()[:12]
+    name = re.sub(r"[^A-Za-z0-9_.-]+", "_", os.path.basename(model_id.rstrip("/\\")))
+    return f"{name}-{digest}"
+
+def onnx_model_path(model_id):
+    """Default location of the exported ONNX file for a model id or path"""
+    return os.path.join(ONNX_DIR, f"{_model_slug(model_id)}.onnx")
+
+def model_snapshot_path(model_id):
+    """Location of the managed local snapshot of a hub model (see prepare_model)"""
+    return os.path.join(MODEL_STORE_DIR, _model_slug(model_id))
+
+def resolve_model(model_id):
+    """
+    (path, source) to load a model from: a local directory as given, else the
+    prepared snapshot in the model store (loaded strictly offline), else the
+    hub name itself.
+    """
+    if os.path.isdir(model_id):
+        return model_id, "path"
+    snapshot = model_snapshot_path(model_id)
+    if os.path.exists(os.path.join(snapshot, SNAPSHOT_MANIFEST)):
+        return snapshot, "snapshot"
+    return model_id, "hub"
+
+class NLIEngine:
+    """
+    Zero-shot NLI over the fixed ALLOWED_STAGES label set.
+
+    Reproduces the zero-shot-classification pipeline with multi_label=False
+    without going through it: the 7 hypotheses are tokenized once at
+    startup, each premise is tokenized once, and every (premise, hypothesis)
+    input is assembled by concatenating token ids, truncating the premise
+    only, as the pipeline does. Pairs are sorted by length and run in padded
+    batches of `batch_size` through the backend (eager PyTorch under
+    torch.inference_mode, or ONNX Runtime), and the entailment softmax over
+    the labels is computed here.
+    """
+
+    def __init__(self, backend, tokenizer, config, entailment_id, batch_size=NLI_BATCH_SIZE, premise=None):
+        self.backend = backend
+        self.premise = premise or PremiseBuilder()
+        self.fingerprint = None  # Set by load(), which knows the model id
+        self.pruner = None  # Optional LabelPruner
+        self.tokenizer = tokenizer
+        self.entailment_id = entailment_id
+        self.batch_size = max(1, batch_size)
+        
+        self.max_length = tokenizer.model_max_length
+        max_positions = getattr(config, "max_position_embeddings", None)
+        if max_positions and self.max_length > max_positions:
+            self.max_length = max_positions
+        self.pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+        
+        self.template = _pair_template(tokenizer)
+        hypotheses = [HYPOTHESIS_TEMPLATE.format(STAGE_DESCRIPTIONS[stage]) for stage in ALLOWED_STAGES]
+        hypothesis_ids = tokenizer(hypotheses, add_special_tokens=False)["input_ids"]
+        # Everything after the premise is fixed per label - precompute it
+        self.tails = [self.template["middle"] + list(ids) + self.template["suffix"] for ids in hypothesis_ids]
+        types = self.template["types"]
+        if types:
+            self.tail_types = [
+                types["middle"] + [types["hypothesis"]] * len(ids) + types["suffix"]
+                for ids in hypothesis_ids
+            ]
+
+    @property
+    def input_names(self):
+        names = ["input_ids", "attention_mask"]
+        if self.template["types"]:
+            names.append("token_type_ids")
+        return names
+
+    @classmethod
+    def load(cls, model_id, batch_size=NLI_BATCH_SIZE, backend="torch", onnx_path=None,
+             intra_op_threads=0, inter_op_threads=0, premise=None, dtype=None):
+        from transformers import AutoConfig, AutoModelForSequenceClassification, AutoTokenizer
+
+        # Local directories and snapshots never touch the network; snapshot
+        # weights are safetensors, which are memory-mapped rather than copied
+        path, source = resolve_model(model_id)
+        if source == "hub":
+            log(f"No local snapshot of {model_id}; run --prepare-model once for offline startup")
+        options = {"local_files_only": True} if source != "hub" else {}
+        if source == "snapshot":
+            options["use_safetensors"] = True
+        tokenizer = AutoTokenizer.from_pretrained(path, local_files_only=source != "hub")
+        config = AutoConfig.from_pretrained(path, local_files_only=source != "hub")
+        
+        entailment_id = -1
+        for label, index in config.label2id.items():
+            if label.lower().startswith("entail"):
+                entailment_id = index
+                break
+        if entailment_id == -1:
+            raise ValueError(f"Model {model_id} has no 'entailment' label in its config")
+        
+        if backend == "torch":
+            if dtype:
+                import torch
+                options["torch_dtype"] = getattr(torch, dtype)
+            model = AutoModelForSequenceClassification.from_pretrained(path, **options)
+            model.eval()
+            if intra_op_threads:
+                import torch
+                torch.set_num_threads(intra_op_threads)
+            engine = cls(TorchBackend(model), tokenizer, config, entailment_id, batch_size, premise)
+        elif backend == "onnx":
+            engine = cls(None, tokenizer, config, entailment_id, batch_size, premise)
+            onnx_path = onnx_path or onnx_model_path(model_id)
+            if not os.path.exists(onnx_path):
+                log(f"Exporting {model_id} to ONNX at {onnx_path} (one-time)...")
+                model = AutoModelForSequenceClassification.from_pretrained(path, **options)
+                model.eval()
+                OnnxBackend.export(model, onnx_path, engine.input_names)
+                del model
+            engine.backend = OnnxBackend(onnx_path, engine.input_names, intra_op_threads, inter_op_threads)
+        else:
+            raise ValueError(f"Unknown backend: {backend}")
+        engine.fingerprint = nli_fingerprint(model_id, engine.premise, dtype)
+        return engine
+
+    def _encode(self, premises, labels=None):
+        """
+        Build (input_ids, token_type_ids) for every premise x label pair, or
+        with `labels` (label indices per premise) for those pairs only
+        """
+        prefix = self.template["prefix"]
+        types = self.template["types"]
+        premise_ids = self.tokenizer(premises, add_special_tokens=False, verbose=False)["input_ids"]
+        
+        pairs = []
+        for index, ids in enumerate(premise_ids):
+            if self.premise.max_tokens:
+                ids = ids[:self.premise.max_tokens]
+            for label in (labels[index] if labels else range(len(self.tails))):
+                tail = self.tails[label]
+                budget = self.max_length - len(prefix) - len(tail)
+                # Like the pipeline: truncate the premise only, and not at
+                # all if the hypothesis alone would not fit
+                premise = ids[:budget] if budget > 0 else ids
+                input_ids = prefix + premise + tail
+                type_ids = None
+                if types:
+                    type_ids = types["prefix"] + [types["premise"]] * len(premise) + self.tail_types[label]
+                pairs.append((input_ids, type_ids))
+        return pairs
+
+    def _entailment_logits(self, premises):
+        """Return an (n_premises, n_labels) array of entailment logits"""
+        return self._run_batches(self._padded_batches(premises), len(premises))
+
+    def _padded_batches(self, premises, labels=None):
+        """
+        Tokenize premise/hypothesis pairs (all labels, or `labels` per
+        premise) into padded numpy batches: a list of (premise x label
+        slots, inputs) ready for the backend
+        """
+        import numpy as np
+
+        with TELEMETRY.phase("tokenize"):
+            pairs = self._encode(premises, labels)
+            n_labels = len(self.tails)
+            slots = [
+                index * n_labels + label
+                for index in range(len(premises))
+                for label in (labels[index] if labels else range(n_labels))
+            ]
+            with_types = self.template["types"] is not None
             
-            # Process when buffer is full
-            if len(buffer) >= BATCH_SIZE:
-                process_batch(buffer)
-                buffer = []
-                
-        except json.JSONDecodeError as e:
-            log(f"Invalid JSON line: {e}")
-            continue
-    
-    # Process remaining items
-    if buffer:
-        process_batch(buffer)
+            # Length bucketing: neighbouring pairs have similar lengths, so each
+            # padded batch wastes little compute on padding tokens
+            order = sorted(range(len(pairs)), key=lambda i: len(pairs[i][0]))
+            batches = []
+            for start in range(0, len(order), self.batch_size):
+                chunk = order[start:start + self.batch_size]
+                width = len(pairs[chunk[-1]][0])
+                inputs = {
+                    "input_ids": np.full((len(chunk), width), self.pad_id, dtype=np.int64),
+                    "attention_mask": np.zeros((len(chunk), width), dtype=np.int64),
+                }
+                if with_types:
+                    inputs["token_type_ids"] = np.zeros((len(chunk), width), dtype=np.int64)
+                for row, i in enumerate(chunk):
+                    ids, type_ids = pairs[i]
+                    inputs["input_ids"][row, :len(ids)] = ids
+                    inputs["attention_mask"][row, :len(ids)] = 1
+                    if with_types:
+                        inputs["token_type_ids"][row, :len(ids)] = type_ids
+                batches.append(([slots[i] for i in chunk], inputs))
+        return batches
+
+    def _run_batches(self, batches, count):
+        """
+        Forward passes over _padded_batches() output; (count, n_labels)
+        entailment logits, -inf for labels that were not scored
+        """
+        import numpy as np
+
+        logits = np.full((count * len(self.tails),), -np.inf, dtype=np.float32)
+        for slots, inputs in batches:
+            with TELEMETRY.phase("forward"):
+                logits[slots] = self.backend(inputs)[:, self.entailment_id]
+        return logits.reshape(count, len(self.tails))
+
+    def try_bfloat16(self, texts):
+        """
+        Convert the torch weights to bfloat16 in place (never holding a second
+        copy of the model) and check that this keeps the label of every text
+        in `texts` and moves no confidence by more than
+        BF16_MAX_CONFIDENCE_DELTA. Returns the accuracy-check report; when it
+        has not passed, the weights are left in bfloat16 and the engine must
+        be reloaded (converting back cannot restore the float32 digits).
+        """
+        import torch
+
+        reference = self.classify(texts)
+        self.backend.model.to(torch.bfloat16)
+        candidate = self.classify(texts)
+        
+        matches = sum(ref[0] == got[0] for ref, got in zip(reference, candidate))
+        delta = max((abs(ref[1] - got[1]) for ref, got in zip(reference, candidate)), default=0.0)
+        passed = matches == len(texts) and delta <= BF16_MAX_CONFIDENCE_DELTA
+        return {"items": len(texts), "label_matches": matches,
+                "max_confidence_delta": round(delta, 4), "passed": passed}
+
+    def warm_up(self):
+        """Run one tiny batch so lazy initialisation happens up front"""
+        self.classify(["warm up"])
+
+    def prepare(self, texts):
+        """
+        CPU-side preparation of classify(texts) (premises, candidate labels,
+        tokenization, padding), split out so a pipeline can overlap it with
+        finish()
+        """
+        scored = shortlists = None
+        if self.pruner:
+            scored, shortlists = self.pruner.plan(texts)
+        premises = [self.premise.build(text) for text in texts]
+        return self._padded_batches(premises, scored), len(texts), scored, shortlists
+
+    def finish(self, prepared):
+        """Run the model on prepare() output; returns classify()'s result"""
+        import numpy as np
+
+        batches, count, scored, shortlists = prepared
+        if not count:
+            return []
+        entail_logits = self._run_batches(batches, count)
+        if shortlists:
+            self.pruner.check(entail_logits, scored, shortlists)
+        # Softmax of the entailment logits over the candidate labels
+        scores = np.exp(entail_logits - entail_logits.max(axis=1, keepdims=True))
+        scores /= scores.sum(axis=1, keepdims=True)
+
+        results = []
+        for row in scores:
+            best = best_label(row)
+            results.append((ALLOWED_STAGES[best], float(row[best])))
+        return results
+
+    def classify(self, texts):
+        """
+        Classify a list of texts (premises are built per the premise strategy).
+        Returns a list of (stage, confidence) tuples in input order.
+        """
+        if not texts:
+            return []
+        return self.finish(self.prepare(texts))
+
+class ResultCache:
+    """
+    Persistent content-addressed cache of NLI results.
+
+    Keys are SHA-256 digests of the text with runs of spaces collapsed
+    within each line (line breaks are kept, as the premise builder reads
+    the first line as the subject) plus a fingerprint of everything that
+    can change an NLI answer (model id,
+    STAGE_DESCRIPTIONS, PATTERN_RULES, hypothesis template), so editing any
+    of them (or the engine `settings`, e.g. the premise strategy) starts
+    from a cold cache. Stored in SQLite (WAL mode, busy
+    timeout) so several classifier processes can share one file; least
+    recently used rows are evicted once `max_entries` is exceeded.
+    """
+
+    def __init__(self, path, model_id, max_entries=CACHE_MAX_ENTRIES, settings=None):
+        import hashlib
+        import sqlite3
+        import threading
+
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._namespace = hashlib.sha256(json.dumps({
+            "model": model_id,
+            "descriptions": STAGE_DESCRIPTIONS,
+            "rules": PATTERN_RULES,
+            "template": HYPOTHESIS_TEMPLATE,
+            "settings": settings or {},
+        }, sort_keys=True).encode("utf-8")).digest()
+        
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " key BLOB PRIMARY KEY, stage TEXT NOT NULL, confidence REAL NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+
+    def key(self, text):
+        import hashlib
+
+        normalized = "\n".join(" ".join(line.split()) for line in text.splitlines())
+        return hashlib.sha256(self._namespace + normalized.encode("utf-8")).digest()
+
+    def get_many(self, keys):
+        """Look up keys; returns {key: (stage, confidence)} for the hits"""
+        found = {}
+        unique = list(dict.fromkeys(keys))
+        with self._lock:
+            for start in range(0, len(unique), 500):
+                chunk = unique[start:start + 500]
+                rows = self._db.execute(
+                    f"SELECT key, stage, confidence FROM results WHERE key IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+                found.update((key, (stage, confidence)) for key, stage, confidence in rows)
+            if found:
+                # LRU touch
+                now = time.time()
+                self._db.executemany(
+                    "UPDATE results SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in found],
+                )
+        return found
+
+    def put_many(self, entries):
+        """Store (key, stage, confidence) entries, then enforce the size bound"""
+        if not entries:
+            return
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO results (key, stage, confidence, last_used) VALUES (?, ?, ?, ?)",
+                    [(key, stage, confidence, now) for key, stage, confidence in entries],
+                )
+                excess = self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0] - self.max_entries
+                if excess > 0:
+                    self._db.execute(
+                        "DELETE FROM results WHERE key IN "
+                        "(SELECT key FROM results ORDER BY last_used LIMIT ?)",
+                        (excess,),
+                    )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def summary(self):
+        return f"cache hits: {self.hits}, misses: {self.misses}"
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+def engine_prepare(engine, texts):
+    """
+    First half of engine.classify(texts): the CPU-side preparation. Engines
+    without a prepare()/finish() split do all their work in engine_finish().
+    """
+    prepare = getattr(engine, "prepare", None)
+    return prepare(texts) if prepare else texts
+
+def engine_finish(engine, prepared):
+    """Second half of engine.classify(): model execution on engine_prepare() output"""
+    finish = getattr(engine, "finish", None)
+    return finish(prepared) if finish else engine.classify(prepared)
+
+class CachedEngine:
+    """
+    Wraps an engine with a ResultCache: only texts that miss the cache reach
+    the wrapped engine, and its answers are written back.
+    """
+
+    def __init__(self, engine, cache):
+        self.engine = engine
+        self.cache = cache
+
+    def __getattr__(self, name):
+        # Everything but classify() is the wrapped engine's (premise, ...)
+        return getattr(self.engine, name)
+
+    def warm_up(self):
+        self.engine.warm_up()
+
+    def prepare(self, texts):
+        keys = [self.cache.key(text) for text in texts]
+        try:
+            cached = self.cache.get_many(keys)
+        except Exception as e:
+            log(f"Result cache read failed: {e}")
+            cached = {}
+        
+        misses = [i for i, key in enumerate(keys) if key not in cached]
+        self.cache.hits += len(texts) - len(misses)
+        self.cache.misses += len(misses)
+        
+        results = [cached.get(key) for key in keys]
+        inner = engine_prepare(self.engine, [texts[i] for i in misses]) if misses else None
+        return keys, results, misses, inner
+
+    def finish(self, prepared):
+        keys, results, misses, inner = prepared
+        if misses:
+            fresh = engine_finish(self.engine, inner)
+            for i, result in zip(misses, fresh):
+                results[i] = result
+            try:
+                self.cache.put_many([(keys[i], stage, confidence) for i, (stage, confidence) in zip(misses, fresh)])
+            except Exception as e:
+                log(f"Result cache write failed: {e}")
+        return results
+
+    def classify(self, texts):
+        if not texts:
+            return []
+        return self.finish(self.prepare(texts))
+
+class HashedLinearModel:
+    """
+    Multinomial logistic regression over hashed word unigrams and bigrams:
+    a first stage that costs microseconds per item against the NLI model's
+    seven forward passes. Features are hashed with CRC32 so a saved model
+    scores identically in every process.
+    """
+
+    def __init__(self, weights=None, bias=None, dim=CASCADE_FEATURES):
+        import numpy as np
+
+        self.dim = dim
+        self.labels = list(ALLOWED_STAGES)
+        self.weights = weights if weights is not None else np.zeros((dim, len(self.labels)), dtype=np.float32)
+        self.bias = bias if bias is not None else np.zeros(len(self.labels), dtype=np.float32)
+
+    @classmethod
+    def load(cls, path):
+        import numpy as np
+
+        with np.load(path) as data:
+            if list(data["labels"]) != list(ALLOWED_STAGES):
+                raise ValueError("cascade model was trained on a different stage set")
+            return cls(data["weights"], data["bias"], dim=int(data["dim"]))
+
+    def save(self, path):
+        import numpy as np
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez_compressed(tmp_path, weights=self.weights, bias=self.bias,
+                            dim=self.dim, labels=np.array(self.labels))
+        os.replace(tmp_path, path)
+
+    def features(self, text):
+        """(indices, values): L2-normalised hashed n-gram counts"""
+        import numpy as np
+        import zlib
+
+        words = CASCADE_TOKEN.findall(text.lower())[:CASCADE_MAX_WORDS]
+        counts = {}
+        for gram in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+            index = zlib.crc32(gram.encode("utf-8")) % self.dim
+            counts[index] = counts.get(index, 0.0) + 1.0
+        indices = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+        values = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+        if len(values):
+            values /= np.sqrt((values * values).sum())
+        return indices, values
+
+    def _probabilities(self, features):
+        import numpy as np
+
+        indices, values = features
+        scores = self.bias + values @ self.weights[indices]
+        scores = np.exp(scores - scores.max())
+        return scores / scores.sum()
+
+    def predict(self, texts):
+        """List of (stage, probability, top-1/top-2 margin) per text"""
+        predictions = []
+        for text in texts:
+            probs = self._probabilities(self.features(text))
+            second, best = probs.argsort()[-2:]
+            predictions.append((self.labels[best], float(probs[best]), float(probs[best] - probs[second])))
+        return predictions
+
+    def fit(self, texts, stages, epochs=8, learning_rate=0.5, seed=0):
+        """Plain SGD on the cross-entropy loss, one example at a time"""
+        import numpy as np
+
+        rng = np.random.default_rng(seed)
+        features = [self.features(text) for text in texts]
+        targets = [self.labels.index(stage) for stage in stages]
+        for epoch in range(epochs):
+            rate = learning_rate / (1 + epoch)
+            for i in rng.permutation(len(features)):
+                indices, values = features[i]
+                gradient = self._probabilities(features[i])
+                gradient[targets[i]] -= 1.0
+                self.weights[indices] -= rate * np.outer(values, gradient)
+                self.bias -= rate * gradient
+        return self
+
+class CascadeEngine:
+    """
+    Wraps an engine with a cheap first stage: items the first stage is sure
+    about (top-1/top-2 probability margin >= `margin`) are answered by it and
+    tagged tier "linear"; the rest escalate to the wrapped engine.
+    """
+
+    def __init__(self, engine, model, margin=CASCADE_MARGIN):
+        self.engine = engine
+        self.model = model
+        self.margin = margin
+        self.decided = 0
+        self.escalated = 0
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
+
+    def warm_up(self):
+        self.engine.warm_up()
+
+    def prepare(self, texts):
+        results = []
+        escalate = []
+        for i, (stage, confidence, margin) in enumerate(self.model.predict(texts)):
+            if margin >= self.margin:
+                results.append((stage, confidence, "linear"))
+            else:
+                results.append(None)
+                escalate.append(i)
+        self.decided += len(texts) - len(escalate)
+        self.escalated += len(escalate)
+        inner = engine_prepare(self.engine, [texts[i] for i in escalate]) if escalate else None
+        return results, escalate, inner
+
+    def finish(self, prepared):
+        results, escalate, inner = prepared
+        if escalate:
+            for i, result in zip(escalate, engine_finish(self.engine, inner)):
+                results[i] = result
+        return results
+
+    def classify(self, texts):
+        if not texts:
+            return []
+        return self.finish(self.prepare(texts))
+
+    def summary(self):
+        return f"cascade linear: {self.decided}, escalated: {self.escalated}"
+
+class EmbeddingEncoder:
+    """
+    Sentence embeddings: the last hidden states of a transformer encoder,
+    mean-pooled over the attention mask and L2-normalised (the
+    sentence-transformers recipe for MiniLM/MPNet models), computed in
+    length-sorted padded batches under torch.inference_mode.
+    """
+
+    name = "torch"
+
+    def __init__(self, model, tokenizer, batch_size=EMBED_BATCH_SIZE):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.batch_size = max(1, batch_size)
+        self.dim = model.config.hidden_size
+        self.max_length = tokenizer.model_max_length
+        max_positions = getattr(model.config, "max_position_embeddings", None)
+        if max_positions and self.max_length > max_positions:
+            self.max_length = max_positions
+        self.pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+
+    @classmethod
+    def load(cls, model_id, batch_size=EMBED_BATCH_SIZE, intra_op_threads=0):
+        from transformers import AutoModel, AutoTokenizer
+
+        path, source = resolve_model(model_id)
+        if source == "hub":
+            log(f"No local snapshot of {model_id}; run --prepare-model once for offline startup")
+        options = {"local_files_only": True} if source != "hub" else {}
+        if source == "snapshot":
+            options["use_safetensors"] = True
+        tokenizer = AutoTokenizer.from_pretrained(path, local_files_only=source != "hub")
+        model = AutoModel.from_pretrained(path, **options)
+        model.eval()
+        if intra_op_threads:
+            import torch
+            torch.set_num_threads(intra_op_threads)
+        return cls(model, tokenizer, batch_size)
+
+    def tokenize(self, texts):
+        """Padded numpy batches of `texts`, shortest first: ([(rows, inputs)], count)"""
+        import numpy as np
+
+        with TELEMETRY.phase("tokenize"):
+            ids = self.tokenizer(texts, truncation=True, max_length=self.max_length, verbose=False)["input_ids"]
+            order = sorted(range(len(ids)), key=lambda i: len(ids[i]))
+            batches = []
+            for start in range(0, len(order), self.batch_size):
+                chunk = order[start:start + self.batch_size]
+                width = len(ids[chunk[-1]])
+                inputs = {
+                    "input_ids": np.full((len(chunk), width), self.pad_id, dtype=np.int64),
+                    "attention_mask": np.zeros((len(chunk), width), dtype=np.int64),
+                }
+                for row, i in enumerate(chunk):
+                    inputs["input_ids"][row, :len(ids[i])] = ids[i]
+                    inputs["attention_mask"][row, :len(ids[i])] = 1
+                batches.append((chunk, inputs))
+        return batches, len(texts)
+
+    def run(self, prepared):
+        """Forward passes over tokenize() output; (count, dim) float32 unit vectors"""
+        import numpy as np
+        import torch
+
+        batches, count = prepared
+        vectors = np.zeros((count, self.dim), dtype=np.float32)
+        for rows, inputs in batches:
+            with TELEMETRY.phase("forward"), torch.inference_mode():
+                mask = torch.from_numpy(inputs["attention_mask"])
+                hidden = self.model(input_ids=torch.from_numpy(inputs["input_ids"]),
+                                    attention_mask=mask).last_hidden_state.float()
+                mask = mask.unsqueeze(-1).to(hidden.dtype)
+                vectors[rows] = ((hidden * mask).sum(1) / mask.sum(1).clamp(min=1)).numpy()
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+    def encode(self, texts):
+        return self.run(self.tokenize(texts))
+
+class VectorIndex:
+    """
+    Append-only on-disk index of labelled unit vectors for the kNN engine.
+
+    A directory of flat files: vectors.f32 (float32 rows), stages.u8 (the
+    ALLOWED_STAGES index of each row), ids.jsonl (one example id per line)
+    and index.json (embedding model, dimension, row count and byte sizes).
+    add() appends to the flat files and fsyncs them before atomically
+    replacing index.json, so index.json is the commit point: readers only
+    ever map committed rows, and a crashed update leaves an unreferenced tail
+    that the next add() truncates. Searches memory-map the vectors, so
+    processes share one page-cache copy and opening an index reads nothing
+    but index.json. The committed ids are read once per instance and then
+    kept up to date by add(), so incremental builds stay linear.
+    """
+
+    META = "index.json"
+
+    def __init__(self, path, model=None):
+        self.path = path
+        try:
+            with open(os.path.join(path, self.META), encoding="utf-8") as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            meta = {"model": model, "dim": None, "build": None, "count": 0, "ids_bytes": 0}
+        if meta.get("stages", ALLOWED_STAGES) != ALLOWED_STAGES:
+            raise ValueError("knn index was built for a different stage set")
+        if model and meta["model"] != model:
+            raise ValueError(f"knn index {path} holds {meta['model']} embeddings, not {model}")
+        self.meta = meta
+        self._mapped = None
+        self._known = None
+
+    @property
+    def count(self):
+        return self.meta["count"]
+
+    @property
+    def version(self):
+        """Identifies the committed contents: build id and row count"""
+        return f"{self.meta['build']}:{self.count}"
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def known_ids(self):
+        """Set of the (string) ids of the committed rows; add() keeps it current, so do not modify it"""
+        if self._known is None:
+            self._known = set()
+            if self.count:
+                with open(self._file("ids.jsonl"), "rb") as f:
+                    data = f.read(self.meta["ids_bytes"])
+                self._known = {json.loads(line) for line in data.splitlines()}
+        return self._known
+
+    def add(self, ids, vectors, stages):
+        """Append the examples whose id is not in the index yet; returns how many were added"""
+        import numpy as np
+        import uuid
+
+        known = self.known_ids()
+        new = set()
+        keep = []
+        for i, item_id in enumerate(ids):
+            if str(item_id) not in known and str(item_id) not in new:
+                new.add(str(item_id))
+                keep.append(i)
+        if not keep:
+            return 0
+
+        vectors = np.ascontiguousarray(np.asarray(vectors, dtype=np.float32)[keep])
+        meta = dict(self.meta, stages=ALLOWED_STAGES)
+        if meta["dim"] is None:
+            meta.update(dim=int(vectors.shape[1]), build=uuid.uuid4().hex[:FINGERPRINT_CHARS])
+        elif vectors.shape[1] != meta["dim"]:
+            raise ValueError(f"{vectors.shape[1]}-dimensional vectors for a {meta['dim']}-dimensional index")
+        id_lines = "".join(json.dumps(str(ids[i])) + "\n" for i in keep).encode("utf-8")
+        appends = [
+            ("vectors.f32", meta["count"] * meta["dim"] * 4, vectors.tobytes()),
+            ("stages.u8", meta["count"], bytes(ALLOWED_STAGES.index(stages[i]) for i in keep)),
+            ("ids.jsonl", meta["ids_bytes"], id_lines),
+        ]
+        os.makedirs(self.path, exist_ok=True)
+        for name, committed, data in appends:
+            with open(self._file(name), "ab") as f:
+                f.truncate(committed)
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+
+        meta["count"] += len(keep)
+        meta["ids_bytes"] += len(id_lines)
+        tmp_path = self._file(f"{self.META}.{os.getpid()}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._file(self.META))
+        self.meta = meta
+        self._mapped = None
+        known.update(new)
+        return len(keep)
+
+    def _map(self):
+        import numpy as np
+
+        if self._mapped is None:
+            count, dim = self.count, self.meta["dim"]
+            self._mapped = (
+                np.memmap(self._file("vectors.f32"), dtype=np.float32, mode="r", shape=(count, dim)),
+                np.memmap(self._file("stages.u8"), dtype=np.uint8, mode="r", shape=(count,)),
+            )
+        return self._mapped
+
+    def search(self, queries, k):
+        """
+        (similarities, stage indices) of the `k` rows nearest to each query
+        (cosine similarity of unit vectors), as (n, k) arrays, nearest first
+        """
+        import numpy as np
+
+        vectors, stages = self._map()
+        k = min(k, self.count)
+        n = len(queries)
+        best = np.empty((n, 0), dtype=np.float32)
+        rows = np.empty((n, 0), dtype=np.int64)
+        # A block of rows at a time, keeping the running top k, so memory
+        # stays at (n, KNN_SEARCH_ROWS) however large the index grows
+        for start in range(0, self.count, KNN_SEARCH_ROWS):
+            block = queries @ vectors[start:start + KNN_SEARCH_ROWS].T
+            best = np.concatenate([best, block], axis=1)
+            rows = np.concatenate([rows, np.broadcast_to(np.arange(start, start + block.shape[1]), block.shape)], axis=1)
+            if best.shape[1] > k:
+                top = np.argpartition(-best, k - 1, axis=1)[:, :k]
+                best = np.take_along_axis(best, top, axis=1)
+                rows = np.take_along_axis(rows, top, axis=1)
+        order = np.argsort(-best, axis=1, kind="stable")
+        return np.take_along_axis(best, order, axis=1), stages[np.take_along_axis(rows, order, axis=1)]
+
+class KnnEngine:
+    """
+    Nearest-neighbour alternative to NLIEngine: each premise is embedded once
+    (one forward pass instead of one per label) and labelled by its `k`
+    nearest examples in a VectorIndex. Every neighbour votes for its stage
+    with its (non-negative) similarity; the stage with the largest total
+    wins (ties as best_label()) with its share of the total as confidence.
+    Answers are tagged tier "knn".
+    """
+
+    def __init__(self, encoder, index, k=KNN_NEIGHBOURS, premise=None):
+        self.backend = encoder
+        self.index = index
+        self.k = k
+        self.premise = premise or PremiseBuilder()
+        self.fingerprint = knn_fingerprint(index.meta["model"], index.version, k, self.premise)
+
+    @classmethod
+    def load(cls, model_id, index_path, k=KNN_NEIGHBOURS, intra_op_threads=0, premise=None):
+        index = VectorIndex(index_path, model_id)
+        if not index.count:
+            raise ValueError(f"knn index {index_path} is empty; build it with --build-index")
+        return cls(EmbeddingEncoder.load(model_id, intra_op_threads=intra_op_threads), index, k, premise)
+
+    def warm_up(self):
+        self.classify(["warm up"])
+
+    def prepare(self, texts):
+        """Premises and tokenization, split out so a pipeline can overlap them with finish()"""
+        return self.backend.tokenize([self.premise.build(text) for text in texts])
+
+    def finish(self, prepared):
+        import numpy as np
+
+        if not prepared[1]:
+            return []
+        similarities, stages = self.index.search(self.backend.run(prepared), self.k)
+        totals = np.zeros((len(stages), len(ALLOWED_STAGES)), dtype=np.float64)
+        np.add.at(totals, (np.arange(len(stages))[:, None], stages), np.maximum(similarities, 0.0))
+
+        results = []
+        for row in totals:
+            total = row.sum()
+            if total <= 0:
+                results.append(("other", 0.0, "knn"))
+                continue
+            best = best_label(row)
+            results.append((ALLOWED_STAGES[best], float(row[best] / total), "knn"))
+        return results
+
+    def classify(self, texts):
+        """List of (stage, confidence, "knn") in input order"""
+        if not texts:
+            return []
+        return self.finish(self.prepare(texts))
+
+class DistilledHead:
+    """
+    Supervised 7-logit softmax head over frozen sentence embeddings: the
+    embeddings are standardised with the training set's mean and scale, then
+    scored by one linear layer. Trained by full-batch gradient descent on
+    the weighted cross-entropy, which takes seconds on CPU for tens of
+    thousands of examples.
+    """
+
+    def __init__(self, embed_model, weights, bias, mean, scale):
+        self.embed_model = embed_model
+        self.labels = list(ALLOWED_STAGES)
+        self.weights = weights
+        self.bias = bias
+        self.mean = mean
+        self.scale = scale
+
+    @classmethod
+    def load(cls, path):
+        import numpy as np
+
+        with np.load(path) as data:
+            if list(data["labels"]) != list(ALLOWED_STAGES):
+                raise ValueError("distilled model was trained on a different stage set")
+            return cls(str(data["embed_model"]), data["weights"], data["bias"], data["mean"], data["scale"])
+
+    def save(self, path):
+        import numpy as np
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, weights=self.weights, bias=self.bias, mean=self.mean, scale=self.scale,
+                 embed_model=self.embed_model, labels=np.array(self.labels))
+        os.replace(tmp_path, path)
+
+    def logits(self, vectors):
+        """(n, 7) logits for (n, dim) embeddings"""
+        return ((vectors - self.mean) / self.scale) @ self.weights + self.bias
+
+    @classmethod
+    def fit(cls, embed_model, vectors, stages, sample_weights=None,
+            epochs=DISTILL_EPOCHS, learning_rate=DISTILL_LEARNING_RATE, l2=DISTILL_L2):
+        import numpy as np
+
+        mean = vectors.mean(axis=0)
+        scale = vectors.std(axis=0) + 1e-6
+        features = (vectors - mean) / scale
+        targets = np.zeros((len(vectors), len(ALLOWED_STAGES)), dtype=np.float32)
+        targets[np.arange(len(vectors)), [ALLOWED_STAGES.index(stage) for stage in stages]] = 1.0
+        sample_weights = np.ones(len(vectors), dtype=np.float32) if sample_weights is None else sample_weights
+        sample_weights = (sample_weights / sample_weights.sum())[:, None]
+
+        weights = np.zeros((vectors.shape[1], len(ALLOWED_STAGES)), dtype=np.float32)
+        bias = np.zeros(len(ALLOWED_STAGES), dtype=np.float32)
+        for _ in range(epochs):
+            scores = features @ weights + bias
+            probs = np.exp(scores - scores.max(axis=1, keepdims=True))
+            probs /= probs.sum(axis=1, keepdims=True)
+            gradient = (probs - targets) * sample_weights
+            weights -= learning_rate * (features.T @ gradient + l2 * weights)
+            bias -= learning_rate * gradient.sum(axis=0)
+        return cls(embed_model, weights, bias, mean.astype(np.float32), scale.astype(np.float32))
+
+class DistilledEngine:
+    """
+    Single-pass alternative to NLIEngine: one encoder forward pass per
+    premise and a DistilledHead over the embedding, instead of one NLI pass
+    per label. Answers (argmax of the softmax, ties as best_label()) are
+    tagged tier "distilled".
+    """
+
+    def __init__(self, encoder, head, premise=None, fingerprint=None):
+        self.backend = encoder
+        self.head = head
+        self.premise = premise or PremiseBuilder()
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def load(cls, path, intra_op_threads=0, premise=None):
+        head = DistilledHead.load(path)
+        encoder = EmbeddingEncoder.load(head.embed_model, intra_op_threads=intra_op_threads)
+        return cls(encoder, head, premise, distilled_fingerprint(path, premise))
+
+    def warm_up(self):
+        self.classify(["warm up"])
+
+    def prepare(self, texts):
+        """Premises and tokenization, split out so a pipeline can overlap them with finish()"""
+        return self.backend.tokenize([self.premise.build(text) for text in texts])
+
+    def finish(self, prepared):
+        import numpy as np
+
+        if not prepared[1]:
+            return []
+        logits = self.head.logits(self.backend.run(prepared))
+        scores = np.exp(logits - logits.max(axis=1, keepdims=True))
+        scores /= scores.sum(axis=1, keepdims=True)
+        results = []
+        for row in scores:
+            best = best_label(row)
+            results.append((ALLOWED_STAGES[best], float(row[best]), "distilled"))
+        return results
+
+    def classify(self, texts):
+        """List of (stage, confidence, "distilled") in input order"""
+        if not texts:
+            return []
+        return self.finish(self.prepare(texts))
+
+class DedupEngine:
+    """
+    Wraps an engine so identical texts in a run share one computation:
+    duplicates within a batch are classified once, and answers are
+    remembered (up to `max_entries` distinct texts, oldest dropped first)
+    for later batches. Texts are keyed by canonicalize() (unless
+    --no-canonicalize), so reposts and "Re:"/"Fwd:" copies of a subject
+    share the answer computed for the first of them.
+    """
+
+    def __init__(self, engine, max_entries=DEDUP_MAX_ENTRIES):
+        from collections import OrderedDict
+
+        self.engine = engine
+        self.max_entries = max_entries
+        self.memo = OrderedDict()
+        self.items = 0
+        self.duplicates = 0
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
+
+    def warm_up(self):
+        self.engine.warm_up()
+
+    @staticmethod
+    def key(text):
+        import hashlib
+
+        if CANONICALIZE:
+            text = canonicalize(text)
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+    def prepare(self, texts):
+        keys = [self.key(text) for text in texts]
+        results = [self.memo.get(key) for key in keys]
+        unique = {}
+        for i, key in enumerate(keys):
+            if results[i] is None and key not in unique:
+                unique[key] = i
+        self.items += len(texts)
+        self.duplicates += len(texts) - len(unique)
+        inner = engine_prepare(self.engine, [texts[i] for i in unique.values()]) if unique else None
+        return keys, results, unique, inner
+
+    def finish(self, prepared):
+        keys, results, unique, inner = prepared
+        if unique:
+            fresh = dict(zip(unique, engine_finish(self.engine, inner)))
+            for key, result in fresh.items():
+                self.memo[key] = result
+            while len(self.memo) > self.max_entries:
+                self.memo.popitem(last=False)
+            results = [fresh[key] if result is None else result for key, result in zip(keys, results)]
+        return results
+
+    def classify(self, texts):
+        if not texts:
+            return []
+        return self.finish(self.prepare(texts))
+
+    def summary(self):
+        ratio = self.duplicates / self.items if self.items else 0.0
+        return f"dedup: {self.duplicates}/{self.items} NLI texts shared ({ratio:.1%})"
+
+class LazyEngine:
+    """
+    Defers the torch/transformers imports and the model load until the first
+    item that actually needs NLI, so runs that the pattern rules (or the
+    result cache / cascade) fully answer never pay for them. `fingerprint`
+    (see nli_fingerprint()) is known up front, so stamping cached answers
+    never forces a load.
+    """
+
+    def __init__(self, loader, premise, fingerprint=None):
+        self.loader = loader
+        self.premise = premise
+        self.fingerprint = fingerprint
+        self.engine = None
+
+    def _load(self):
+        if self.engine is None:
+            log("Loading NLI classification model (first item needing NLI)...")
+            start = time.perf_counter()
+            try:
+                with TELEMETRY.phase("model_load"):
+                    self.engine = self.loader()
+            except Exception as e:
+                log(f"Error loading model: {e}")
+                sys.exit(1)
+            log(f"Model loaded in {time.perf_counter() - start:.2f}s.")
+        return self.engine
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def warm_up(self):
+        self._load().warm_up()
+
+    def prepare(self, texts):
+        return self._load().prepare(texts)
+
+    def finish(self, prepared):
+        return self._load().finish(prepared)
+
+    def classify(self, texts):
+        if not texts:
+            return []
+        return self._load().classify(texts)
+
+class PendingEngine:
+    """
+    Stand-in engine for --patterns-only: never imports torch, answers every
+    item with (None, 0.0, "needs_nli") so the caller can route it to NLI.
+    """
+
+    def __init__(self, premise):
+        self.premise = premise
+
+    def warm_up(self):
+        pass
+
+    def prepare(self, texts):
+        return len(texts)
+
+    def finish(self, prepared):
+        return [(None, 0.0, "needs_nli")] * prepared
+
+    def classify(self, texts):
+        return self.finish(self.prepare(texts))
+
+# Tiers decided by a --engine model, whose records carry its fingerprint
+MODEL_TIERS = ("nli", "knn", "distilled")
+
+def result_record(item_id, stage, confidence):
+    """One output line: {"id": ..., "stage": ..., "confidence": 0.XX, "rules": ...}"""
+    return {"id": item_id, "stage": stage, "confidence": round(confidence, 4), "rules": rules_fingerprint()}
+
+def nli_record(engine, item_id, nli_result):
+    """
+    Output record for an engine decision, tagged with the tier that decided
+    (a cascade first stage and the kNN and distilled engines answer (stage,
+    confidence, tier); answers of a MODEL_TIERS engine carry the premise
+    strategy and the model fingerprint). None (a failed item) becomes other/0.0
+    """
+    if nli_result is None:
+        return result_record(item_id, "other", 0.0)
+    record = result_record(item_id, nli_result[0], nli_result[1])
+    record["tier"] = nli_result[2] if len(nli_result) > 2 else "nli"
+    if record["tier"] in MODEL_TIERS:
+        if getattr(engine, "premise", None):
+            record["premise"] = engine.premise.strategy
+        if getattr(engine, "fingerprint", None):
+            record["model"] = engine.fingerprint
+    elif record["tier"] == "needs_nli":
+        record["needs_nli"] = True
+    return record
+
+def item_text(item):
+    """The text of an input item as classified (stripped)"""
+    return item.get("text", "").strip()
+
+def prepare_items(items, counts):
+    """
+    Empty-text and pattern pass over a list of input items.
+
+    Returns (results, pending): `results` holds one output record per item in
+    input order, with None where the item still needs NLI; `pending` lists
+    (slot, item_id, text) for those items.
+    """
+    results = []
+    pending = []
+    for item in items:
+        item_id = item.get("id", "unknown")
+        text = item_text(item)
+        
+        if not text:
+            results.append(result_record(item_id, "other", 0.0))
+            TELEMETRY.observe("empty", 0.0)
+            continue
+        
+        # Try pattern-based classification first (high confidence)
+        start = time.perf_counter()
+        pattern_result = quick_classify(text)
+        elapsed = time.perf_counter() - start
+        TELEMETRY.add("patterns", elapsed)
+        if pattern_result:
+            results.append(dict(result_record(item_id, *pattern_result), tier="pattern"))
+            TELEMETRY.observe("pattern", elapsed)
+            counts["pattern"] += 1
+            continue
+        
+        # Fall back to NLI for ambiguous cases
+        results.append(None)
+        pending.append((len(results) - 1, item_id, text))
+    
+    return results, pending
+
+def classify_nli(engine, pending):
+    """Run NLI for (item_id, text) pairs; isolate failures to single items"""
+    try:
+        return engine.classify([text for _, text in pending])
+    except Exception as e:
+        if len(pending) == 1:
+            log(f"Classification error for {pending[0][0]}: {e}")
+            return [None]
+        log(f"Batched NLI failed ({e}), retrying items individually")
+        return [classify_nli(engine, [entry])[0] for entry in pending]
+
+def complete_items(engine, results, pending, counts, prepared=None):
+    """
+    Fill the NLI slots left by prepare_items() with one batched NLI call
+    (finishing `prepared`, engine_prepare() output for the pending texts, when
+    given). Items decided in the same call share its latency in telemetry.
+    """
+    if not pending:
+        return results
+    
+    start = time.perf_counter()
+    nli_results = None
+    if prepared is not None:
+        try:
+            nli_results = engine_finish(engine, prepared)
+        except Exception as e:
+            log(f"Batched NLI failed ({e}), retrying items individually")
+    if nli_results is None:
+        nli_results = classify_nli(engine, [(item_id, text) for _, item_id, text in pending])
+    elapsed = time.perf_counter() - start
+    for (slot, item_id, _), nli_result in zip(pending, nli_results):
+        record = results[slot] = nli_record(engine, item_id, nli_result)
+        TELEMETRY.observe(record.get("tier", "failed"), elapsed)
+        if record.get("needs_nli"):
+            counts["needs_nli"] = counts.get("needs_nli", 0) + 1
+        elif nli_result is not None:
+            counts["nli"] += 1
+    return results
+
+def classify_items(engine, items, counts):
+    """Classify a list of input items; returns output records in input order"""
+    results, pending = prepare_items(items, counts)
+    return complete_items(engine, results, pending, counts)
+
+class ThreadPropagator:
+    """
+    Thread-aware classification for inputs carrying optional `thread_id`
+    and/or `parent_id` fields.
+
+    Threads are keyed by thread_id when given (a topic id or the root's own
+    id), otherwise by following parent_id. The thread root is the item
+    without a parent_id; an item carrying only a thread_id counts as a reply
+    when its thread's root was already seen (and is not itself that id).
+    Roots are classified as usual and their stage becomes the thread's stage. A reply
+    then inherits that stage (tier "thread") unless its own pattern pass
+    names a different stage: only such conflicting replies go to NLI (marked
+    "thread_conflict"). Replies that agree with the root keep their pattern
+    record. Replies that arrive before their root wait for it (at most
+    `max_waiting` items; beyond that, and at end of input, waiting replies
+    are classified on their own). Items without thread fields are roots of
+    their own one-item thread, so plain inputs are classified as before.
+    Only the latest `max_roots` root stages and thread links are kept (a
+    reply to an older root is classified on its own), so memory stays
+    bounded however long the input is.
+    """
+
+    def __init__(self, engine, counts, max_waiting=THREAD_MAX_WAITING, max_roots=THREAD_MAX_ROOTS):
+        from collections import OrderedDict
+
+        self.engine = engine
+        self.counts = counts
+        self.max_waiting = max_waiting
+        self.max_roots = max_roots
+        # Items with thread fields only: item id -> thread key, so grandchildren find the thread
+        self.thread_of = OrderedDict()
+        self.rooted = OrderedDict()  # thread keys whose root has been seen
+        self.stages = OrderedDict()  # thread key -> (stage, confidence) of the root
+        self.waiting = OrderedDict()  # thread key -> replies waiting for their root
+        self.waiting_items = 0
+        self.inherited = 0
+        self.conflicts = 0
+
+    def _thread(self, item):
+        """(thread key, is_root) of an item"""
+        item_id = str(item.get("id", "unknown"))
+        parent_id = item.get("parent_id")
+        thread_id = item.get("thread_id")
+        if thread_id is not None:
+            key = str(thread_id)
+        elif parent_id is not None:
+            key = self.thread_of.get(str(parent_id), str(parent_id))
+        else:
+            # A plain item roots its own thread; replies find it by its id
+            self._remember(self.rooted, item_id, True)
+            return item_id, True
+        self._remember(self.thread_of, item_id, key)
+        is_root = parent_id is None and (key == item_id or key not in self.rooted)
+        if is_root:
+            self._remember(self.rooted, key, True)
+        return key, is_root
+
+    def _remember(self, mapping, key, value):
+        """Store into one of the bounded maps, dropping its oldest entries"""
+        mapping[key] = value
+        mapping.move_to_end(key)
+        while len(mapping) > self.max_roots:
+            mapping.popitem(last=False)
+
+    def _rooted(self, key, item, stage):
+        """
+        Record the stage of a thread root; returns the replies waiting for it,
+        including replies that named the root by its own id before it arrived,
+        as (thread key, reply, root stage) triples
+        """
+        root_id = str(item.get("id", "unknown"))
+        keys = [key] if root_id == key else [key, root_id]
+        replies = []
+        for name in keys:
+            self._remember(self.stages, name, stage)
+            for reply in self.waiting.pop(name, []):
+                replies.append((key, reply, stage))
+                self.waiting_items -= 1
+        return replies
+
+    def classify(self, items):
+        """Classify a mini-batch; returns the output records now decided (any order)"""
+        roots = []
+        replies = []
+        for item in items:
+            key, is_root = self._thread(item)
+            if is_root:
+                roots.append((key, item))
+            elif key in self.stages:
+                # Capture the root's stage now: rooting this batch's new
+                # items below may evict it from the bounded map
+                replies.append((key, item, self.stages[key]))
+            else:
+                self.waiting.setdefault(key, []).append(item)
+                self.waiting_items += 1
+        
+        records = classify_items(self.engine, [item for _, item in roots], self.counts)
+        for (key, item), record in zip(roots, records):
+            if record["stage"] is not None and record["confidence"] > 0:
+                replies.extend(self._rooted(key, item, (record["stage"], record["confidence"])))
+        
+        records.extend(self._classify_replies(replies))
+        while self.waiting_items > self.max_waiting:
+            _, orphans = self.waiting.popitem(last=False)
+            self.waiting_items -= len(orphans)
+            records.extend(classify_items(self.engine, orphans, self.counts))
+        return records
+
+    def replayed(self, item, record):
+        """
+        Register an item answered from a --resume journal, so replies to it
+        still inherit its stage; returns the records of replies it releases
+        """
+        key, is_root = self._thread(item)
+        if not is_root or record["stage"] is None or record["confidence"] <= 0:
+            return []
+        return self._classify_replies(self._rooted(key, item, (record["stage"], record["confidence"])))
+
+    def flush(self):
+        """End of input: classify replies whose root never arrived on their own"""
+        orphans = [item for items in self.waiting.values() for item in items]
+        self.waiting.clear()
+        self.waiting_items = 0
+        return classify_items(self.engine, orphans, self.counts)
+
+    def _classify_replies(self, replies):
+        records = []
+        pending = []
+        for key, item, (stage, confidence) in replies:
+            item_id = item.get("id", "unknown")
+            text = item_text(item)
+            pattern_result = quick_classify(text) if text else None
+            if pattern_result is None:
+                records.append(dict(result_record(item_id, stage, confidence), tier="thread", thread_id=key))
+                self.inherited += 1
+            elif pattern_result[0] == stage:
+                records.append(dict(result_record(item_id, *pattern_result), tier="pattern"))
+                self.counts["pattern"] += 1
+            else:
+                records.append(None)
+                pending.append((len(records) - 1, item_id, text))
+        
+        self.conflicts += len(pending)
+        complete_items(self.engine, records, pending, self.counts)
+        for slot, _, _ in pending:
+            records[slot]["thread_conflict"] = True
+        return records
+
+    def summary(self):
+        return f"thread: {self.inherited} inherited, {self.conflicts} conflicts"
+
+def run_pipeline(engine, stream, output, counts, args, budget, journal=None):
+    """
+    Pipelined classification of an input stream in three stages:
+      reader    - parses input, runs the pattern pass and prepares the NLI
+                  batch of each mini-batch (cache lookups, tokenization,
+                  padding) via engine_prepare()
+      inference - this thread: runs the model (engine_finish())
+      writer    - encodes and writes output records
+    Tokenizers and torch release the GIL, so preparation of the next batches
+    overlaps the forward pass of the current one. The queues between stages
+    hold at most --pipeline-depth batches, so a slow stage blocks the one
+    feeding it instead of letting memory grow. Mini-batches are sized by
+    `budget` (a MemoryBudget); items in `journal` are answered from it.
+    Returns the items processed.
+    """
+    import queue
+    import threading
+
+    ready = queue.Queue(maxsize=args.pipeline_depth)
+    done = queue.Queue(maxsize=args.pipeline_depth)
+    failures = []
+    processed = [0]
+
+    def read():
+        try:
+            for items in read_batches(stream, budget, args.framing, journal):
+                results, pending = prepare_items(items, counts)
+                prepared = None
+                if pending:
+                    try:
+                        prepared = engine_prepare(engine, [text for _, _, text in pending])
+                    except Exception as e:
+                        log(f"Batch preparation failed ({e}), classifying items individually")
+                ready.put((results, pending, prepared))
+        except BaseException as e:  # Includes SystemExit from a failed model load
+            failures.append(e)
+        finally:
+            ready.put(None)
+
+    def write():
+        while True:
+            records = done.get()
+            if records is None:
+                return
+            with TELEMETRY.phase("output"):
+                output.write_many(records)
+            for _ in records:
+                processed[0] += 1
+                if processed[0] % 50 == 0:
+                    log(f"Processed {processed[0]} items...")
+
+    reader = threading.Thread(target=read, name="reader", daemon=True)
+    writer = threading.Thread(target=write, name="writer", daemon=True)
+    reader.start()
+    writer.start()
+    
+    try:
+        while True:
+            job = ready.get()
+            if job is None:
+                break
+            results, pending, prepared = job
+            done.put(complete_items(engine, results, pending, counts, prepared))
+            budget.check()
+            TELEMETRY.maybe_emit()
+    finally:
+        done.put(None)
+        writer.join()
+    
+    reader.join()
+    if failures:
+        raise failures[0]
+    return processed[0]
+
+class Reclassifier:
+    """
+    --reclassify: classify again only the items of a corpus whose result
+    could differ from `previous` ({id: record} output of an earlier run on
+    the same corpus) under the current rules and model.
+
+    The pattern pass is cheap, so it is repeated for every item and compared
+    with the previous record; that finds items newly matched by added or
+    edited rules ("new_match"), items whose earliest-matching rule moved to
+    a different stage or confidence ("moved") and items no rule matches any
+    more ("unmatched", re-run through NLI). Items still left to NLI keep
+    their previous answer when it carries the current model fingerprint, and
+    are re-run otherwise ("model": changed descriptions, template, premise
+    settings or model, or a record from before fingerprints). Thread-inherited
+    replies are re-derived from their root's current stage. Items missing
+    from `previous` are classified as new.
+    """
+
+    REASONS = ["new_item", "new_match", "moved", "unmatched", "model", "thread"]
+
+    def __init__(self, engine, previous, counts):
+        self.engine = engine
+        self.previous = previous
+        self.counts = counts
+        self.rules = rules_fingerprint()
+        self.model = getattr(engine, "fingerprint", None)
+        self.threads = ThreadPropagator(engine, counts)
+        # Stages of thread roots this run, for their inheriting replies
+        self.roots = {str(record["thread_id"]) for record in previous.values() if record.get("tier") == "thread"}
+        self.root_stages = {}
+        self.reasons = dict.fromkeys(self.REASONS, 0)
+        self.kept = 0
+        self.changed = 0
+
+    def classify(self, items):
+        """Reclassify a mini-batch; returns (records, changed records) in any order"""
+        records = []
+        rerun = []
+        replies = []
+        thread_roots = {}  # item id -> thread key, for items that may be a thread root
+        for item in items:
+            item_id = item.get("id", "unknown")
+            if item.get("parent_id") is None:
+                thread_roots[str(item_id)] = str(item.get("thread_id", item_id))
+            previous = self.previous.get(str(item_id))
+            if previous is None:
+                self.reasons["new_item"] += 1
+                rerun.append(item)
+                continue
+            
+            text = item_text(item)
+            tier = previous.get("tier")
+            pattern_result = quick_classify(text) if text else None
+            if not text:
+                records.append(result_record(item_id, "other", 0.0))
+            elif pattern_result:
+                record = dict(result_record(item_id, *pattern_result), tier="pattern")
+                if tier != "pattern":
+                    self.reasons["new_match"] += 1
+                elif (record["stage"], record["confidence"]) != (previous["stage"], previous["confidence"]):
+                    self.reasons["moved"] += 1
+                self.counts["pattern"] += 1
+                records.append(record)
+            elif tier == "pattern":
+                self.reasons["unmatched"] += 1
+                rerun.append(item)
+            elif tier == "thread" and previous.get("thread_id") is not None:
+                self.reasons["thread"] += 1
+                replies.append((str(previous["thread_id"]), item, previous))
+            elif tier in MODEL_TIERS and self.model and previous.get("model") == self.model:
+                records.append(dict(previous, rules=self.rules))
+            else:
+                self.reasons["model"] += 1
+                rerun.append(item)
+        
+        self.kept += len(records)
+        records.extend(classify_items(self.engine, rerun, self.counts))
+        for record in records:
+            key = thread_roots.get(str(record["id"]))
+            if key not in self.roots or record["stage"] is None or record["confidence"] <= 0:
+                continue
+            if key == str(record["id"]):
+                self.root_stages[key] = (record["stage"], record["confidence"])
+            else:
+                self.root_stages.setdefault(key, (record["stage"], record["confidence"]))
+        if replies:
+            stages = [self.root_stages.get(key, (previous["stage"], previous["confidence"]))
+                      for key, _, previous in replies]
+            for (key, _, _), stage in zip(replies, stages):
+                self.threads._remember(self.threads.stages, key, stage)
+            records.extend(self.threads._classify_replies(
+                [(key, item, stage) for (key, item, _), stage in zip(replies, stages)]))
+        
+        changed = [record for record in records if self._changed(record)]
+        self.changed += len(changed)
+        return records, changed
+
+    def _changed(self, record):
+        previous = self.previous.get(str(record["id"]))
+        return (previous is None or record["stage"] != previous.get("stage")
+                or record["confidence"] != previous.get("confidence"))
+
+    def summary(self):
+        rerun = ", ".join(f"{reason} {count}" for reason, count in self.reasons.items() if count)
+        return f"reclassify: {self.kept} kept, re-run ({rerun or 'none'}), {self.changed} changed"
+
+class InferenceServer:
+    """
+    Long-lived classification server speaking a request-id multiplexed JSONL
+    protocol over stdin/stdout, so the model is loaded once per server
+    instead of once per call.
+
+    Requests (one JSON object per line):
+      {"request_id": "r1", "op": "classify", "items": [{"id": "...", "text": "..."}]}
+      {"request_id": "r2", "op": "health"}
+      {"request_id": "r3", "op": "shutdown"}
+      {"request_id": "r1", "op": "cancel"}
+
+    Responses carry the same request_id and may arrive out of order:
+      {"request_id": "r1", "results": [{"id": "...", "stage": "...", "confidence": 0.XX}]}
+      {"request_id": "r2", "status": "ready", ...}
+      {"request_id": "r1", "status": "cancelled"}
+      {"request_id": "...", "error": "..."}
+
+    {"event": "ready"} is written once the model is loaded. The pattern pass
+    runs on the reader thread, so pattern-only requests are answered at once;
+    NLI work is queued to a single inference thread that coalesces the items
+    of all waiting requests into one batch. A cancel request drops the queued
+    NLI work of the request with its request_id (a caller that gave up on it),
+    which then gets no results. EOF on stdin, a shutdown request, SIGTERM or
+    SIGINT stop reading, drain queued work and exit.
+    """
+
+    def __init__(self, engine, max_batch_items=SERVE_MAX_BATCH_ITEMS, framing="lines", budget=None):
+        import queue
+        import threading
+
+        self.engine = engine
+        self.max_batch_items = max_batch_items
+        self.framing = framing
+        self.budget = budget or MemoryBudget()  # Only for pressure GCs between batches
+        self.jobs = queue.Queue()
+        self.queued = set()  # request_ids with NLI work not yet taken by the inference thread
+        self.cancelled = set()
+        # Responses are flushed as they are sent: each is already a whole request
+        self.writer = OutputWriter(sys.stdout.buffer, framing, flush_interval=0)
+        self.counts = {"pattern": 0, "nli": 0, "requests": 0}
+        self.started_at = time.time()
+        self.draining = False
+        self._worker = threading.Thread(target=self._inference_loop, name="inference", daemon=True)
+
+    def send(self, message):
+        with TELEMETRY.phase("output"):
+            self.writer.write(message)
+
+    def health(self):
+        return {
+            "status": "draining" if self.draining else "ready",
+            "pid": os.getpid(),
+            "uptime_s": round(time.time() - self.started_at, 1),
+            "queued": self.jobs.qsize(),
+            "requests": self.counts["requests"],
+            "pattern": self.counts["pattern"],
+            "nli": self.counts["nli"],
+            "memory": memory_report(),
+        }
+
+    def handle(self, request):
+        """Dispatch one request; returns False when the server should stop"""
+        request_id = request.get("request_id")
+        op = request.get("op", "classify")
+        
+        if op == "health":
+            self.send({"request_id": request_id, **self.health()})
+        elif op == "shutdown":
+            self.send({"request_id": request_id, "status": "shutting_down"})
+            return False
+        elif op == "cancel":
+            if request_id in self.queued:
+                self.cancelled.add(request_id)
+            self.send({"request_id": request_id, "status": "cancelled"})
+        elif op == "classify":
+            items = request.get("items")
+            if not isinstance(items, list):
+                self.send({"request_id": request_id, "error": "classify requires an 'items' list"})
+                return True
+            self.counts["requests"] += 1
+            try:
+                results, pending = prepare_items(items, self.counts)
+            except (AttributeError, TypeError) as e:
+                self.send({"request_id": request_id, "error": f"invalid items: {e}"})
+                return True
+            if pending:
+                self.queued.add(request_id)
+                self.jobs.put((request_id, results, pending))
+            else:
+                self.send({"request_id": request_id, "results": results})
+        else:
+            self.send({"request_id": request_id, "error": f"unknown op: {op}"})
+        return True
+
+    def _inference_loop(self):
+        import queue
+
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            
+            # Coalesce whatever else is already waiting into the same batch
+            jobs = [job]
+            total = len(job[2])
+            stop = False
+            while total < self.max_batch_items:
+                try:
+                    extra = self.jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if extra is None:
+                    stop = True
+                    break
+                jobs.append(extra)
+                total += len(extra[2])
+            
+            # Drop the work of requests cancelled while they were queued
+            taken = jobs
+            jobs = [job for job in taken if job[0] not in self.cancelled]
+            for request_id, _, _ in taken:
+                self.queued.discard(request_id)
+                self.cancelled.discard(request_id)
+            if not jobs:
+                if stop:
+                    return
+                continue
+            
+            merged = []
+            for job_index, (_, _, pending) in enumerate(jobs):
+                merged.extend((job_index, entry) for entry in pending)
+            start = time.perf_counter()
+            nli_results = classify_nli(self.engine, [(item_id, text) for _, (_, item_id, text) in merged])
+            elapsed = time.perf_counter() - start
+            
+            for (job_index, (slot, item_id, _)), nli_result in zip(merged, nli_results):
+                record = jobs[job_index][1][slot] = nli_record(self.engine, item_id, nli_result)
+                TELEMETRY.observe(record.get("tier", "failed"), elapsed)
+                if nli_result is not None:
+                    self.counts["nli"] += 1
+            
+            for request_id, results, _ in jobs:
+                self.send({"request_id": request_id, "results": results})
+            self.budget.check()
+            TELEMETRY.maybe_emit()
+            
+            if stop:
+                return
+
+    def serve(self, stream):
+        import signal
+
+        class _Shutdown(Exception):
+            pass
+
+        def on_signal(signum, frame):
+            raise _Shutdown()
+
+        signal.signal(signal.SIGTERM, on_signal)
+        signal.signal(signal.SIGINT, on_signal)
+        
+        # Warm up so the first real request does not pay one-time init costs
+        self.engine.warm_up()
+        
+        self._worker.start()
+        self.send({"event": "ready", "pid": os.getpid()})
+        log("Inference server ready")
+        
+        try:
+            for payload in iter_payloads(stream, self.framing, bulk=False):
+                try:
+                    request = json_loads(payload)
+                except json.JSONDecodeError as e:
+                    self.send({"request_id": None, "error": f"invalid JSON: {e}"})
+                    continue
+                if not isinstance(request, dict):
+                    self.send({"request_id": None, "error": "request must be a JSON object"})
+                    continue
+                if not self.handle(request):
+                    break
+        except _Shutdown:
+            log("Signal received, draining...")
+        
+        # Graceful shutdown: finish queued work, then exit
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        self.draining = True
+        self.jobs.put(None)
+        self._worker.join()
+        log(f"Inference server stopped. Served {self.counts['requests']} requests "
+            f"(pattern: {self.counts['pattern']}, NLI: {self.counts['nli']}).")
+        TELEMETRY.emit("telemetry_final", requests=self.counts["requests"])
+
+def _file_sha256(path):
+    import hashlib
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def prepare_model(args):
+    """
+    Write a pinned local snapshot of --model (--embed-model with --engine
+    knn or distilled) at --revision to the model store: safetensors weights, config and
+    tokenizer files, plus a manifest recording the resolved commit and file
+    hashes. Later runs load it offline. Prints a JSON report including the
+    offline load time; returns the exit code.
+    """
+    import inspect
+    import shutil
+    from transformers import AutoModel, AutoModelForSequenceClassification, AutoTokenizer
+
+    model_id = args.embed_model if args.engine != "nli" else args.model
+    model_class = AutoModel if args.engine != "nli" else AutoModelForSequenceClassification
+    target = model_snapshot_path(model_id)
+    tmp_dir = f"{target}.{os.getpid()}.tmp"
+    start = time.perf_counter()
+    
+    log(f"Preparing local snapshot of {model_id} in {target}...")
+    tokenizer = AutoTokenizer.from_pretrained(model_id, revision=args.revision)
+    model = model_class.from_pretrained(model_id, revision=args.revision)
+    
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    save_options = {}
+    if "safe_serialization" in inspect.signature(model.save_pretrained).parameters:
+        save_options["safe_serialization"] = True  # transformers < 5 defaults to pickle
+    model.save_pretrained(tmp_dir, **save_options)
+    tokenizer.save_pretrained(tmp_dir)
+    if not any(name.endswith(".safetensors") for name in os.listdir(tmp_dir)):
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        log("Snapshot has no safetensors weights; is the safetensors package installed?")
+        return 1
+    
+    manifest = {
+        "model": model_id,
+        "revision": args.revision or "main",
+        "commit": getattr(model.config, "_commit_hash", None),
+        "files": {name: _file_sha256(os.path.join(tmp_dir, name)) for name in sorted(os.listdir(tmp_dir))},
+    }
+    with open(os.path.join(tmp_dir, SNAPSHOT_MANIFEST), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    del model
+    
+    shutil.rmtree(target, ignore_errors=True)
+    os.replace(tmp_dir, target)
+    prepare_seconds = time.perf_counter() - start
+    
+    start = time.perf_counter()
+    if args.engine != "nli":
+        EmbeddingEncoder.load(model_id)
+    else:
+        NLIEngine.load(model_id)
+    report = dict(manifest, snapshot=target, prepare_seconds=round(prepare_seconds, 3),
+                  offline_load_seconds=round(time.perf_counter() - start, 3))
+    print(json.dumps(report, indent=2))
+    return 0
+
+def load_reference_corpus(path=None):
+    """Texts for backend equivalence checks: a JSONL file of {"text": ...} or the built-in corpus"""
+    if not path:
+        return list(REFERENCE_CORPUS)
+    texts = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                texts.append(json.loads(line).get("text", ""))
+    return [text for text in texts if text.strip()]
+
+def verify_backends(args):
+    """
+    Check that the ONNX backend picks the same stage as the PyTorch backend
+    on a reference corpus. Prints a JSON report to stdout; returns the exit
+    code (0 = all labels match).
+    """
+    texts = load_reference_corpus(args.reference_corpus)
+    engines = {
+        backend: NLIEngine.load(
+            args.model, batch_size=args.nli_batch_size, backend=backend, onnx_path=args.onnx_path,
+            intra_op_threads=args.intra_op_threads, inter_op_threads=args.inter_op_threads,
+        )
+        for backend in ("torch", "onnx")
+    }
+    reference = engines["torch"].classify(texts)
+    candidate = engines["onnx"].classify(texts)
+    
+    mismatches = [
+        {"text": text[:120], "torch": ref[0], "onnx": got[0]}
+        for text, ref, got in zip(texts, reference, candidate)
+        if ref[0] != got[0]
+    ]
+    report = {
+        "items": len(texts),
+        "label_matches": len(texts) - len(mismatches),
+        "max_confidence_delta": max(
+            (abs(ref[1] - got[1]) for ref, got in zip(reference, candidate)), default=0.0
+        ),
+        "mismatches": mismatches,
+    }
+    print(json.dumps(report, indent=2))
+    return 1 if mismatches else 0
+
+def measure_premise(args, stream):
+    """
+    Classify the NLI-bound items of a JSONL corpus twice, with full premises
+    and with the selected premise strategy, and print a JSON report of the
+    latency saved against the change in labels. Returns the exit code.
+    """
+    texts = [
+        item.get("text", "")
+        for items in read_batches(stream, memory_budget(args))
+        for item in items
+        if item.get("text", "").strip() and quick_classify(item["text"]) is None
+    ]
+    engine = load_nli_engine(args)
+    engine.warm_up()
+    
+    runs = {}
+    for builder in (PremiseBuilder("full"), premise_builder(args)):
+        engine.premise = builder
+        start = time.perf_counter()
+        runs[builder.strategy] = (engine.classify(texts), time.perf_counter() - start)
+    (reference, full_seconds), (candidate, seconds) = runs["full"], runs[args.premise_strategy]
+    
+    agree = sum(1 for ref, got in zip(reference, candidate) if ref[0] == got[0])
+    report = {
+        "items": len(texts),
+        "strategy": premise_builder(args).settings(),
+        "full_seconds": round(full_seconds, 3),
+        "strategy_seconds": round(seconds, 3),
+        "latency_saved_pct": round(100 * (1 - seconds / full_seconds), 1) if full_seconds else 0.0,
+        "label_agreement": round(agree / len(texts), 4) if texts else 1.0,
+        "changed_labels": len(texts) - agree,
+        "mean_confidence_delta": round(
+            sum(abs(ref[1] - got[1]) for ref, got in zip(reference, candidate)) / len(texts), 4
+        ) if texts else 0.0,
+    }
+    print(json.dumps(report, indent=2))
+    return 0
+
+def json_loads(data):
+    """Decode one JSON payload (str or bytes) with the fastest available codec"""
+    return _orjson.loads(data) if _orjson else json.loads(data)
+
+def json_dumps_bytes(obj):
+    """Encode one message as compact UTF-8 JSON with the fastest available codec"""
+    if _orjson:
+        return _orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def iter_payloads(stream, framing="lines", bulk=True):
+    """
+    Yield raw JSON payloads from a binary input stream. In "lines" mode,
+    `bulk` reads about READ_CHUNK_BYTES of lines per call (batch runs);
+    without it every line is yielded as soon as it arrives (serve mode).
+    """
+    import struct
+
+    if framing == "length":
+        while True:
+            header = stream.read(4)
+            if not header:
+                return
+            size = struct.unpack(">I", header)[0] if len(header) == 4 else -1
+            payload = stream.read(size) if size >= 0 else b""
+            if len(payload) != size:
+                log("Truncated frame at end of input, ignoring it")
+                return
+            yield payload
+    elif bulk:
+        for lines in _line_chunks(stream):
+            yield from lines
+    else:
+        for line in stream:
+            line = line.strip()
+            if line:
+                yield line
+
+def _line_chunks(stream):
+    """Lists of the non-blank lines in about READ_CHUNK_BYTES of input each"""
+    while True:
+        lines = stream.readlines(READ_CHUNK_BYTES)
+        if not lines:
+            return
+        yield [line for line in (line.strip() for line in lines) if line]
+
+def _decode_payload(payload):
+    """The item in one payload, or None (logged) if it is not valid JSON"""
+    try:
+        with TELEMETRY.phase("decode"):
+            return json_loads(payload)
+    except json.JSONDecodeError as e:
+        log(f"Invalid JSON line: {e}")
+        return None
+
+def iter_items(stream, framing="lines"):
+    """
+    Yield the decoded items of a binary input stream; invalid payloads are
+    logged and skipped. With orjson and "lines" framing, each bulk read of
+    lines is decoded in one call, as the elements of a JSON array; if that
+    fails or does not give exactly one object per line, the chunk's lines
+    are decoded one at a time instead. Other inputs decode per payload.
+    """
+    if framing != "lines" or not _orjson:
+        for payload in iter_payloads(stream, framing):
+            item = _decode_payload(payload)
+            if item is not None:
+                yield item
+        return
+    
+    for lines in _line_chunks(stream):
+        try:
+            with TELEMETRY.phase("decode"):
+                items = _orjson.loads(b"[" + b",".join(lines) + b"]")
+        except ValueError:
+            items = None
+        if items is not None and len(items) == len(lines) and all(isinstance(item, dict) for item in items):
+            yield from items
+            continue
+        for line in lines:
+            item = _decode_payload(line)
+            if item is not None:
+                yield item
+
+def read_batches(stream, budget, framing="lines", journal=None):
+    """
+    Yield lists of parsed input items sized by `budget` (a MemoryBudget:
+    estimated tokens and max items, re-read for every batch); invalid
+    payloads are logged and skipped, and items `journal` (a RunJournal)
+    already has a result for are answered from it instead of yielded
+    """
+    buffer = []
+    tokens = 0
+    for item in iter_items(stream, framing):
+        if journal and journal.replay(item):
+            continue
+        buffer.append(item)
+        tokens += estimate_tokens(item)
+        
+        if tokens >= budget.tokens or len(buffer) >= budget.max_items:
+            budget.batches += 1
+            budget.items += len(buffer)
+            yield buffer
+            buffer = []
+            tokens = 0
+    
+    if buffer:
+        budget.batches += 1
+        budget.items += len(buffer)
+        yield buffer
+
+def default_batch_size():
+    """
+    Items per mini-batch without --batch-size: BATCH_SIZE when stdout is a
+    regular file, else STREAM_BATCH_SIZE. Results are only written once
+    their mini-batch is done, so a caller reading a pipe (and perhaps
+    killing the run at a timeout) gets them in small steps instead of after
+    minutes of NLI on a large batch.
+    """
+    import stat
+
+    try:
+        regular = stat.S_ISREG(os.fstat(sys.stdout.fileno()).st_mode)
+    except (AttributeError, OSError, ValueError):  # Replaced or closed stdout
+        regular = False
+    return BATCH_SIZE if regular else STREAM_BATCH_SIZE
+
+def memory_budget(args):
+    """MemoryBudget selected by the command line arguments"""
+    return MemoryBudget(args.max_rss_mb, tokens=args.batch_tokens, max_items=args.batch_size or default_batch_size())
+
+class OutputWriter:
+    """
+    Buffered, framed message writer for stdout.
+
+    Messages are encoded into an in-memory buffer and written in one call
+    once OUTPUT_BUFFER_BYTES accumulate, or at the latest `flush_interval`
+    seconds after they were written (a background thread enforces the
+    deadline), so streaming consumers still see results promptly without a
+    syscall per item. A flush_interval of 0 writes every message immediately.
+    With a `journal` (RunJournal) set, messages are also appended to it.
+    """
+
+    def __init__(self, stream, framing="lines", flush_interval=FLUSH_INTERVAL, max_buffer=OUTPUT_BUFFER_BYTES):
+        import threading
+
+        self.stream = stream
+        self.framing = framing
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.lock = threading.Lock()
+        self.pending = []
+        self.pending_bytes = 0
+        self.journal = None
+        self._closed = threading.Event()
+        self._flusher = None
+        if flush_interval > 0:
+            self._flusher = threading.Thread(target=self._flush_loop, name="output-flush", daemon=True)
+            self._flusher.start()
+
+    def _frame(self, message):
+        import struct
+
+        data = json_dumps_bytes(message)
+        if self.framing == "length":
+            return struct.pack(">I", len(data)) + data
+        return data + b"\n"
+
+    def write(self, message):
+        self.write_many([message])
+
+    def write_many(self, messages, journal=True):
+        frames = [self._frame(message) for message in messages]
+        with self.lock:
+            if journal and self.journal:
+                self.journal.append(messages)
+            self.pending.extend(frames)
+            self.pending_bytes += sum(len(frame) for frame in frames)
+            if self.pending_bytes >= self.max_buffer or not self._flusher:
+                self._flush_locked()
+
+    def flush(self):
+        with self.lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        if self.pending:
+            self.stream.write(b"".join(self.pending))
+            self.pending = []
+            self.pending_bytes = 0
+        self.stream.flush()
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.flush_interval):
+            if self.pending:
+                self.flush()
+
+    def close(self):
+        self._closed.set()
+        if self._flusher:
+            self._flusher.join()
+        self.flush()
+
+class RunJournal:
+    """
+    Append-only journal of completed results in a run directory, so a run
+    cut short (e.g. killed by the caller's timeout) can be resumed without
+    redoing its work.
+
+    journal.jsonl starts with a header holding the run `settings` (rules and
+    engine fingerprints, so answers of other rules or models are never
+    replayed), then one {"key", "record"} line per result written, "key"
+    hashing the rest of what the result depends on (the item's text and
+    thread fields). Every `checkpoint_every` results the journal is fsync'd
+    and checkpoint.json is atomically replaced (temporary file, fsync,
+    rename) with the results and bytes now durable. A journal with the same
+    settings is loaded (a torn last line is cut off) and appended to; with
+    `resume`, replay() answers the items it holds at once, otherwise they
+    are classified again. A journal of other settings starts over. The
+    journal is locked while open, so concurrent runs cannot interleave
+    their lines. Several input sets may share one run directory:
+    a run that reaches the end of its input has nothing left to resume, so
+    close(finished=True) drops the entries of the items it saw and keeps
+    only other runs' unfinished ones (removing journal and checkpoint once
+    none are left), so the journal never grows across runs.
+    """
+
+    JOURNAL = "journal.jsonl"
+    CHECKPOINT = "checkpoint.json"
+
+    def __init__(self, run_dir, settings, output, resume=False, checkpoint_every=CHECKPOINT_EVERY):
+        self.run_dir = run_dir
+        self.settings = settings
+        self.output = output
+        self.checkpoint_every = max(1, checkpoint_every)
+        self.completed = {}  # id -> (key, record, output) loaded from the journal
+        self.pending = {}  # id -> key of items being classified
+        self.seen = set()  # ids of every item of this run
+        self.on_replay = None  # Called with (item, record) for each replayed item
+        self.entries = 0
+        self.replayed = 0
+        self.written = 0
+        self.since_checkpoint = 0
+
+        os.makedirs(run_dir, exist_ok=True)
+        self.resume = resume
+        self.file = self._locked(os.path.join(run_dir, self.JOURNAL))
+        # Without resume a matching journal is still kept: it may hold other
+        # input sets' unfinished entries, which close(finished=True) preserves
+        valid = self._load()
+        if valid is None:
+            self.completed = {}
+            self.file.truncate(0)
+            self.file.write(json_dumps_bytes({"journal": 1, "settings": settings}) + b"\n")
+        else:
+            self.file.truncate(valid)
+        self.entries = len(self.completed)
+        self.checkpoint()
+
+    @staticmethod
+    def _locked(path):
+        """Open `path` for appending under an exclusive lock; OSError if another run holds it"""
+        file = open(path, "a+b")
+        try:
+            import fcntl
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except ImportError:  # No advisory locks on this platform
+            pass
+        except OSError:
+            file.close()
+            raise
+        return file
+
+    def _load(self):
+        """Read the journal into `completed`; bytes of its valid prefix, or None if unusable"""
+        self.file.seek(0)
+        lines = self.file.read().split(b"\n")
+        try:
+            header = json_loads(lines[0])
+        except ValueError:
+            return None
+        if not isinstance(header, dict) or header.get("settings") != self.settings:
+            log("Run journal was written with other rules or models, starting over")
+            return None
+        valid = len(lines[0]) + 1
+        # The part after the last newline is empty, or a line torn by a crash
+        for line in lines[1:-1]:
+            try:
+                entry = json_loads(line)
+                self.completed[str(entry["record"]["id"])] = (
+                    entry["key"], entry["record"], entry.get("output", True))
+            except (ValueError, KeyError, TypeError):
+                break
+            valid += len(line) + 1
+        return valid
+
+    @staticmethod
+    def _key(item):
+        import hashlib
+
+        return hashlib.blake2b(json.dumps([item.get("text", ""), item.get("thread_id"), item.get("parent_id")])
+                               .encode("utf-8"), digest_size=8).hexdigest()
+
+    def replay(self, item):
+        """
+        Write the journalled result of `item` (unless it was journalled without
+        output) and return True if there is one for its current text; otherwise
+        return False (it is then journalled once its result is written)
+        """
+        item_id = str(item.get("id", "unknown"))
+        self.seen.add(item_id)
+        key = self._key(item)
+        done = self.completed.get(item_id) if self.resume else None
+        if done and done[0] == key:
+            if done[2]:
+                self.output.write_many([done[1]], journal=False)
+            self.replayed += 1
+            if self.on_replay:
+                self.on_replay(item, done[1])
+            return True
+        self.pending[item_id] = key
+        return False
+
+    def append(self, records, output=True):
+        """
+        Journal records of items passed to replay(); with output=False they
+        count as done on resume but are not written again (e.g. unchanged
+        items under --reclassify --changed-only)
+        """
+        lines = []
+        for record in records:
+            key = self.pending.pop(str(record.get("id")), None)
+            if key is not None:
+                lines.append(self._line(key, record, output))
+        if not lines:
+            return
+        self.file.write(b"".join(lines))
+        self.entries += len(lines)
+        self.written += len(lines)
+        self.since_checkpoint += len(lines)
+        if self.since_checkpoint >= self.checkpoint_every:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """fsync the journal, then atomically record how much of it is durable"""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        state = {
+            "settings": self.settings,
+            "results": self.entries,
+            "journal_bytes": os.fstat(self.file.fileno()).st_size,
+            "time": round(time.time(), 3),
+        }
+        path = os.path.join(self.run_dir, self.CHECKPOINT)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        # The rename itself is durable once the directory is synced
+        fd = os.open(self.run_dir, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self.since_checkpoint = 0
+
+    def close(self, finished=False):
+        """
+        Checkpoint and close; with `finished` (the run reached the end of its
+        input), first drop the entries of this run's items
+        """
+        if finished:
+            kept = [entry for item_id, entry in self.completed.items() if item_id not in self.seen]
+            if kept:
+                self._rewrite(kept)
+            else:
+                # Unlinked while still locked, so no other run picks up a half-removed journal
+                for name in (self.CHECKPOINT, self.JOURNAL):
+                    try:
+                        os.unlink(os.path.join(self.run_dir, name))
+                    except FileNotFoundError:
+                        pass
+                self.file.close()
+                return
+        self.checkpoint()
+        self.file.close()
+
+    def _rewrite(self, entries):
+        """Atomically replace the journal with the header and `entries` ((key, record, output) triples)"""
+        path = os.path.join(self.run_dir, self.JOURNAL)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        # Locked before the swap, so the journal is never unlocked on disk
+        f = self._locked(tmp_path)
+        f.truncate(0)
+        f.write(json_dumps_bytes({"journal": 1, "settings": self.settings}) + b"\n")
+        f.write(b"".join(self._line(*entry) for entry in entries))
+        f.flush()
+        os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        self.file.close()
+        self.file = f
+        self.entries = len(entries)
+
+    @staticmethod
+    def _line(key, record, output=True):
+        entry = {"key": key, "record": record}
+        if not output:
+            entry["output"] = False
+        return json_dumps_bytes(entry) + b"\n"
+
+    def summary(self):
+        return f"journal: {self.replayed} replayed, {self.written} recorded"
+
+def open_journal(args, output):
+    """
+    RunJournal for --run-dir/--resume attached to `output`, or None when not
+    asked for or unavailable (e.g. the run directory is in use by another run)
+    """
+    if not (args.run_dir or args.resume):
+        return None
+    run_dir = args.run_dir or RUN_DIR
+    settings = {
+        "rules": rules_fingerprint(),
+        "engine": None if args.patterns_only else engine_fingerprint(args),
+        "cascade": (cascade_fingerprint(args.cascade_model, args.cascade_margin)
+                    if args.cascade and not args.patterns_only else None),
+        "patterns_only": args.patterns_only,
+    }
+    try:
+        journal = RunJournal(run_dir, settings, output, resume=args.resume, checkpoint_every=args.checkpoint_every)
+    except OSError as e:
+        log(f"Run journal in {run_dir} unavailable ({e}), continuing without it")
+        return None
+    if journal.completed and args.resume:
+        log(f"Resuming: {len(journal.completed)} results journalled in {run_dir}")
+    output.journal = journal
+    return journal
+
+def premise_builder(args):
+    """PremiseBuilder selected by the command line arguments"""
+    return PremiseBuilder(
+        args.premise_strategy, max_tokens=args.premise_tokens,
+        sentences=args.premise_sentences, window=args.keyword_window,
+    )
+
+def load_nli_engine(args, intra_op_threads=None, pruner=None):
+    """
+    Load the NLI engine selected by the command line arguments. With
+    --low-memory the torch weights become bfloat16 if they passed (or now
+    pass) the accuracy check on the reference corpus. With --prune-labels
+    the engine scores label shortlists (from `pruner` when given).
+    """
+    low_memory = args.low_memory and args.backend == "torch"
+    if args.low_memory and not low_memory:
+        log("--low-memory: bfloat16 weights need the torch backend, loading the model as is")
+    key = f"{engine_fingerprint(args)}:{args.reference_corpus or 'builtin'}"
+    verdict = load_precision_checks().get(key) if low_memory else None
+    
+    def load(dtype):
+        return NLIEngine.load(
+            args.model, batch_size=args.nli_batch_size, backend=args.backend, onnx_path=args.onnx_path,
+            intra_op_threads=args.intra_op_threads if intra_op_threads is None else intra_op_threads,
+            inter_op_threads=args.inter_op_threads, premise=premise_builder(args), dtype=dtype,
+        )
+    
+    engine = load("bfloat16" if verdict and verdict["passed"] else None)
+    if low_memory and verdict is None:
+        verdict = engine.try_bfloat16(load_reference_corpus(args.reference_corpus))
+        save_precision_check(key, verdict)
+        log(f"bfloat16 accuracy check: {verdict['label_matches']}/{verdict['items']} labels kept, "
+            f"max confidence delta {verdict['max_confidence_delta']}")
+        if not verdict["passed"]:
+            # The weights were converted in place: drop them before loading
+            # float32 again, so only one copy is ever resident
+            import gc
+
+            del engine
+            gc.collect()
+            engine = load(None)
+    if low_memory and not verdict["passed"]:
+        log("--low-memory: bfloat16 changed labels on the reference corpus, keeping float32 weights")
+    if args.prune_labels:
+        engine.pruner = pruner or LabelPruner(check_rate=args.prune_check)
+    # Outputs and cache entries are keyed by the precision asked for, so a
+    # failed check only costs re-runs, never mixes float32 and bfloat16 answers
+    engine.fingerprint = engine_fingerprint(args)
+    return engine
+
+def load_knn_engine(args, intra_op_threads=None):
+    """Load the embedding kNN engine selected by the command line arguments"""
+    return KnnEngine.load(
+        args.embed_model, args.knn_index, k=args.knn_k, premise=premise_builder(args),
+        intra_op_threads=args.intra_op_threads if intra_op_threads is None else intra_op_threads,
+    )
+
+def load_engine(args, intra_op_threads=None, pruner=None):
+    """Load the engine selected by --engine for items the patterns leave"""
+    if args.engine != "nli":
+        ignored = [flag for flag, on in (("--low-memory", args.low_memory), ("--prune-labels", args.prune_labels),
+                                         ("--backend onnx", args.backend != "torch")) if on]
+        if ignored:
+            log(f"--engine {args.engine}: ignoring NLI options {', '.join(ignored)}")
+    if args.engine == "knn":
+        return load_knn_engine(args, intra_op_threads)
+    if args.engine == "distilled":
+        return DistilledEngine.load(
+            args.distilled_model, premise=premise_builder(args),
+            intra_op_threads=args.intra_op_threads if intra_op_threads is None else intra_op_threads,
+        )
+    return load_nli_engine(args, intra_op_threads, pruner)
+
+def engine_fingerprint(args):
+    """nli_fingerprint() (or the kNN/distilled one) of the engine selected by the command line arguments"""
+    if args.engine == "knn":
+        return knn_fingerprint(args.embed_model, VectorIndex(args.knn_index).version, args.knn_k,
+                               premise_builder(args))
+    if args.engine == "distilled":
+        return distilled_fingerprint(args.distilled_model, premise_builder(args))
+    precision = "bfloat16" if args.low_memory and args.backend == "torch" else None
+    return nli_fingerprint(args.model, premise_builder(args), precision, args.prune_labels)
+
+def load_precision_checks(path=None):
+    """Cached --low-memory accuracy-check verdicts: {key: report}"""
+    try:
+        with open(path or PRECISION_CHECKS_PATH, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_precision_check(key, report, path=None):
+    path = path or PRECISION_CHECKS_PATH
+    try:
+        checks = load_precision_checks(path)
+        checks[key] = report
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(checks, f, indent=2)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        log(f"Could not record the accuracy check ({e}); it runs again next time")
+
+def open_result_cache(args):
+    """ResultCache for this process, or None when disabled or unavailable"""
+    # Only NLI answers are cached: kNN answers change as the index grows, and
+    # single-pass answers cost little more to recompute than to look up
+    if args.no_cache or args.engine != "nli":
+        return None
+    settings = {"premise": premise_builder(args).settings()}
+    if args.low_memory and args.backend == "torch":
+        settings["precision"] = "bfloat16"
+    if args.prune_labels:
+        settings["pruned"] = True
+    try:
+        return ResultCache(args.cache, args.model, max_entries=args.cache_max_entries, settings=settings)
+    except Exception as e:
+        log(f"Result cache unavailable ({e}), continuing without it")
+        return None
+
+def open_cascade(engine, args):
+    """Wrap `engine` in a CascadeEngine when --cascade is set and a trained model exists"""
+    if not args.cascade:
+        return engine
+    try:
+        model = HashedLinearModel.load(args.cascade_model)
+    except Exception as e:
+        log(f"Cascade model unavailable ({e}), every item goes to NLI")
+        return engine
+    return CascadeEngine(engine, model, margin=args.cascade_margin)
+
+def load_labels(path):
+    """{id: (stage, confidence, tier)} from a previous run's JSONL output"""
+    labels = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                record = json.loads(line)
+                labels[record.get("id")] = (record.get("stage"), record.get("confidence", 0.0), record.get("tier"))
+    return labels
+
+def load_previous(path):
+    """{id: record} from a previous run's JSONL output"""
+    previous = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                record = json.loads(line)
+                previous[str(record.get("id"))] = record
+    return previous
+
+def train_cascade(args, stream):
+    """
+    Train the cascade first stage from labelled items on stdin and save it to
+    --cascade-model. Labels follow labelled_example(): a previous run's
+    pattern/NLI answers via --labels, the item's own "stage", or a confident
+    pattern match - never the first stage's own answers. A seeded 10%
+    hold-out reports the accuracy and the share of items the first stage
+    would decide at --cascade-margin. Prints a JSON report; returns the exit code.
+    """
+    import random
+
+    labels = load_labels(args.labels) if args.labels else {}
+    examples = []
+    for items in read_batches(stream, memory_budget(args)):
+        for item in items:
+            example = labelled_example(item, labels)
+            if example:
+                examples.append(example[1:3])
+    if len(examples) < 10:
+        log(f"Need at least 10 labelled items to train the cascade, got {len(examples)}")
+        return 1
+    
+    random.Random(args.seed).shuffle(examples)
+    held_out = examples[:max(1, len(examples) // 10)]
+    train = examples[len(held_out):]
+    model = HashedLinearModel().fit([t for t, _ in train], [s for _, s in train], seed=args.seed)
+    
+    predictions = model.predict([t for t, _ in held_out])
+    decided = [(p[0], stage) for p, (_, stage) in zip(predictions, held_out) if p[2] >= args.cascade_margin]
+    model.save(args.cascade_model)
+    report = {
+        "model": args.cascade_model,
+        "train_items": len(train),
+        "held_out_items": len(held_out),
+        "held_out_accuracy": round(sum(p[0] == stage for p, (_, stage) in zip(predictions, held_out)) / len(held_out), 4),
+        "margin": args.cascade_margin,
+        "decided_share": round(len(decided) / len(held_out), 4),
+        "decided_accuracy": round(sum(got == stage for got, stage in decided) / len(decided), 4) if decided else None,
+    }
+    print(json.dumps(report, indent=2))
+    return 0
+
+def load_golden_set(path):
+    """
+    (id, text, stage) for the items of a golden-set file (see
+    server/inference/golden-set.js) whose trueType is a stage
+    """
+    with open(path, encoding="utf-8") as f:
+        items = json.load(f).get("items", [])
+    return [
+        (f"golden:{item['id']}", f"{item.get('subject') or ''}\n{item.get('body') or ''}".strip(), item["trueType"])
+        for item in items if item.get("trueType") in ALLOWED_STAGES
+    ]
+
+def labelled_example(item, labels):
+    """
+    (id, text, stage, source) for an input item with a usable label, else
+    None. The label is by id a previous run's answer from `labels` (source
+    "labels"), else the item's own "stage" ("stage"), else the pattern
+    rules' ("pattern"). Only the tiers in LABEL_TIER_FLOORS are used, at or
+    above their floor (and never a failed item's 0.0).
+    """
+    text = item_text(item)
+    if not text:
+        return None
+    if item.get("id") in labels:
+        source = "labels"
+        stage, confidence, tier = labels[item.get("id")]
+    else:
+        source = "stage"
+        stage, confidence, tier = item.get("stage"), item.get("confidence", 1.0), item.get("tier")
+    if stage is None:
+        source = "pattern"
+        stage, confidence = quick_classify(text) or (None, 0.0)
+        tier = "pattern"
+    if stage not in ALLOWED_STAGES or tier not in LABEL_TIER_FLOORS:
+        return None
+    if confidence <= 0 or confidence < LABEL_TIER_FLOORS[tier]:
+        return None
+    return str(item.get("id")), text, stage, source
+
+def build_knn_index(args, stream):
+    """
+    Add labelled examples to the kNN index at --knn-index (created on first
+    use), embedded with --embed-model: the items on stdin with a label (see
+    labelled_example()) and golden-set items (--golden-set). Ids already in
+    the index are not embedded again, so re-running on a growing corpus only
+    pays for the new examples. Prints a JSON report; returns the exit code.
+    """
+    from collections import Counter
+
+    labels = load_labels(args.labels) if args.labels else {}
+    index = VectorIndex(args.knn_index, args.embed_model)
+    known = index.known_ids()
+    encoder = EmbeddingEncoder.load(args.embed_model, intra_op_threads=args.intra_op_threads)
+    premise = premise_builder(args)
+    counts = Counter()
+    added = Counter()
+
+    def add(examples):
+        fresh = [example for example in examples if example[0] not in known]
+        counts["known"] += len(examples) - len(fresh)
+        if fresh:
+            vectors = encoder.encode([premise.build(text) for _, text, _ in fresh])
+            # Also adds the fresh ids to `known`, the index's own set
+            index.add([item_id for item_id, _, _ in fresh], vectors, [stage for _, _, stage in fresh])
+            added.update(stage for _, _, stage in fresh)
+
+    if args.golden_set:
+        golden = load_golden_set(args.golden_set)
+        counts["golden"] = len(golden)
+        add(golden)
+    for items in read_batches(stream, memory_budget(args)):
+        examples = []
+        for item in items:
+            example = labelled_example(item, labels)
+            if example:
+                examples.append(example[:3])
+            else:
+                counts["unlabelled"] += 1
+        add(examples)
+
+    report = {
+        "index": args.knn_index,
+        "model": args.embed_model,
+        "added": sum(added.values()),
+        "added_by_stage": dict(sorted(added.items())),
+        "already_indexed": counts["known"],
+        "golden_items": counts["golden"],
+        "skipped_unlabelled": counts["unlabelled"],
+        "rows": index.count,
+        "version": index.version,
+    }
+    print(json.dumps(report, indent=2))
+    return 0
+
+def train_distilled(args, stream):
+    """
+    Train the single-pass classifier and save it to --distilled-model: a
+    DistilledHead over --embed-model embeddings of the labelled items on
+    stdin (see labelled_example() - their own stages, a previous run's
+    pattern/NLI answers via --labels, confident pattern matches) and of
+    golden-set items (--golden-set). A seeded 10% hold-out is kept out of
+    training and classified by both the distilled model and zero-shot
+    --model, for accuracy (overall and per label source) and items/sec.
+    Prints a JSON report; returns the exit code.
+    """
+    import random
+
+    labels = load_labels(args.labels) if args.labels else {}
+    examples = []
+    if args.golden_set:
+        examples.extend((item_id, text, stage, "golden") for item_id, text, stage in load_golden_set(args.golden_set))
+    for items in read_batches(stream, memory_budget(args)):
+        for item in items:
+            example = labelled_example(item, labels)
+            if example:
+                examples.append(example)
+    if len(examples) < 10:
+        log(f"Need at least 10 labelled items to train the distilled model, got {len(examples)}")
+        return 1
+
+    random.Random(args.seed).shuffle(examples)
+    held_out = examples[:max(1, len(examples) // 10)]
+    train = examples[len(held_out):]
+    premise = premise_builder(args)
+    encoder = EmbeddingEncoder.load(args.embed_model, intra_op_threads=args.intra_op_threads)
+    start = time.perf_counter()
+    vectors = encoder.encode([premise.build(text) for _, text, _, _ in train])
+    head = DistilledHead.fit(args.embed_model, vectors, [stage for _, _, stage, _ in train])
+    train_seconds = time.perf_counter() - start
+    head.save(args.distilled_model)
+
+    engines = {"distilled": DistilledEngine(encoder, head, premise)}
+    try:
+        engines["zero_shot"] = load_nli_engine(args)
+    except Exception as e:
+        log(f"Zero-shot model unavailable ({e}), evaluating the distilled model only")
+    texts = [text for _, text, _, _ in held_out]
+    evaluation = {}
+    predictions = {}
+    for name, engine in engines.items():
+        engine.warm_up()
+        start = time.perf_counter()
+        predictions[name] = [result[0] for result in engine.classify(texts)]
+        seconds = time.perf_counter() - start
+        by_source = {}
+        for got, (_, _, stage, source) in zip(predictions[name], held_out):
+            hits, total = by_source.get(source, (0, 0))
+            by_source[source] = (hits + (got == stage), total + 1)
+        evaluation[name] = {
+            "accuracy": round(sum(hits for hits, _ in by_source.values()) / len(held_out), 4),
+            "accuracy_by_source": {source: round(hits / total, 4) for source, (hits, total) in sorted(by_source.items())},
+            "items_per_sec": round(len(texts) / seconds, 1),
+        }
+    if len(predictions) == 2:
+        evaluation["agreement"] = round(
+            sum(a == b for a, b in zip(predictions["distilled"], predictions["zero_shot"])) / len(held_out), 4)
+        evaluation["speedup"] = round(evaluation["distilled"]["items_per_sec"] / evaluation["zero_shot"]["items_per_sec"], 2)
+
+    sources = {}
+    for _, _, _, source in examples:
+        sources[source] = sources.get(source, 0) + 1
+    report = {
+        "model": args.distilled_model,
+        "embed_model": args.embed_model,
+        "train_items": len(train),
+        "held_out_items": len(held_out),
+        "items_by_source": dict(sorted(sources.items())),
+        "train_seconds": round(train_seconds, 3),
+        "held_out": evaluation,
+    }
+    print(json.dumps(report, indent=2))
+    return 0
+
+# Engine loaded by the parent before forking workers; children inherit it
+# copy-on-write instead of each loading their own copy
+_FORK_ENGINE = None
+
+def _limit_threads(engine, threads):
+    """Keep a worker's torch engine to its share of the CPUs; returns the engine"""
+    backend = getattr(engine, "backend", None)
+    if backend is not None and backend.name == "torch":
+        import torch
+        torch.set_num_threads(threads)
+    return engine
+
+def _worker_main(worker_id, args, threads, tasks, results):
+    """
+    Worker process: classify (seq, items) chunks from `tasks` until None.
+    Without an engine shared by the parent, the worker loads its own on the
+    first item that needs it (never, if patterns, cache and cascade answer all).
+    """
+    global CANONICALIZE
+
+    # main() sets these from the flags, but only forked workers inherit them
+    CANONICALIZE = not args.no_canonicalize
+    if args.telemetry and not TELEMETRY.enabled:
+        TELEMETRY.enable(args.telemetry_interval)
+    
+    pruner = None
+    if _FORK_ENGINE is not None:
+        engine = _limit_threads(_FORK_ENGINE, threads)
+        pruner = getattr(engine, "pruner", None)
+    else:
+        if args.prune_labels and args.engine == "nli":
+            pruner = LabelPruner(check_rate=args.prune_check)
+        engine = LazyEngine(lambda: _limit_threads(load_engine(args, intra_op_threads=threads, pruner=pruner), threads),
+                            premise_builder(args), engine_fingerprint(args))
+    
+    # SQLite connections must not cross fork(), so each worker opens its own
+    cache = open_result_cache(args)
+    if cache:
+        engine = CachedEngine(engine, cache)
+    engine = open_cascade(engine, args)
+    cascade = engine if isinstance(engine, CascadeEngine) else None
+    engine = DedupEngine(engine)
+    
+    # Each worker keeps to its share of --max-rss-mb
+    budget = MemoryBudget(args.max_rss_mb and args.max_rss_mb / args.workers)
+    counts = {"pattern": 0, "nli": 0}
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        seq, items = task
+        results.put(("chunk", seq, classify_items(engine, items, counts)))
+        budget.check()
+        TELEMETRY.maybe_emit(worker=worker_id)
+    
+    stats = dict(counts, hits=cache.hits if cache else 0, misses=cache.misses if cache else 0,
+                 linear=cascade.decided if cascade else 0, escalated=cascade.escalated if cascade else 0,
+                 dedup_items=engine.items, dedup_shared=engine.duplicates, memory=memory_report())
+    for key in ("items", "hypotheses", "checked", "mismatches"):
+        stats[f"prune_{key}"] = getattr(pruner, key, 0)
+    if cache:
+        cache.close()
+    TELEMETRY.emit("telemetry_final", worker=worker_id)
+    results.put(("done", worker_id, stats))
+
+def run_workers(args, stream):
+    """
+    Sharded classification across `args.workers` processes.
+
+    Input is read in token-sized chunks (--batch-tokens, at most
+    --batch-size items) and handed to workers over
+    a bounded queue (so memory stays flat however large the input is).
+    Output records stream back on stdout as chunks complete; with
+    --preserve-order they are held back until all earlier chunks are out.
+    With --share-model or --low-memory (torch backend, or a kNN/distilled
+    engine) on platforms that support fork(), the model is loaded once here
+    and shared copy-on-write with the workers; otherwise each worker loads
+    its own, lazily, on its first item that needs it. Each worker limits its
+    own thread count. If a
+    worker dies, the results that were completed are still written and a
+    RuntimeError is raised at the end; when no worker is left, reading stops.
+    """
+    import gc
+    import multiprocessing
+    import queue
+    import threading
+
+    global _FORK_ENGINE
+
+    workers = args.workers
+    threads = args.threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+    use_fork = "fork" in multiprocessing.get_all_start_methods()
+    ctx = multiprocessing.get_context("fork" if use_fork else None)
+    
+    share = (args.share_model or args.low_memory) and (args.backend == "torch" or args.engine != "nli")
+    if share and not use_fork:
+        log("--share-model: needs fork(), each worker loads its own model")
+    if share and use_fork:
+        log("Loading classification model once for all workers...")
+        with TELEMETRY.phase("model_load"):
+            _FORK_ENGINE = load_engine(args)
+        # Keep the collector from writing to the model's objects in the
+        # children, which would copy their pages out of the shared mapping
+        gc.collect()
+        gc.freeze()
+    
+    tasks = ctx.Queue(maxsize=workers * 2)
+    results = ctx.Queue()
+    procs = [
+        ctx.Process(target=_worker_main, args=(i, args, threads, tasks, results), daemon=True)
+        for i in range(workers)
+    ]
+    started = list(procs)  # `procs` loses workers as the writer finds them dead
+    for proc in procs:
+        proc.start()
+    log(f"Started {workers} workers ({threads} threads each). Processing JSONL input from stdin...")
+    
+    totals = {"processed": 0, "pattern": 0, "nli": 0, "hits": 0, "misses": 0, "linear": 0, "escalated": 0,
+              "dedup_items": 0, "dedup_shared": 0, "prune_items": 0, "prune_hypotheses": 0, "prune_checked": 0,
+              "prune_mismatches": 0}
+    memory = {}  # worker id -> memory_report() at exit
+    died = []
+    
+    def write_results():
+        held = {}
+        next_seq = 0
+        finished = 0
+        while finished < workers:
+            try:
+                message = results.get(timeout=1.0)
+            except queue.Empty:
+                dead = [p for p in procs if p.exitcode not in (None, 0)]
+                if dead:
+                    log(f"{len(dead)} worker(s) died; results of their in-flight chunks are lost")
+                    died.extend(dead)
+                    finished += len(dead)
+                    for proc in dead:
+                        procs.remove(proc)
+                continue
+            
+            if message[0] == "done":
+                finished += 1
+                memory[message[1]] = message[2]["memory"]
+                for key in totals:
+                    if key == "processed":
+                        continue
+                    totals[key] += message[2][key]
+                continue
+            
+            _, seq, records = message
+            if args.preserve_order:
+                held[seq] = records
+                ready = []
+                while next_seq in held:
+                    ready.extend(held.pop(next_seq))
+                    next_seq += 1
+            else:
+                ready = records
+            with TELEMETRY.phase("output"):
+                output.write_many(ready)
+            for record in ready:
+                totals["processed"] += 1
+                if totals["processed"] % 50 == 0:
+                    log(f"Processed {totals['processed']} items...")
+        
+        # Chunks after a dead worker's gap can no longer be ordered - flush them
+        for seq in sorted(held):
+            output.write_many(held[seq])
+            totals["processed"] += len(held[seq])
+        output.close()
+    
+    output = OutputWriter(sys.stdout.buffer, args.framing, args.flush_interval)
+    journal = open_journal(args, output)
+    writer = threading.Thread(target=write_results, name="writer")
+    writer.start()
+    
+    def put(task):
+        """Queue a task; False once no worker is alive to take it"""
+        while True:
+            try:
+                tasks.put(task, timeout=1.0)
+                return True
+            except queue.Full:
+                if not any(proc.is_alive() for proc in started):
+                    return False
+    
+    for seq, items in enumerate(read_batches(stream, memory_budget(args), args.framing, journal)):
+        if not put((seq, items)):
+            log("No workers left; stopping input")
+            break
+    for _ in started:
+        if not put(None):
+            break
+    
+    writer.join()
+    if not any(proc.is_alive() for proc in started):
+        # Tasks nobody will read must not hold up interpreter exit
+        tasks.cancel_join_thread()
+    for proc in started:
+        proc.join()
+    if journal:
+        journal.close(finished=not died)
+    if died:
+        raise RuntimeError(f"{len(died)} of {workers} workers exited with an error")
+    
+    summary = f"pattern: {totals['pattern']}, NLI: {totals['nli']}"
+    if not args.no_cache:
+        summary += f", cache hits: {totals['hits']}, misses: {totals['misses']}"
+    if args.cascade:
+        summary += f", cascade linear: {totals['linear']}, escalated: {totals['escalated']}"
+    summary += f", dedup: {totals['dedup_shared']}/{totals['dedup_items']} NLI texts shared"
+    if journal:
+        summary += f", {journal.summary()}"
+    if args.prune_labels:
+        average = totals["prune_hypotheses"] / totals["prune_items"] if totals["prune_items"] else 0.0
+        summary += f", pruning: {average:.2f} hypotheses/item (of {len(ALLOWED_STAGES)})"
+        if args.prune_check:
+            summary += f", {totals['prune_checked']} checked, {totals['prune_mismatches']} argmax changes"
+    log(f"Inference complete. Processed {totals['processed']} items with {workers} workers ({summary}).")
+    log(f"Memory: parent {memory_summary(memory_report())}")
+    for worker_id in sorted(memory):
+        log(f"Memory: worker {worker_id} {memory_summary(memory[worker_id])}")
+    TELEMETRY.emit("telemetry_final", processed=totals["processed"], workers=workers)
+
+def parse_args(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Governance stage classification engine (JSONL stdin -> stdout)")
+    parser.add_argument("--model", default=MODEL_ID,
+                        help=f"Hub name or local path of the NLI model (default: {MODEL_ID})")
+    parser.add_argument("--prepare-model", action="store_true",
+                        help=f"Write a pinned local snapshot of --model (--embed-model with --engine knn/distilled) "
+                             f"under {MODEL_STORE_DIR} and exit")
+    parser.add_argument("--revision", default=None,
+                        help="Hub revision (branch, tag or commit) to pin with --prepare-model (default: main)")
+    parser.add_argument("--batch-size", type=int, default=None,
+                        help=f"Max items per mini-batch. Results are written once their mini-batch is done, so "
+                             f"larger batches trade latency (and work lost to a kill) for throughput "
+                             f"(default: {BATCH_SIZE} writing to a file, {STREAM_BATCH_SIZE} to a pipe)")
+    parser.add_argument("--batch-tokens", type=int, default=BATCH_TOKENS,
+                        help=f"Estimated tokens per mini-batch; lowered automatically near --max-rss-mb (default: {BATCH_TOKENS})")
+    parser.add_argument("--max-rss-mb", type=float, default=None,
+                        help="Memory budget: shrink batches and collect garbage when RSS nears it (default: none)")
+    parser.add_argument("--nli-batch-size", type=int, default=NLI_BATCH_SIZE,
+                        help=f"Premise/hypothesis pairs per forward pass (default: {NLI_BATCH_SIZE})")
+    parser.add_argument("--backend", choices=["torch", "onnx"], default="torch",
+                        help="NLI execution backend (default: torch)")
+    parser.add_argument("--onnx-path", default=None,
+                        help=f"Exported ONNX model file; created on first use (default: under {ONNX_DIR})")
+    parser.add_argument("--intra-op-threads", type=int, default=0,
+                        help="Threads used inside one operator (0 = runtime default)")
+    parser.add_argument("--inter-op-threads", type=int, default=0,
+                        help="ONNX Runtime threads across independent operators (0 = runtime default)")
+    parser.add_argument("--low-memory", action="store_true",
+                        help="bfloat16 torch weights when they pass an accuracy check on --reference-corpus "
+                             "(verdict cached per model), reported per-process memory")
+    parser.add_argument("--verify-backend", action="store_true",
+                        help="Compare ONNX against PyTorch labels on a reference corpus and exit")
+    parser.add_argument("--reference-corpus", default=None,
+                        help="JSONL file of {\"text\": ...} for --verify-backend and the --low-memory check (default: built-in corpus)")
+    parser.add_argument("--premise-strategy", choices=PREMISE_STRATEGIES, default="full",
+                        help="Part of each post used as the NLI premise (default: full)")
+    parser.add_argument("--premise-tokens", type=int, default=None,
+                        help=f"Cap premises at N tokens (default: {PREMISE_TOKENS} for 'budget', otherwise model limit)")
+    parser.add_argument("--premise-sentences", type=int, default=PREMISE_SENTENCES,
+                        help=f"Body sentences kept by 'sentences'/'keywords' (default: {PREMISE_SENTENCES})")
+    parser.add_argument("--keyword-window", type=int, default=PREMISE_KEYWORD_WINDOW,
+                        help=f"Words kept either side of a keyword by 'keywords' (default: {PREMISE_KEYWORD_WINDOW})")
+    parser.add_argument("--measure-premise", action="store_true",
+                        help="Compare the premise strategy against full premises on stdin and exit")
+    parser.add_argument("--prune-labels", action="store_true",
+                        help="Score each NLI item only on the label families its keywords point to, plus 'other'")
+    parser.add_argument("--prune-check", type=float, nargs="?", const=PRUNE_CHECK_RATE, default=0.0, metavar="RATE",
+                        help=f"With --prune-labels, also score a sample of items on every label and count argmax "
+                             f"changes (default rate: {PRUNE_CHECK_RATE})")
+    parser.add_argument("--cascade", action="store_true",
+                        help="Answer confident items with the cheap first-stage model, escalate the rest to NLI")
+    parser.add_argument("--cascade-model", default=CASCADE_MODEL_PATH,
+                        help=f"Trained first-stage model file (default: {CASCADE_MODEL_PATH})")
+    parser.add_argument("--cascade-margin", type=float, default=CASCADE_MARGIN,
+                        help=f"Escalate to NLI below this top-1/top-2 probability margin (default: {CASCADE_MARGIN})")
+    parser.add_argument("--train-cascade", action="store_true",
+                        help="Train the first-stage model from labelled JSONL on stdin and exit")
+    parser.add_argument("--engine", choices=["nli", "knn", "distilled"], default="nli",
+                        help="Engine for items the patterns leave: zero-shot NLI, a nearest-neighbour vote "
+                             "over --knn-index, or the --distilled-model classifier (default: nli)")
+    parser.add_argument("--embed-model", default=EMBED_MODEL_ID,
+                        help=f"Hub name or local path of the sentence-embedding model for --engine knn (default: {EMBED_MODEL_ID})")
+    parser.add_argument("--knn-index", default=KNN_INDEX_DIR,
+                        help=f"Labelled example index directory for --engine knn (default: {KNN_INDEX_DIR})")
+    parser.add_argument("--knn-k", type=int, default=KNN_NEIGHBOURS,
+                        help=f"Neighbours voting per item (default: {KNN_NEIGHBOURS})")
+    parser.add_argument("--build-index", action="store_true",
+                        help="Add labelled items on stdin (and --golden-set) to --knn-index and exit; "
+                             "ids already indexed are skipped")
+    parser.add_argument("--distilled-model", default=DISTILLED_MODEL_PATH,
+                        help=f"Trained single-pass classifier for --engine distilled (default: {DISTILLED_MODEL_PATH})")
+    parser.add_argument("--train-distilled", action="store_true",
+                        help="Train --distilled-model over --embed-model from labelled JSONL on stdin (and "
+                             "--golden-set), compare it with zero-shot --model on a hold-out and exit")
+    parser.add_argument("--golden-set", nargs="?", const=GOLDEN_SET_PATH, default=None, metavar="PATH",
+                        help=f"With --build-index/--train-distilled, also use golden-set items (default path: {GOLDEN_SET_PATH})")
+    parser.add_argument("--labels", default=None,
+                        help="Previous run's output JSONL supplying --train-cascade/--build-index/--train-distilled "
+                             "labels by id")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Random seed for training and hold-out splits (default: 0)")
+    parser.add_argument("--telemetry", action="store_true",
+                        help="Emit JSON telemetry (phase timings, latency histograms, rule hits, RSS) on stderr")
+    parser.add_argument("--telemetry-interval", type=float, default=TELEMETRY_INTERVAL,
+                        help=f"Seconds between periodic telemetry reports; 0 = only at exit (default: {TELEMETRY_INTERVAL:g})")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Classify in N worker processes (default: 1, in-process)")
+    parser.add_argument("--threads-per-worker", type=int, default=0,
+                        help="Torch/ORT threads per worker (default: CPU count / workers)")
+    parser.add_argument("--share-model", action="store_true",
+                        help="With --workers, load the model once before forking and share it copy-on-write "
+                             "(implied by --low-memory); otherwise each worker loads its own when first needed")
+    parser.add_argument("--preserve-order", action="store_true",
+                        help="With --workers, emit results in input order")
+    parser.add_argument("--framing", choices=FRAMINGS, default="lines",
+                        help="stdin/stdout message framing: JSONL lines or 4-byte length-prefixed JSON (default: lines)")
+    parser.add_argument("--flush-interval", type=float, default=FLUSH_INTERVAL,
+                        help=f"Max seconds a result may sit in the output buffer; 0 = flush every item (default: {FLUSH_INTERVAL})")
+    parser.add_argument("--no-canonicalize", action="store_true",
+                        help="Share NLI answers only between identical texts (no reply-prefix stripping or Unicode/whitespace normalization)")
+    parser.add_argument("--ignore-threads", action="store_true",
+                        help="Classify every item on its own, ignoring thread_id/parent_id "
+                             "(always the case with --pipeline, --workers and --serve)")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Overlap input parsing, patterns and tokenization with model execution in separate threads")
+    parser.add_argument("--pipeline-depth", type=int, default=PIPELINE_DEPTH,
+                        help=f"Mini-batches queued between pipeline stages (default: {PIPELINE_DEPTH})")
+    parser.add_argument("--reclassify", default=None, metavar="PREVIOUS",
+                        help="Previous output JSONL for the corpus on stdin: re-run only items the current "
+                             "rules/model could change, copy the rest")
+    parser.add_argument("--changed-only", action="store_true",
+                        help="With --reclassify, output only records whose stage or confidence changed")
+    parser.add_argument("--run-dir", default=None,
+                        help=f"Journal results to DIR (fsync'd checkpoint every --checkpoint-every results) so the run "
+                             f"can be resumed (default with --resume: {RUN_DIR})")
+    parser.add_argument("--resume", action="store_true",
+                        help="Answer items already journalled in the run directory from it and classify only the rest")
+    parser.add_argument("--checkpoint-every", type=int, default=CHECKPOINT_EVERY,
+                        help=f"Results between journal checkpoints (default: {CHECKPOINT_EVERY})")
+    parser.add_argument("--patterns-only", action="store_true",
+                        help="Pattern pass only, never loads the model: unmatched items are output with needs_nli")
+    parser.add_argument("--serve", action="store_true",
+                        help="Run as a long-lived server (request-id multiplexed JSONL on stdin/stdout)")
+    parser.add_argument("--cache", default=CACHE_PATH,
+                        help=f"NLI result cache file (default: {CACHE_PATH})")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Disable the persistent NLI result cache")
+    parser.add_argument("--cache-max-entries", type=int, default=CACHE_MAX_ENTRIES,
+                        help=f"Evict least recently used cache entries beyond this count (default: {CACHE_MAX_ENTRIES})")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    global CANONICALIZE
+    
+    args = parse_args(argv)
+    if args.telemetry:
+        TELEMETRY.enable(args.telemetry_interval)
+    CANONICALIZE = not args.no_canonicalize
+    
+    # Memory optimization settings
+    os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'max_split_size_mb:128')
+    # Hub downloads persist under the data dir (not /tmp, which reboots clear)
+    os.environ.setdefault('HF_HOME', os.path.join(BASE_DATA_DIR, 'cache', 'huggingface'))
+    
+    if args.prepare_model:
+        sys.exit(prepare_model(args))
+    
+    if args.verify_backend:
+        sys.exit(verify_backends(args))
+    
+    if args.measure_premise:
+        sys.exit(measure_premise(args, sys.stdin.buffer))
+    
+    if args.train_cascade:
+        sys.exit(train_cascade(args, sys.stdin.buffer))
+    
+    if args.build_index:
+        sys.exit(build_knn_index(args, sys.stdin.buffer))
+    
+    if args.train_distilled:
+        sys.exit(train_distilled(args, sys.stdin.buffer))
+    
+    if args.workers > 1 and not (args.serve or args.patterns_only or args.reclassify):
+        try:
+            run_workers(args, sys.stdin.buffer)
+        except Exception as e:
+            log(f"Error running workers: {e}")
+            sys.exit(1)
+        return
+    
+    # The model is loaded on the first item that needs NLI (or up front by
+    # --serve's warm-up). Using DistilBERT-MNLI for memory efficiency
+    # (~250MB vs ~1.6GB), on CPU for determinism
+    cache = None
+    pruner = None
+    if args.prune_labels and args.engine == "nli" and not args.patterns_only:
+        pruner = LabelPruner(check_rate=args.prune_check)
+    if args.patterns_only:
+        if args.cascade:
+            log("--patterns-only: ignoring --cascade (unmatched items are output with needs_nli)")
+        engine = PendingEngine(premise_builder(args))
+    else:
+        engine = LazyEngine(lambda: load_engine(args, pruner=pruner), premise_builder(args), engine_fingerprint(args))
+        cache = open_result_cache(args)
+        if cache:
+            engine = CachedEngine(engine, cache)
+        engine = open_cascade(engine, args)
+    cascade = engine if isinstance(engine, CascadeEngine) else None
+    engine = DedupEngine(engine)
+    
+    if args.serve:
+        if args.run_dir or args.resume:
+            log("--serve: ignoring --run-dir/--resume (requests are answered as they arrive)")
+        log(f"Loading NLI classification model ({args.backend} backend)...")
+        InferenceServer(engine, framing=args.framing, budget=memory_budget(args)).serve(sys.stdin.buffer)
+        if cache:
+            log(f"Result {cache.summary()}")
+            cache.close()
+        return
+    
+    log("Processing JSONL input from stdin...")
+    
+    processed = 0
+    counts = {"pattern": 0, "nli": 0}
+    
+    output = OutputWriter(sys.stdout.buffer, args.framing, args.flush_interval)
+    journal = open_journal(args, output)
+    budget = memory_budget(args)
+    threads = None
+    reclassifier = None
+    finished = False
+    
+    try:
+        if args.reclassify:
+            reclassifier = Reclassifier(engine, load_previous(args.reclassify), counts)
+            for items in read_batches(sys.stdin.buffer, budget, args.framing, journal):
+                records, changed = reclassifier.classify(items)
+                with TELEMETRY.phase("output"):
+                    output.write_many(changed if args.changed_only else records)
+                    if args.changed_only and journal:
+                        # Unchanged items are done too: journal them, or a resumed run re-reads them forever
+                        written = {id(record) for record in changed}
+                        with output.lock:
+                            journal.append([r for r in records if id(r) not in written], output=False)
+                processed += len(records)
+                budget.check()
+                TELEMETRY.maybe_emit()
+        elif args.pipeline:
+            processed = run_pipeline(engine, sys.stdin.buffer, output, counts, args, budget, journal)
+        else:
+            threads = None if args.ignore_threads else ThreadPropagator(engine, counts)
+            if threads and journal:
+                journal.on_replay = lambda item, record: output.write_many(threads.replayed(item, record))
+            
+            # Process in token-sized mini-batches within the memory budget
+            for items in read_batches(sys.stdin.buffer, budget, args.framing, journal):
+                # Pattern pass first; everything else is classified in one NLI batch
+                records = threads.classify(items) if threads else classify_items(engine, items, counts)
+                with TELEMETRY.phase("output"):
+                    output.write_many(records)
+                for record in records:
+                    processed += 1
+                    if processed % 50 == 0:
+                        log(f"Processed {processed} items...")
+                
+                budget.check()
+                TELEMETRY.maybe_emit()
+            
+            if threads:
+                records = threads.flush()
+                output.write_many(records)
+                processed += len(records)
+        finished = True
+    finally:
+        # Results already classified are written (and journalled) even if the run aborts
+        output.close()
+        if journal:
+            journal.close(finished=finished)
     
-    log(f"Inference complete. Processed {processed} items (pattern: {pattern_hits}, NLI: {nli_hits}).")
+    summary = f"pattern: {counts['pattern']}, NLI: {counts['nli']}"
+    if args.patterns_only:
+        summary += f", needs NLI: {counts.get('needs_nli', 0)}"
+    if cache:
+        summary += f", {cache.summary()}"
+        cache.close()
+    if cascade:
+        summary += f", {cascade.summary()}"
+    if threads:
+        summary += f", {threads.summary()}"
+    if reclassifier:
+        summary += f", {reclassifier.summary()}"
+    if pruner:
+        summary += f", {pruner.summary()}"
+    if journal:
+        summary += f", {journal.summary()}"
+    summary += f", {engine.summary()}, {budget.summary()}"
+    log(f"Inference complete. Processed {processed} items ({summary}).")
+    log(f"Memory: {memory_summary(memory_report())}")
+    TELEMETRY.emit("telemetry_final")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,1321 @@
+"""
+Tests for the governance stage classification engine (infer_stage.py)
+
+Run with: python -m pytest scripts/ingest/test/test_infer_stage.py
+
+Engine tests build a tiny randomly initialised DistilBERT NLI model on the
+fly, so they need torch + transformers but no network access.
+"""
+
+import itertools
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+import pytest
+
+INGEST_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(INGEST_DIR, "infer_stage.py")
+
+sys.path.insert(0, INGEST_DIR)
+
+import infer_stage  # noqa: E402
+
+SAMPLE_TEXTS = [
+    "CIP-0042 discussion about fees",
+    "General governance topic for the forum",
+    "Thread on validator weight for a featured app",
+    "a" * 40,
+    "super validator post on the tokenomics of the network " * 20,
+]
+
+
+# One subject per PATTERN_RULES entry, in rule order, that matches that rule
+RULE_EXAMPLES = [
+    "Validator Operators Approved",
+    "Validators approved for Q3",
+    "Operator approved",
+    "Featured Apps Approved",
+    "Tokenomics Outcomes - March",
+    "Outcome of the tokenomics call",
+    "Weight change for node X",
+    "Reward allocation approved",
+    "New Featured App Request: Foo",
+    "Featured App Request - Bar",
+    "Featured app Baz - discuss",
+    "New Validator Request from Acme",
+    "Validator Operator Request",
+    "Validator application: Acme",
+    "Weight increase request",
+    "Setting weights on the new SVs",
+    "Approved by SV owners",
+    "SV rights owners have approved it",
+    "CIP-0042 approved",
+    "CIP Announcement",
+    "CIP-0043 final announcement",
+    "Vote proposal to add 2 weight",
+    "Vote Proposal: onboarding",
+    "CIP-0044: Vote",
+    "CIP vote on fees",
+    "Voting on CIP 45",
+    "CIP 0046 reminder to vote now",
+    "CIP-Discuss: new idea",
+    "CIP discussion thread",
+    "Draft CIP for fees",
+    "CIP-TBD fees",
+    "CIP-00XX fees",
+    "CIP-XXXX fees",
+    "CIP - 0037: Fees",
+    "SV Announcement: maintenance",
+    "Super Validator node announced",
+    "Add 1 weight to GSF SV",
+    "SV weight assignment",
+]
+
+NOISE = ["", "hello world", "Re: ", "lorem ipsum dolor sit amet " * 40, "\n\nBody text follows.\n"]
+
+
+def sequential_quick_classify(text):
+    """Reference: the original ordered re.search loop, subject rules on the first line"""
+    text_lower = text.lower()
+    for pattern, stage, confidence, *scope in infer_stage.PATTERN_RULES:
+        if re.search(pattern, text_lower.split("\n", 1)[0] if scope == ["subject"] else text_lower):
+            return (stage, confidence)
+    return None
+
+
+def test_rule_examples_cover_every_rule():
+    assert len(RULE_EXAMPLES) == len(infer_stage.PATTERN_RULES)
+    for example, (pattern, *_) in zip(RULE_EXAMPLES, infer_stage.PATTERN_RULES):
+        assert re.search(pattern, example.lower()), (pattern, example)
+
+
+@pytest.mark.parametrize("example", RULE_EXAMPLES)
+def test_pattern_engine_matches_sequential_rules(example):
+    for prefix, suffix in itertools.product(NOISE, repeat=2):
+        text = prefix + example + suffix
+        assert infer_stage.quick_classify(text) == sequential_quick_classify(text)
+
+
+def test_pattern_engine_priority_across_rule_pairs():
+    # A lower-priority match early in the text must not hide a
+    # higher-priority match later on (and vice versa)
+    texts = [a + " / " + b for a, b in itertools.permutations(RULE_EXAMPLES, 2)]
+    expected = [sequential_quick_classify(text) for text in texts]
+    assert infer_stage.classify_many(texts) == expected
+
+
+def test_pattern_engine_no_match():
+    assert infer_stage.quick_classify("General question about node uptime") is None
+    assert infer_stage.classify_many([]) == []
+
+
+def test_pattern_rule_scopes():
+    body = "Weekly sync notes\n" + "x" * 200 + " vote proposal"
+    rules = [(r"vote\s+proposal", "cip-vote", 0.95, "subject")]
+    assert infer_stage.PatternEngine(rules).classify(body) is None
+    assert infer_stage.PatternEngine(rules).classify("Vote Proposal\nbody") == ("cip-vote", 0.95)
+    assert infer_stage.PatternEngine([(r"vote\s+proposal", "cip-vote", 0.95, 100)]).classify(body) is None
+    assert infer_stage.PatternEngine([(r"vote\s+proposal", "cip-vote", 0.95, 300)]).classify(body) == ("cip-vote", 0.95)
+
+    # Without a scope a rule reads the whole post, however long
+    late = "x" * 100000 + " vote proposal"
+    assert infer_stage.PatternEngine([(r"vote\s+proposal", "cip-vote", 0.95)]).classify(late) == ("cip-vote", 0.95)
+    assert infer_stage.quick_classify(late) == ("cip-vote", 0.95)
+
+    # The draft-number rules read the whole post, as they always did
+    assert infer_stage.quick_classify("CIP-0042: fee change\nbody") == ("cip-discuss", 0.70)
+    assert infer_stage.quick_classify("Weekly sync\nsee CIP-0042: fee change") == ("cip-discuss", 0.70)
+
+    with pytest.raises(ValueError):
+        infer_stage.PatternEngine([(r"vote", "cip-vote", 0.95, "body")])
+
+
+def test_chain_search_matches_re_search():
+    # Random texts over the rules' own words, separators and newlines, so
+    # partial chains, overlaps and line breaks between segments all occur
+    import random
+
+    rng = random.Random(7)
+    chains = [(pattern, infer_stage._chain_search(pattern)) for pattern, *_ in infer_stage.PATTERN_RULES]
+    chains = [(pattern, search) for pattern, search in chains if search]
+    assert len(chains) >= 5
+    vocabulary = sorted({word for pattern, _ in chains
+                         for literal in infer_stage._required_literals(pattern)
+                         for word in literal.split()})
+    vocabulary += ["cip-1", "cip 42", "cip7", "vote", "sv", "x", "\n", " ", "-", ":"]
+    for _ in range(3000):
+        text = " ".join(rng.choice(vocabulary) for _ in range(rng.randrange(1, 12)))
+        for pattern, search in chains:
+            assert search(text) == bool(re.search(pattern, text)), (pattern, text)
+
+
+ADVERSARIAL = [
+    "add weight to ", "outcome ", "cip-1 ", "cip1 ", "vote proposal to ", "featured app ",
+    "validator operator ", "super validator ", "sv ", "cip1" + " " * 20, "re: ",
+]
+
+
+@pytest.mark.parametrize("unit", ADVERSARIAL)
+def test_pattern_matching_cost_is_bounded(unit):
+    # Long runs of rule prefixes that never complete are the worst case for
+    # backtracking; every rule reads the whole post here
+    engine = infer_stage.PatternEngine([(pattern, stage, confidence, "text")
+                                        for pattern, stage, confidence, *_ in infer_stage.PATTERN_RULES])
+    for separator in (" ", "\n"):
+        text = separator.join([unit] * 5000)
+        for classify in (engine.classify, infer_stage.quick_classify):
+            start = time.perf_counter()
+            classify(text)
+            assert time.perf_counter() - start < 0.5, (unit, separator)
+
+
+def test_canonicalize_strips_prefixes_and_normalizes():
+    canonical = infer_stage.canonicalize("Re: Fwd: [sv-announce]  CIP-0042:\u00a0 Vote\n\n  body \t text ")
+    assert canonical == "CIP-0042: Vote\nbody text"
+    assert infer_stage.canonicalize("RE[2]: ｈｅｌｌｏ") == "hello"
+    assert infer_stage.canonicalize("[governance] Re: [sv-announce] Node upgrade") == "Node upgrade"
+    # A subject that is nothing but a tag is kept
+    assert infer_stage.canonicalize("[sv-announce]") == "[sv-announce]"
+    # CIP and stage tags are content, not list noise
+    assert infer_stage.canonicalize("Re: [CIP-0042] vote reminder") == "[CIP-0042] vote reminder"
+    assert infer_stage.canonicalize("[cip-discuss] New fee idea") == "[cip-discuss] New fee idea"
+    assert infer_stage.canonicalize("[CIP-0042] Approved") != infer_stage.canonicalize("[CIP-0043] Approved")
+
+    for text in RULE_EXAMPLES:
+        assert infer_stage.quick_classify(infer_stage.canonicalize(text)) == infer_stage.quick_classify(text)
+
+
+@pytest.mark.parametrize("text,expected", [
+    ("[CIP-0042] Vote on fees", ("cip-vote", 0.85)),
+    ("[CIP-0042] Approved", ("cip-announce", 0.95)),
+    ("[cip-discuss] New fee idea", ("cip-discuss", 0.98)),
+    ("Re: [CIP-0042] vote reminder", ("cip-vote", 0.85)),
+])
+def test_bracketed_cip_subjects_keep_their_pattern_match(text, expected):
+    items = [{"id": "1", "text": text}]
+    results, pending = infer_stage.prepare_items(items, {"pattern": 0, "nli": 0})
+    assert pending == []
+    assert (results[0]["stage"], results[0]["confidence"]) == expected
+
+
+def test_dedup_key_keeps_different_cips_apart():
+    inner = CountingEngine()
+    engine = infer_stage.DedupEngine(inner)
+    engine.classify(["[CIP-0042] fee thoughts", "[CIP-0043] fee thoughts", "Re: [CIP-0042] fee thoughts"])
+    # The reply shares the first answer; the model saw the texts as posted
+    assert inner.seen == ["[CIP-0042] fee thoughts", "[CIP-0043] fee thoughts"]
+
+
+def test_dedup_key_strips_list_tags():
+    inner = CountingEngine()
+    engine = infer_stage.DedupEngine(inner)
+    results = engine.classify(["[sv-announce] Node upgrade window", "Node upgrade window"])
+    assert inner.seen == ["[sv-announce] Node upgrade window"]
+    assert results[0] == results[1] and engine.duplicates == 1
+
+
+class CountingEngine:
+    """Stand-in NLI engine that records which texts reach the model"""
+
+    def __init__(self):
+        self.seen = []
+
+    def classify(self, texts):
+        self.seen.extend(texts)
+        return [("other", len(text) / 100) for text in texts]
+
+
+def test_result_cache_skips_repeated_texts(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    inner = CountingEngine()
+    engine = infer_stage.CachedEngine(inner, infer_stage.ResultCache(path, "model-a"))
+
+    first = engine.classify(["alpha post", "beta post"])
+    # Whitespace-only differences share a cache entry
+    second = engine.classify(["alpha   post", "gamma post"])
+
+    assert inner.seen == ["alpha post", "beta post", "gamma post"]
+    assert second[0] == first[0]
+    assert (engine.cache.hits, engine.cache.misses) == (1, 3)
+
+    # A line break moves text into or out of the subject, so it is not whitespace noise
+    engine.classify(["alpha\npost"])
+    engine.classify(["alpha \t\npost "])
+    assert inner.seen[3:] == ["alpha\npost"]
+
+    # A second process (here: a second connection) sees the same entries
+    other = infer_stage.CachedEngine(CountingEngine(), infer_stage.ResultCache(path, "model-a"))
+    assert other.classify(["beta post"]) == [first[1]]
+    assert other.engine.seen == []
+
+    # A different model id must not reuse entries
+    fresh = infer_stage.CachedEngine(CountingEngine(), infer_stage.ResultCache(path, "model-b"))
+    fresh.classify(["beta post"])
+    assert fresh.engine.seen == ["beta post"]
+
+
+def test_dedup_engine_shares_identical_texts():
+    inner = CountingEngine()
+    engine = infer_stage.DedupEngine(inner, max_entries=2)
+
+    first = engine.classify(["alpha", "beta", "alpha"])
+    second = engine.classify(["beta", "gamma"])
+
+    assert inner.seen == ["alpha", "beta", "gamma"]
+    assert first[0] == first[2] and second[0] == first[1]
+    assert (engine.items, engine.duplicates) == (5, 2)
+
+    # Bounded memory: "alpha" was the oldest entry and has been dropped
+    engine.classify(["alpha"])
+    assert inner.seen[-1] == "alpha"
+
+
+def test_thread_replies_inherit_root_stage():
+    inner = CountingEngine()
+    counts = {"pattern": 0, "nli": 0}
+    threads = infer_stage.ThreadPropagator(inner, counts)
+
+    early = threads.classify([{"id": "r0", "parent_id": "t1", "text": "thanks, +1"}])
+    assert early == []  # Waits for its root
+
+    records = threads.classify([
+        {"id": "t1", "text": "CIP-0042 Vote Proposal - fees"},
+        {"id": "r1", "parent_id": "t1", "text": "I support this"},
+        {"id": "r2", "parent_id": "r1", "text": "Re: me too"},  # Grandchild, same thread
+        {"id": "r3", "thread_id": "t1", "text": "Draft CIP for a follow-up"},  # Pattern says cip-discuss
+        {"id": "r4", "thread_id": "t1", "text": "vote proposal reminder"},  # Agrees with the root
+        {"id": "x1", "parent_id": "missing", "text": "orphan reply"},
+    ])
+    by_id = {record["id"]: record for record in records}
+
+    assert by_id["t1"]["tier"] == "pattern" and by_id["t1"]["stage"] == "cip-vote"
+    for reply in ("r0", "r1", "r2"):
+        assert by_id[reply] == {"id": reply, "stage": "cip-vote", "confidence": 0.95, "tier": "thread",
+                                "thread_id": "t1", "rules": infer_stage.rules_fingerprint()}
+    assert by_id["r3"]["thread_conflict"] and by_id["r3"]["tier"] == "nli"
+    assert by_id["r4"]["tier"] == "pattern"
+    assert "x1" not in by_id
+    assert inner.seen == ["Draft CIP for a follow-up"]
+
+    # A reply whose root never arrives is classified on its own at the end
+    assert [record["id"] for record in threads.flush()] == ["x1"]
+    assert inner.seen[-1] == "orphan reply"
+    assert (threads.inherited, threads.conflicts) == (3, 1)
+
+
+def test_thread_root_keyed_by_topic_thread_id():
+    inner = CountingEngine()
+    counts = {"pattern": 0, "nli": 0}
+    threads = infer_stage.ThreadPropagator(inner, counts)
+
+    # The reply names its parent by post id before the root arrives
+    assert threads.classify([{"id": "p2", "thread_id": "T1", "parent_id": "p1", "text": "sounds good"}]) == []
+    records = threads.classify([
+        {"id": "p1", "thread_id": "T1", "text": "CIP-0042 Vote Proposal - fees"},
+        {"id": "p3", "parent_id": "p1", "text": "agreed"},
+    ])
+    by_id = {record["id"]: record for record in records}
+
+    assert by_id["p1"]["tier"] == "pattern"
+    for reply in ("p2", "p3"):
+        assert by_id[reply]["tier"] == "thread" and by_id[reply]["thread_id"] == "T1"
+        assert by_id[reply]["stage"] == "cip-vote"
+    assert inner.seen == [] and threads.flush() == []
+
+
+def test_thread_state_stays_bounded():
+    counts = {"pattern": 0, "nli": 0}
+    threads = infer_stage.ThreadPropagator(CountingEngine(), counts, max_roots=100)
+
+    # Plain items leave no thread links behind, and only the latest roots
+    threads.classify([{"id": str(i), "text": RULE_EXAMPLES[0]} for i in range(1000)])
+    assert len(threads.thread_of) == 0
+    assert len(threads.rooted) == len(threads.stages) == 100
+
+    # Threaded items are remembered up to max_roots; a recent root still has its replies
+    threads.classify([{"id": f"p{i}", "thread_id": f"T{i}", "text": RULE_EXAMPLES[0]} for i in range(1000)])
+    assert max(len(threads.thread_of), len(threads.rooted), len(threads.stages)) == 100
+    records = threads.classify([{"id": "r", "parent_id": "p999", "text": "agreed"}])
+    assert records[0]["tier"] == "thread" and records[0]["thread_id"] == "T999"
+
+
+def test_reply_keeps_root_stage_evicted_by_its_own_batch():
+    counts = {"pattern": 0, "nli": 0}
+    threads = infer_stage.ThreadPropagator(CountingEngine(), counts, max_roots=3)
+    threads.classify([{"id": "A", "thread_id": "t1", "text": RULE_EXAMPLES[0]}])
+    stage = threads.stages["t1"][0]
+
+    # The new roots in the reply's batch push t1 out of the bounded map
+    batch = [{"id": "r", "thread_id": "t1", "parent_id": "A", "text": "agreed"}]
+    batch += [{"id": str(i), "text": RULE_EXAMPLES[0]} for i in range(5)]
+    records = {record["id"]: record for record in threads.classify(batch)}
+
+    assert "t1" not in threads.stages
+    assert len(records) == 6
+    assert records["r"]["tier"] == "thread" and records["r"]["stage"] == stage
+
+
+def test_result_cache_evicts_least_recently_used(tmp_path):
+    cache = infer_stage.ResultCache(str(tmp_path / "cache.sqlite3"), "model", max_entries=2)
+    keys = [cache.key(text) for text in ("one", "two", "three")]
+
+    cache.put_many([(keys[0], "other", 0.1)])
+    time.sleep(0.01)
+    cache.put_many([(keys[1], "other", 0.2)])
+    time.sleep(0.01)
+    cache.get_many([keys[0]])  # "one" is now more recent than "two"
+    time.sleep(0.01)
+    cache.put_many([(keys[2], "other", 0.3)])
+
+    assert set(cache.get_many(keys)) == {keys[0], keys[2]}
+
+
+CASCADE_TRAINING = (
+    [(f"Discussion of fee schedule idea number {i}", "cip-discuss") for i in range(40)]
+    + [(f"Weekly meeting notes and sync summary {i}", "other") for i in range(40)]
+)
+
+
+def test_cascade_escalates_low_margin_items(tmp_path):
+    pytest.importorskip("numpy")
+    model = infer_stage.HashedLinearModel(dim=4096).fit(*zip(*CASCADE_TRAINING))
+    path = str(tmp_path / "cascade.npz")
+    model.save(path)
+    loaded = infer_stage.HashedLinearModel.load(path)
+    assert loaded.predict(["fee schedule idea"]) == model.predict(["fee schedule idea"])
+
+    inner = CountingEngine()
+    engine = infer_stage.CascadeEngine(inner, loaded, margin=0.5)
+    easy, unknown = engine.classify(["Discussion of fee schedule idea", "zzz qqq"])
+
+    assert easy[0] == "cip-discuss" and easy[2] == "linear"
+    assert unknown == ("other", 0.07)
+    assert inner.seen == ["zzz qqq"]
+    assert (engine.decided, engine.escalated) == (1, 1)
+
+    record = infer_stage.nli_record(engine, "1", easy)
+    assert record["tier"] == "linear" and "premise" not in record
+
+
+def test_train_cascade_skips_its_own_answers(tmp_path, capsys):
+    import io
+
+    pytest.importorskip("numpy")
+    corpus = [{"id": str(i), "text": text, "stage": stage} for i, (text, stage) in enumerate(CASCADE_TRAINING)]
+    corpus += [{"id": f"l{i}", "text": f"Fee schedule follow-up {i}"} for i in range(20)]
+    labels_path = tmp_path / "previous.jsonl"
+    labels_path.write_text("".join(
+        json.dumps({"id": f"l{i}", "stage": "cip-discuss", "confidence": 0.9, "tier": "linear"}) + "\n"
+        for i in range(20)
+    ))
+    stream = io.BytesIO(b"".join(json.dumps(item).encode() + b"\n" for item in corpus))
+    args = infer_stage.parse_args(["--train-cascade", "--cascade-model", str(tmp_path / "cascade.npz"),
+                                   "--labels", str(labels_path)])
+    assert infer_stage.train_cascade(args, stream) == 0
+    report = json.loads(capsys.readouterr().out)
+    assert report["train_items"] + report["held_out_items"] == len(CASCADE_TRAINING)
+
+
+def build_tiny_model(model_dir, architecture="distilbert"):
+    """Save a tiny random NLI model + WordPiece tokenizer to model_dir"""
+    torch = pytest.importorskip("torch")
+    transformers = pytest.importorskip("transformers")
+
+    words = (
+        "the a cip vote discuss proposal governance forum post is this approved announcement "
+        "validator weight featured app request tokenomics sv super general topic other thread "
+        "for of on to and with"
+    ).split()
+    vocab = (
+        ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", ".", ",", "'", "-", ":"]
+        + words
+        + [str(i) for i in range(10)]
+        + list("abcdefghijklmnopqrstuvwxyz")
+        + ["##" + c for c in "abcdefghijklmnopqrstuvwxyz0123456789"]
+    )
+    vocab_file = model_dir / "vocab.txt"
+    vocab_file.write_text("\n".join(vocab))
+
+    labels = {
+        "id2label": {0: "CONTRADICTION", 1: "ENTAILMENT", 2: "NEUTRAL"},
+        "label2id": {"CONTRADICTION": 0, "ENTAILMENT": 1, "NEUTRAL": 2},
+    }
+    torch.manual_seed(0)
+    if architecture == "bert":
+        # BERT also consumes token_type_ids
+        tokenizer = transformers.BertTokenizerFast(vocab_file=str(vocab_file), model_max_length=128)
+        config = transformers.BertConfig(
+            vocab_size=len(vocab), hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+            num_attention_heads=2, max_position_embeddings=128, initializer_range=0.5,
+            num_labels=3, **labels,
+        )
+        model = transformers.BertForSequenceClassification(config).eval()
+    else:
+        tokenizer = transformers.DistilBertTokenizerFast(vocab_file=str(vocab_file), model_max_length=128)
+        config = transformers.DistilBertConfig(
+            vocab_size=len(vocab), dim=32, hidden_dim=64, n_layers=2, n_heads=2,
+            max_position_embeddings=128, initializer_range=0.5, num_labels=3, **labels,
+        )
+        model = transformers.DistilBertForSequenceClassification(config).eval()
+    model.save_pretrained(str(model_dir))
+    tokenizer.save_pretrained(str(model_dir))
+    return str(model_dir)
+
+
+@pytest.fixture(scope="module")
+def tiny_model_dir(tmp_path_factory):
+    return build_tiny_model(tmp_path_factory.mktemp("tiny-nli"))
+
+
+@pytest.fixture(scope="module", params=["distilbert", "bert"])
+def any_tiny_model_dir(request, tmp_path_factory):
+    return build_tiny_model(tmp_path_factory.mktemp(f"tiny-{request.param}"), request.param)
+
+
+def pipeline_classify(classifier, text):
+    """Reference: the original one-call-per-item pipeline path"""
+    result = classifier(
+        text,
+        [infer_stage.STAGE_DESCRIPTIONS[stage] for stage in infer_stage.ALLOWED_STAGES],
+        hypothesis_template=infer_stage.HYPOTHESIS_TEMPLATE,
+        multi_label=False,
+    )
+    for stage, desc in infer_stage.STAGE_DESCRIPTIONS.items():
+        if desc == result["labels"][0]:
+            return stage, result["scores"][0]
+
+
+def test_nli_engine_softmax_is_stable_for_large_logits():
+    np = pytest.importorskip("numpy")
+    labels = len(infer_stage.ALLOWED_STAGES)
+    logits = np.array([
+        np.arange(labels, dtype=np.float32),
+        np.arange(labels, dtype=np.float32) * 1000,  # Overflows a plain exp()
+        np.full(labels, -np.inf, dtype=np.float32),
+    ], dtype=np.float32)
+    logits[2, 1] = 500.0  # Pruned labels are -inf
+    engine = object.__new__(infer_stage.NLIEngine)
+    engine.pruner = None
+    engine._run_batches = lambda batches, count: logits
+
+    results = engine.finish(([], 3, None, None))
+    expected = np.exp(np.arange(labels) - (labels - 1.0))
+    assert results[0] == (infer_stage.ALLOWED_STAGES[-1], pytest.approx(1 / expected.sum(), rel=1e-5))
+    assert results[1] == (infer_stage.ALLOWED_STAGES[-1], 1.0)
+    assert results[2] == (infer_stage.ALLOWED_STAGES[1], 1.0)
+
+
+@pytest.mark.parametrize("batch_size", [1, 3, 64])
+def test_nli_engine_matches_pipeline(any_tiny_model_dir, batch_size):
+    from transformers import pipeline
+
+    classifier = pipeline("zero-shot-classification", model=any_tiny_model_dir, device=-1)
+    engine = infer_stage.NLIEngine.load(any_tiny_model_dir, batch_size=batch_size)
+    results = engine.classify(SAMPLE_TEXTS)
+
+    assert len(results) == len(SAMPLE_TEXTS)
+    for text, (stage, confidence) in zip(SAMPLE_TEXTS, results):
+        expected_stage, expected_confidence = pipeline_classify(classifier, text)
+        assert stage == expected_stage
+        assert confidence == pytest.approx(expected_confidence, abs=1e-5)
+
+
+def test_nli_engine_truncates_premise_only(tiny_model_dir):
+    engine = infer_stage.NLIEngine.load(tiny_model_dir)
+    pairs = engine._encode([SAMPLE_TEXTS[-1]])
+
+    assert all(len(ids) == engine.max_length for ids, _ in pairs)
+    for (ids, _), tail in zip(pairs, engine.tails):
+        assert ids[-len(tail):] == tail
+
+
+def test_premise_builder_strategies():
+    text = ("CIP-0099 discussion\n"
+            "First sentence here. Second one follows! Third? Fourth is long. "
+            + "filler words " * 50 + "the validator weight changes next week " + "more filler " * 50)
+
+    assert infer_stage.PremiseBuilder("full").build(text) == text
+    assert infer_stage.PremiseBuilder("subject").build(text) == "CIP-0099 discussion"
+    assert infer_stage.PremiseBuilder("sentences", sentences=2).build(text) == (
+        "CIP-0099 discussion\nFirst sentence here. Second one follows!")
+
+    keywords = infer_stage.PremiseBuilder("keywords", window=2).build(text)
+    assert keywords == "CIP-0099 discussion\nwords the validator weight changes next"
+
+    # Subject-only posts are left alone; keyword strategy falls back to sentences
+    assert infer_stage.PremiseBuilder("subject").build("Just a subject") == "Just a subject"
+    assert infer_stage.PremiseBuilder("keywords", sentences=1).build("Hi\nNo terms. At all.") == "Hi\nNo terms."
+    assert infer_stage.PremiseBuilder("budget").max_tokens == infer_stage.PREMISE_TOKENS
+    with pytest.raises(ValueError):
+        infer_stage.PremiseBuilder("bogus")
+
+
+def test_nli_engine_premise_token_budget(tiny_model_dir):
+    budget = infer_stage.PremiseBuilder("budget", max_tokens=8)
+    engine = infer_stage.NLIEngine.load(tiny_model_dir, premise=budget)
+    pairs = engine._encode([SAMPLE_TEXTS[-1]])
+
+    prefix = len(engine.template["prefix"])
+    for (ids, _), tail in zip(pairs, engine.tails):
+        assert len(ids) == prefix + 8 + len(tail)
+
+    records, _ = run_script(["--model", tiny_model_dir, "--no-cache", "--premise-strategy", "subject"],
+                            [{"id": "1", "text": SAMPLE_TEXTS[-1]}])
+    assert records[0]["premise"] == "subject"
+
+
+def test_low_memory_bfloat16_is_gated_and_cached(tiny_model_dir, tmp_path, monkeypatch):
+    import torch
+
+    monkeypatch.setattr(infer_stage, "PRECISION_CHECKS_PATH", str(tmp_path / "checks.json"))
+    args = infer_stage.parse_args(["--model", tiny_model_dir, "--low-memory"])
+
+    def weight_dtype(engine):
+        return next(engine.backend.model.parameters()).dtype
+
+    # A check nothing can pass keeps float32, and the verdict is remembered
+    monkeypatch.setattr(infer_stage, "BF16_MAX_CONFIDENCE_DELTA", -1.0)
+    engine = infer_stage.load_nli_engine(args)
+    assert weight_dtype(engine) == torch.float32
+    # ...with the original float32 weights, not a round trip through bfloat16
+    plain = infer_stage.load_nli_engine(infer_stage.parse_args(["--model", tiny_model_dir]))
+    assert engine.classify(SAMPLE_TEXTS) == plain.classify(SAMPLE_TEXTS)
+    checks = infer_stage.load_precision_checks()
+    assert [report["passed"] for report in checks.values()] == [False]
+    assert engine.fingerprint == infer_stage.engine_fingerprint(args) != infer_stage.nli_fingerprint(
+        tiny_model_dir, infer_stage.premise_builder(args))
+
+    # A passed verdict loads bfloat16 weights directly, without re-checking
+    key, = checks
+    infer_stage.save_precision_check(key, dict(checks[key], passed=True))
+    engine = infer_stage.load_nli_engine(args)
+    assert weight_dtype(engine) == torch.bfloat16
+    assert all(stage in infer_stage.ALLOWED_STAGES for stage, _ in engine.classify(SAMPLE_TEXTS))
+    assert infer_stage.memory_report()["rss_mb"] > 0
+
+
+def test_label_pruner_shortlists_families_and_checks_argmax(tiny_model_dir):
+    import numpy as np
+
+    stages = infer_stage.ALLOWED_STAGES
+    pruner = infer_stage.LabelPruner(check_rate=1.0)
+    assert [stages[i] for i in pruner.candidates("Thoughts on CIP-0042")] == [
+        "cip-discuss", "cip-vote", "cip-announce", "other"]
+    assert [stages[i] for i in pruner.candidates("Validator liveness")] == [
+        "tokenomics", "tokenomics-announce", "sv-announce", "other"]
+    assert pruner.candidates("Weekly sync notes") == pruner.all_labels  # No signal, no pruning
+
+    engine = infer_stage.NLIEngine.load(tiny_model_dir)
+    texts = ["Thoughts on CIP-0042", "Validator liveness", "Weekly sync notes"]
+    full = engine._entailment_logits(texts)
+    engine.pruner = infer_stage.LabelPruner()
+    scored, _ = engine.pruner.plan(texts)
+    pruned = engine._run_batches(engine._padded_batches(texts, scored), len(texts))
+    assert np.allclose(pruned[np.isfinite(pruned)], full[np.isfinite(pruned)], atol=1e-5)
+    assert engine.pruner.hypotheses == 4 + 4 + 7
+
+    # The safety check scores everything but answers from the shortlist
+    engine.pruner = pruner
+    results = engine.classify(texts)
+    for (stage, _), text in zip(results, texts):
+        assert stages.index(stage) in pruner.candidates(text)
+    assert pruner.checked == 2 and pruner.hypotheses == 7 * 3
+
+
+def test_vector_index_appends_and_searches(tmp_path, monkeypatch):
+    np = pytest.importorskip("numpy")
+
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(50, 8)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    stages = [infer_stage.ALLOWED_STAGES[i % 7] for i in range(50)]
+    path = str(tmp_path / "index")
+
+    index = infer_stage.VectorIndex(path, "embedder")
+    assert index.add([str(i) for i in range(30)], vectors[:30], stages[:30]) == 30
+    version = index.version
+    # Known ids are skipped; a crashed append's tail is overwritten
+    with open(os.path.join(path, "vectors.f32"), "ab") as f:
+        f.write(b"\xff" * 100)
+    reopened = infer_stage.VectorIndex(path, "embedder")
+    # The committed ids are read once, not on every add()
+    reads = []
+
+    def counting_open(file, mode="r", *args, **kwargs):
+        if str(file).endswith("ids.jsonl") and "r" in mode:
+            reads.append(file)
+        return open(file, mode, *args, **kwargs)
+
+    monkeypatch.setattr(infer_stage, "open", counting_open, raising=False)
+    assert reopened.add([str(i) for i in range(20, 40)], vectors[20:40], stages[20:40]) == 10
+    assert reopened.add([str(i) for i in range(35, 50)], vectors[35:], stages[35:]) == 10
+    assert len(reads) == 1 and reopened.known_ids() == {str(i) for i in range(50)}
+    monkeypatch.undo()
+    assert reopened.count == 50 and reopened.version != version
+    assert os.path.getsize(os.path.join(path, "vectors.f32")) == 50 * 8 * 4
+
+    monkeypatch.setattr(infer_stage, "KNN_SEARCH_ROWS", 16)  # Several blocks
+    queries = vectors[[3, 41]]
+    similarities, found = infer_stage.VectorIndex(path).search(queries, 5)
+    expected = np.argsort(-(queries @ vectors.T), axis=1)[:, :5]
+    assert np.allclose(similarities, np.take_along_axis(queries @ vectors.T, expected, axis=1))
+    assert found.tolist() == [[infer_stage.ALLOWED_STAGES.index(stages[i]) for i in row] for row in expected]
+
+    with pytest.raises(ValueError):
+        infer_stage.VectorIndex(path, "other-embedder")
+
+
+def test_knn_engine_votes_over_indexed_examples(tiny_model_dir, tmp_path, capsys):
+    import io
+
+    index_dir = str(tmp_path / "index")
+    golden = tmp_path / "golden-items.json"
+    golden.write_text(json.dumps({"items": [
+        {"id": "g1", "subject": "Thread on validator weight", "body": None, "trueType": "tokenomics"},
+        {"id": "g2", "subject": "Lifecycle type, not a stage", "trueType": "featured-app"},
+    ]}))
+    corpus = [
+        {"id": "1", "text": "General governance topic for the forum", "stage": "other"},
+        {"id": "2", "text": "CIP-0042 vote proposal"},  # Labelled by the pattern rules
+        {"id": "3", "text": "Weekly sync notes"},  # No label: not indexed
+    ]
+    stream = io.BytesIO(b"".join(json.dumps(item).encode() + b"\n" for item in corpus))
+    args = infer_stage.parse_args(["--build-index", "--embed-model", tiny_model_dir, "--knn-index", index_dir,
+                                   "--golden-set", str(golden)])
+    assert infer_stage.build_knn_index(args, stream) == 0
+    report = json.loads(capsys.readouterr().out)
+    assert report["added_by_stage"] == {"cip-vote": 1, "other": 1, "tokenomics": 1}
+    assert (report["golden_items"], report["skipped_unlabelled"]) == (1, 1)
+
+    stream.seek(0)
+    assert infer_stage.build_knn_index(args, stream) == 0
+    report = json.loads(capsys.readouterr().out)
+    assert (report["added"], report["already_indexed"], report["rows"]) == (0, 3, 3)
+
+    # An indexed text is its own nearest neighbour
+    args = infer_stage.parse_args(["--engine", "knn", "--embed-model", tiny_model_dir, "--knn-index", index_dir,
+                                   "--knn-k", "1"])
+    engine = infer_stage.load_engine(args)
+    assert engine.fingerprint == infer_stage.engine_fingerprint(args)
+    assert engine.classify(["General governance topic for the forum", "Thread on validator weight"]) == [
+        ("other", 1.0, "knn"), ("tokenomics", 1.0, "knn")]
+    engine.k = 3
+    stage, confidence, tier = engine.classify(["Weekly sync notes"])[0]
+    assert stage in infer_stage.ALLOWED_STAGES and 0 < confidence <= 1 and tier == "knn"
+
+    record = infer_stage.nli_record(engine, "3", (stage, confidence, tier))
+    assert record["model"] == engine.fingerprint and record["premise"] == "full"
+    assert infer_stage.open_result_cache(args) is None
+
+
+def test_distilled_head_fits_and_round_trips(tmp_path):
+    np = pytest.importorskip("numpy")
+
+    rng = np.random.default_rng(0)
+    centres = rng.normal(size=(7, 16)) * 3
+    targets = rng.integers(0, 7, size=350)
+    vectors = (centres[targets] + rng.normal(size=(350, 16))).astype(np.float32)
+    stages = [infer_stage.ALLOWED_STAGES[i] for i in targets]
+
+    head = infer_stage.DistilledHead.fit("embedder", vectors, stages)
+    assert (head.logits(vectors).argmax(axis=1) == targets).mean() > 0.95
+
+    path = str(tmp_path / "distilled.npz")
+    head.save(path)
+    loaded = infer_stage.DistilledHead.load(path)
+    assert loaded.embed_model == "embedder"
+    assert np.allclose(loaded.logits(vectors), head.logits(vectors))
+
+
+def test_labelled_examples_skip_derived_tiers():
+    labels = {str(i): ("cip-vote", 0.97, tier)
+              for i, tier in enumerate(["pattern", "nli", "golden", "linear", "thread", "knn", "distilled"])}
+    used = [item_id for item_id in labels
+            if infer_stage.labelled_example({"id": item_id, "text": "Weekly sync notes"}, labels)]
+    assert used == ["0", "1", "2"]
+    # A stage given on the item itself, without a tier, is a hand label
+    assert infer_stage.labelled_example({"id": "x", "text": "Weekly sync", "stage": "other"}, {})[3] == "stage"
+    assert infer_stage.labelled_example({"id": "x", "text": "Weekly sync", "stage": "other", "tier": "thread"},
+                                        {}) is None
+
+
+def test_train_distilled_reports_against_zero_shot(tiny_model_dir, tmp_path, capsys):
+    import io
+
+    corpus = [{"id": str(i), "text": f"Thread on validator weight {i}", "stage": "tokenomics"} for i in range(10)]
+    corpus += [{"id": f"p{i}", "text": f"CIP-00{i} vote proposal"} for i in range(10)]  # Pattern labels
+    corpus += [{"id": f"n{i}", "text": f"Question about the call {i}"} for i in range(6)]  # Labelled by NLI
+    labels_path = tmp_path / "previous.jsonl"
+    labels_path.write_text("".join(json.dumps(record) + "\n" for record in [
+        *({"id": f"n{i}", "stage": "sv-announce", "confidence": 0.41, "tier": "nli"} for i in range(5)),
+        {"id": "n5", "stage": "other", "confidence": 0.0, "tier": "nli"},  # Failed item
+    ]))
+    stream = io.BytesIO(b"".join(json.dumps(item).encode() + b"\n" for item in corpus))
+    path = str(tmp_path / "distilled.npz")
+    args = infer_stage.parse_args(["--train-distilled", "--embed-model", tiny_model_dir, "--model", tiny_model_dir,
+                                   "--distilled-model", path, "--labels", str(labels_path)])
+    assert infer_stage.train_distilled(args, stream) == 0
+    report = json.loads(capsys.readouterr().out)
+    assert report["items_by_source"] == {"labels": 5, "pattern": 10, "stage": 10}
+    assert (report["train_items"], report["held_out_items"]) == (23, 2)
+    assert set(report["held_out"]) == {"distilled", "zero_shot", "agreement", "speedup"}
+
+    args = infer_stage.parse_args(["--engine", "distilled", "--distilled-model", path])
+    engine = infer_stage.load_engine(args)
+    assert engine.fingerprint == infer_stage.engine_fingerprint(args)
+    results = engine.classify(["Thread on validator weight", "General governance topic"])
+    assert [tier for _, _, tier in results] == ["distilled", "distilled"]
+    assert all(stage in infer_stage.ALLOWED_STAGES and 0 < confidence <= 1 for stage, confidence, _ in results)
+    assert infer_stage.nli_record(engine, "1", results[0])["model"] == engine.fingerprint
+
+
+def test_prepared_snapshot_loads_offline(tiny_model_dir, tmp_path, monkeypatch):
+    monkeypatch.setattr(infer_stage, "MODEL_STORE_DIR", str(tmp_path / "models"))
+    args = infer_stage.parse_args(["--prepare-model", "--model", tiny_model_dir])
+    assert infer_stage.prepare_model(args) == 0
+
+    snapshot = infer_stage.model_snapshot_path(tiny_model_dir)
+    with open(os.path.join(snapshot, infer_stage.SNAPSHOT_MANIFEST)) as f:
+        manifest = json.load(f)
+    assert any(name.endswith(".safetensors") for name in manifest["files"])
+
+    # A hub name with a prepared snapshot resolves to it and never hits the network
+    hub_snapshot = infer_stage.model_snapshot_path("example-org/tiny-nli")
+    os.rename(snapshot, hub_snapshot)
+    assert infer_stage.resolve_model("example-org/tiny-nli") == (hub_snapshot, "snapshot")
+    monkeypatch.setenv("HF_HUB_OFFLINE", "1")
+    engine = infer_stage.NLIEngine.load("example-org/tiny-nli")
+    reference = infer_stage.NLIEngine.load(tiny_model_dir)
+    assert engine.classify(SAMPLE_TEXTS) == reference.classify(SAMPLE_TEXTS)
+
+
+def test_nli_engine_empty_input(tiny_model_dir):
+    engine = infer_stage.NLIEngine.load(tiny_model_dir)
+    assert engine.classify([]) == []
+
+
+def test_onnx_backend_matches_torch(any_tiny_model_dir, tmp_path):
+    pytest.importorskip("onnxruntime")
+    onnx_path = str(tmp_path / "model.onnx")
+    texts = SAMPLE_TEXTS + infer_stage.REFERENCE_CORPUS
+
+    torch_engine = infer_stage.NLIEngine.load(any_tiny_model_dir, batch_size=5)
+    onnx_engine = infer_stage.NLIEngine.load(any_tiny_model_dir, batch_size=5, backend="onnx", onnx_path=onnx_path)
+
+    # Compare raw entailment logits: the random tiny models produce exact
+    # ties that float noise may break either way, so labels alone are flaky
+    expected = torch_engine._entailment_logits(texts)
+    actual = onnx_engine._entailment_logits(texts)
+    assert actual.shape == expected.shape
+    assert abs(actual - expected).max() < 1e-4
+
+    # The exported file is reused, not re-exported
+    exported_at = os.path.getmtime(onnx_path)
+    infer_stage.NLIEngine.load(any_tiny_model_dir, backend="onnx", onnx_path=onnx_path)
+    assert os.path.getmtime(onnx_path) == exported_at
+
+
+def test_reclassify_reruns_only_items_a_change_can_affect(monkeypatch):
+    items = [
+        {"id": "a", "text": "CIP-0042 Vote Proposal - fees"},
+        {"id": "r", "parent_id": "a", "text": "I support this"},
+        {"id": "b", "text": "Weekly sync notes"},
+        {"id": "c", "text": "Meeting reschedule"},
+        {"id": "e", "text": ""},
+    ]
+    inner = CountingEngine()
+    inner.fingerprint = "model-1"
+    threads = infer_stage.ThreadPropagator(inner, {"pattern": 0, "nli": 0})
+    previous = {record["id"]: record for record in threads.classify(items)}
+    assert previous["c"]["model"] == "model-1" and previous["r"]["tier"] == "thread"
+
+    # Unchanged rules and model: nothing reaches the engine, nothing changes
+    inner.seen.clear()
+    reclassifier = infer_stage.Reclassifier(inner, previous, {"pattern": 0, "nli": 0})
+    records, changed = reclassifier.classify(items)
+    assert inner.seen == [] and changed == []
+    assert {record["id"]: record for record in records} == previous
+
+    # An earlier rule now decides "a" (and its reply follows), a new rule matches "b"
+    rules = [(r"cip-\d+", "cip-discuss", 0.85), (r"weekly sync", "sv-announce", 0.9)] + infer_stage.PATTERN_RULES
+    monkeypatch.setattr(infer_stage, "PATTERN_RULES", rules)
+    monkeypatch.setattr(infer_stage, "PATTERN_ENGINE", infer_stage.PatternEngine(rules))
+    monkeypatch.setattr(infer_stage, "_RULES_FINGERPRINTS", {})
+    reclassifier = infer_stage.Reclassifier(inner, previous, {"pattern": 0, "nli": 0})
+    records, changed = reclassifier.classify(items)
+    by_id = {record["id"]: record for record in records}
+    assert inner.seen == []
+    assert sorted(record["id"] for record in changed) == ["a", "b", "r"]
+    assert by_id["a"]["stage"] == by_id["r"]["stage"] == "cip-discuss"
+    assert by_id["b"]["tier"] == "pattern"
+    assert by_id["c"] == dict(previous["c"], rules=infer_stage.rules_fingerprint())
+    assert reclassifier.reasons["moved"] == reclassifier.reasons["new_match"] == 1
+
+    # Changed descriptions/model: only the NLI item is re-run
+    inner.fingerprint = "model-2"
+    reclassifier = infer_stage.Reclassifier(inner, previous, {"pattern": 0, "nli": 0})
+    records, _ = reclassifier.classify(items)
+    assert inner.seen == ["Meeting reschedule"]
+    assert {record["id"]: record for record in records}["c"]["model"] == "model-2"
+
+
+def test_memory_budget_sizes_batches_by_tokens_and_backs_off(monkeypatch):
+    import io
+
+    long_item = {"id": "l", "text": "x" * 800}  # ~200 tokens
+    short_item = {"id": "s", "text": "CIP-0042"}
+    stream = io.BytesIO(b"".join(json.dumps(item).encode() + b"\n" for item in [long_item] * 6 + [short_item] * 5))
+    budget = infer_stage.MemoryBudget(tokens=512, max_items=4)
+    sizes = [len(items) for items in infer_stage.read_batches(stream, budget)]
+    assert sizes == [3, 3, 4, 1]  # Long items by tokens, short ones by the item cap
+    assert budget.batches == 4 and budget.items == 11
+
+    rss = iter([900, 900, 900, 100, 100])
+    monkeypatch.setattr(infer_stage, "current_rss_mb", lambda: next(rss))
+    budget = infer_stage.MemoryBudget(max_rss_mb=1000, tokens=4096)
+    budget.check()  # Still near the budget after collecting: halve
+    assert budget.tokens == 2048 and budget.collections == 1 and budget.backoffs == 1
+    budget.check()  # Collecting was enough
+    assert budget.tokens == 2048 and budget.collections == 2
+    budget.check()  # Plenty of headroom: grow back
+    assert budget.tokens == 2560 and budget.collections == 2
+
+
+def test_batches_stay_small_when_writing_to_a_pipe(monkeypatch, tmp_path):
+    args = infer_stage.parse_args([])
+    with open(tmp_path / "out.jsonl", "w") as f:
+        monkeypatch.setattr(sys, "stdout", f)
+        assert infer_stage.memory_budget(args).max_items == infer_stage.BATCH_SIZE
+    read_fd, write_fd = os.pipe()
+    with os.fdopen(read_fd), os.fdopen(write_fd, "w") as f:
+        monkeypatch.setattr(sys, "stdout", f)
+        assert infer_stage.memory_budget(args).max_items == infer_stage.STREAM_BATCH_SIZE
+        assert infer_stage.memory_budget(infer_stage.parse_args(["--batch-size", "100"])).max_items == 100
+
+
+def test_serve_mode_multiplexes_requests(tiny_model_dir, tmp_path):
+    requests = [
+        {"request_id": "h", "op": "health"},
+        {"request_id": "a", "op": "classify", "items": [
+            {"id": "1", "text": "CIP-0042 Vote Proposal"},
+            {"id": "2", "text": SAMPLE_TEXTS[1]},
+            {"id": "3", "text": ""},
+        ]},
+        {"request_id": "b", "op": "classify", "items": [{"id": "4", "text": "Validators approved"}]},
+        {"request_id": "c", "op": "nope"},
+        {"request_id": "z", "op": "shutdown"},
+    ]
+    proc = subprocess.run(
+        [sys.executable, SCRIPT, "--serve", "--model", tiny_model_dir, "--cache", str(tmp_path / "cache.sqlite3")],
+        input="".join(json.dumps(r) + "\n" for r in requests),
+        capture_output=True, text=True, timeout=300,
+    )
+    assert proc.returncode == 0, proc.stderr
+    lines = [json.loads(line) for line in proc.stdout.splitlines()]
+
+    assert lines[0]["event"] == "ready"
+    responses = {line["request_id"]: line for line in lines[1:]}
+    assert responses["h"]["status"] == "ready"
+    assert responses["c"]["error"] == "unknown op: nope"
+    assert responses["z"]["status"] == "shutting_down"
+    rules = infer_stage.rules_fingerprint()
+    assert responses["b"]["results"] == [{"id": "4", "stage": "tokenomics-announce", "confidence": 0.95,
+                                          "tier": "pattern", "rules": rules}]
+
+    # Queued NLI work is drained before the server exits
+    results = responses["a"]["results"]
+    assert [r["id"] for r in results] == ["1", "2", "3"]
+    assert results[0] == {"id": "1", "stage": "cip-vote", "confidence": 0.95, "tier": "pattern", "rules": rules}
+    assert results[1]["stage"] in infer_stage.ALLOWED_STAGES
+    assert results[2] == {"id": "3", "stage": "other", "confidence": 0.0, "rules": rules}
+
+
+def test_serve_cancel_drops_queued_work(capsysbinary):
+    inner = CountingEngine()
+    server = infer_stage.InferenceServer(inner)
+    for request_id, text in (("a", "Question about the call"), ("b", "Another open question")):
+        server.handle({"request_id": request_id, "op": "classify", "items": [{"id": request_id, "text": text}]})
+    server.handle({"request_id": "a", "op": "cancel"})
+    server.jobs.put(None)
+    server._inference_loop()
+
+    responses = [json.loads(line) for line in capsysbinary.readouterr().out.splitlines()]
+    assert responses[0] == {"request_id": "a", "status": "cancelled"}
+    assert [r["request_id"] for r in responses[1:]] == ["b"]
+    assert inner.seen == ["Another open question"]
+    assert not server.queued and not server.cancelled
+
+
+def run_script(args, items, timeout=300):
+    """Run infer_stage.py over JSONL items; returns (output records, stderr)"""
+    proc = subprocess.run(
+        [sys.executable, SCRIPT, *args],
+        input="".join(json.dumps(item) + "\n" for item in items),
+        capture_output=True, text=True, timeout=timeout,
+    )
+    assert proc.returncode == 0, proc.stderr
+    return [json.loads(line) for line in proc.stdout.splitlines()], proc.stderr
+
+
+def test_telemetry_reports_phases_and_rule_hits(tiny_model_dir):
+    texts = RULE_EXAMPLES[:3] + SAMPLE_TEXTS[:2] + [""]
+    items = [{"id": str(i), "text": text} for i, text in enumerate(texts)]
+
+    _, stderr = run_script(["--model", tiny_model_dir, "--no-cache", "--telemetry"], items)
+    reports = [json.loads(line) for line in stderr.splitlines() if line.startswith('{"event": "telemetry')]
+    final = reports[-1]
+
+    assert final["event"] == "telemetry_final"
+    assert final["items"] == len(items)
+    assert {"model_load", "decode", "patterns", "tokenize", "forward", "output"} <= set(final["phases_seconds"])
+    assert sum(final["latency_ms"]["pattern"].values()) == 3
+    assert sum(final["rule_hits"].values()) == 3
+    assert final["peak_rss_mb"] > 0
+
+
+def test_length_framing_matches_jsonl():
+    import struct
+
+    items = [{"id": str(i), "text": text} for i, text in enumerate(RULE_EXAMPLES[:5] + ["", "ünïcode text"])]
+    expected, _ = run_script(["--patterns-only", "--no-cache"], items)
+
+    frames = b""
+    for item in items:
+        payload = json.dumps(item).encode("utf-8")
+        frames += struct.pack(">I", len(payload)) + payload
+    proc = subprocess.run([sys.executable, SCRIPT, "--patterns-only", "--no-cache", "--framing", "length"],
+                          input=frames, capture_output=True, timeout=60)
+    assert proc.returncode == 0, proc.stderr
+
+    records, data = [], proc.stdout
+    while data:
+        size = struct.unpack(">I", data[:4])[0]
+        records.append(json.loads(data[4:4 + size]))
+        data = data[4 + size:]
+    assert records == expected
+
+
+def test_bulk_decoding_falls_back_to_lines(monkeypatch, capsys):
+    import io
+
+    class CountingCodec:
+        calls = 0
+
+        @classmethod
+        def loads(cls, data):
+            cls.calls += 1
+            return json.loads(data)
+
+    monkeypatch.setattr(infer_stage, "_orjson", CountingCodec)
+    items = [{"id": str(i), "text": f"text {i}"} for i in range(50)]
+    lines = b"".join(json.dumps(item).encode() + b"\n\n" for item in items)
+    assert list(infer_stage.iter_items(io.BytesIO(lines))) == items
+    assert CountingCodec.calls == 1  # One call for the whole chunk
+
+    # An invalid line, or one holding two objects, sends the chunk down the per-line path
+    bad = lines + b'{"id": "x"\n{"id": "a"}, {"id": "b"}\n'
+    assert list(infer_stage.iter_items(io.BytesIO(bad))) == items
+    assert capsys.readouterr().err.count("Invalid JSON line") == 2
+
+
+def test_output_writer_flushes_within_deadline():
+    import io
+
+    class Sink(io.BytesIO):
+        def close(self):
+            pass
+
+    sink = Sink()
+    writer = infer_stage.OutputWriter(sink, flush_interval=0.05)
+    writer.write({"id": "1", "stage": "other", "confidence": 0.5})
+    assert sink.getvalue() == b""  # Buffered, not written per item
+    time.sleep(0.3)
+    assert json.loads(sink.getvalue()) == {"id": "1", "stage": "other", "confidence": 0.5}
+
+    writer.write_many([{"id": "2"}, {"id": "3"}])
+    writer.close()
+    assert [json.loads(line)["id"] for line in sink.getvalue().splitlines()] == ["1", "2", "3"]
+
+
+def test_run_journal_replays_completed_items(tmp_path):
+    import io
+
+    run_dir = str(tmp_path / "run")
+    settings = {"rules": "r1", "engine": "e1"}
+    items = [{"id": str(i), "text": f"text {i}"} for i in range(5)]
+    output = infer_stage.OutputWriter(io.BytesIO(), flush_interval=0)
+    journal = infer_stage.RunJournal(run_dir, settings, output, checkpoint_every=2)
+    assert not any(journal.replay(item) for item in items[:3])
+    output.journal = journal
+    output.write_many([{"id": item["id"], "stage": "other"} for item in items[:3]])
+    with open(os.path.join(run_dir, "checkpoint.json")) as f:
+        assert json.load(f)["results"] == 3
+    # A second run cannot share the journal while this one holds it
+    with pytest.raises(OSError):
+        infer_stage.RunJournal(run_dir, settings, output, resume=True)
+    journal.close()
+    with open(os.path.join(run_dir, "journal.jsonl"), "ab") as f:
+        f.write(b'{"key": "torn')
+
+    sink = io.BytesIO()
+    output = infer_stage.OutputWriter(sink, flush_interval=0)
+    journal = infer_stage.RunJournal(run_dir, settings, output, resume=True)
+    changed = dict(items[2], text="edited")
+    assert [journal.replay(item) for item in items[:2] + [changed] + items[3:]] == [True, True, False, False, False]
+    assert [json.loads(line)["id"] for line in sink.getvalue().splitlines()] == ["0", "1"]
+    assert set(journal.pending) == {"2", "3", "4"}
+    journal.close()
+    with open(os.path.join(run_dir, "journal.jsonl"), "rb") as f:
+        assert f.read().endswith(b"}\n")  # The torn line was cut off
+
+    # Other rules or models: nothing is replayed
+    journal = infer_stage.RunJournal(run_dir, dict(settings, engine="e2"), output, resume=True)
+    assert not journal.completed and not journal.replay(items[0])
+    journal.close()
+
+
+def test_finished_run_keeps_other_runs_journal_entries(tmp_path):
+    import io
+
+    run_dir = str(tmp_path / "run")
+    settings = {"rules": "r1", "engine": "e1"}
+    backlog = [{"id": f"b{i}", "text": f"backlog {i}"} for i in range(3)]
+    output = infer_stage.OutputWriter(io.BytesIO(), flush_interval=0)
+    journal = infer_stage.RunJournal(run_dir, settings, output)
+    output.journal = journal
+    for item in backlog:
+        journal.replay(item)
+    output.write_many([{"id": item["id"], "stage": "other"} for item in backlog[:2]])
+    journal.close()  # Killed part-way
+
+    # A short run on other items finishes cleanly in the same run directory
+    output = infer_stage.OutputWriter(io.BytesIO(), flush_interval=0)
+    journal = infer_stage.RunJournal(run_dir, settings, output, resume=True)
+    output.journal = journal
+    journal.replay({"id": "s1", "text": "short"})
+    output.write_many([{"id": "s1", "stage": "other"}])
+    journal.close(finished=True)
+
+    # The backlog's progress survived; once the backlog finishes, nothing is left
+    sink = io.BytesIO()
+    output = infer_stage.OutputWriter(sink, flush_interval=0)
+    journal = infer_stage.RunJournal(run_dir, settings, output, resume=True)
+    assert set(journal.completed) == {"b0", "b1"}
+    assert [journal.replay(item) for item in backlog] == [True, True, False]
+    journal.close(finished=True)
+    assert os.listdir(run_dir) == []
+
+
+def test_run_without_resume_keeps_other_runs_journal_entries(tmp_path):
+    import io
+
+    run_dir = str(tmp_path / "run")
+    settings = {"rules": "r1", "engine": "e1"}
+    backlog = [{"id": f"b{i}", "text": f"backlog {i}"} for i in range(3)]
+    output = infer_stage.OutputWriter(io.BytesIO(), flush_interval=0)
+    journal = infer_stage.RunJournal(run_dir, settings, output)
+    output.journal = journal
+    for item in backlog:
+        journal.replay(item)
+    output.write_many([{"id": item["id"], "stage": "other"} for item in backlog[:2]])
+    journal.close()  # Killed part-way
+
+    # A run without resume classifies its items again but keeps the backlog's entries
+    output = infer_stage.OutputWriter(io.BytesIO(), flush_interval=0)
+    journal = infer_stage.RunJournal(run_dir, settings, output)
+    output.journal = journal
+    assert not journal.replay(backlog[0]) and not journal.replay({"id": "s1", "text": "short"})
+    output.write_many([{"id": "b0", "stage": "other"}, {"id": "s1", "stage": "other"}])
+    journal.close(finished=True)
+
+    output = infer_stage.OutputWriter(io.BytesIO(), flush_interval=0)
+    journal = infer_stage.RunJournal(run_dir, settings, output, resume=True)
+    assert set(journal.completed) == {"b1"}
+    # A rewritten journal stays locked by the run holding it
+    journal._rewrite(list(journal.completed.values()))
+    with pytest.raises(OSError):
+        infer_stage.RunJournal(run_dir, settings, output)
+    journal.close()
+
+
+def test_resume_continues_an_interrupted_run(tmp_path):
+    items = [{"id": str(i), "text": text} for i, text in enumerate(RULE_EXAMPLES + ["General question"])]
+    run_dir = tmp_path / "run"
+    args = ["--patterns-only", "--no-cache", "--run-dir", str(run_dir), "--checkpoint-every", "1", "--batch-size", "5"]
+    full, _ = run_script(["--patterns-only", "--no-cache"], items)
+
+    # The first run is killed after its first 10 results
+    proc = subprocess.Popen([sys.executable, SCRIPT, *args], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL, text=True)
+    # Blank lines fill the reader's bulk read, so the 10 items are read while stdin stays open
+    proc.stdin.write("".join(json.dumps(item) + "\n" for item in items[:10]) + "\n" * infer_stage.READ_CHUNK_BYTES)
+    proc.stdin.flush()
+    first = [json.loads(proc.stdout.readline()) for _ in range(10)]
+    proc.kill()
+    proc.wait()
+    assert first == full[:10]
+
+    records, stderr = run_script(args + ["--resume"], items)
+    assert "journal: 10 replayed, %d recorded" % (len(items) - 10) in stderr
+    assert sorted(records, key=lambda r: int(r["id"])) == full
+
+    # A run that finished leaves nothing to resume
+    assert os.listdir(run_dir) == []
+    _, stderr = run_script(args + ["--resume"], items)
+    assert "journal: 0 replayed, %d recorded" % len(items) in stderr
+
+
+def test_resume_skips_unchanged_items_of_a_changed_only_reclassify(tmp_path):
+    items = [{"id": str(i), "text": text} for i, text in enumerate(RULE_EXAMPLES + ["General question"])]
+    previous = tmp_path / "previous.jsonl"
+    full, _ = run_script(["--patterns-only", "--no-cache"], items)
+    previous.write_text("".join(json.dumps(record) + "\n" for record in full))
+    run_dir = tmp_path / "run"
+    args = ["--patterns-only", "--no-cache", "--reclassify", str(previous), "--changed-only",
+            "--run-dir", str(run_dir), "--checkpoint-every", "1", "--batch-size", "5"]
+
+    # Nothing changed, so nothing is output: the first run is killed once 10 items are journalled
+    proc = subprocess.Popen([sys.executable, SCRIPT, *args], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL, text=True)
+    proc.stdin.write("".join(json.dumps(item) + "\n" for item in items[:10]) + "\n" * infer_stage.READ_CHUNK_BYTES)
+    proc.stdin.flush()
+    checkpoint = run_dir / "checkpoint.json"
+    deadline = time.time() + 60
+    while not (checkpoint.exists() and json.loads(checkpoint.read_text())["results"] >= 10):
+        assert time.time() < deadline and proc.poll() is None
+        time.sleep(0.05)
+    proc.kill()
+    proc.wait()
+
+    # The resumed run skips them without writing them
+    records, stderr = run_script(args + ["--resume"], items)
+    assert records == []
+    assert "journal: 10 replayed, %d recorded" % (len(items) - 10) in stderr
+    assert os.listdir(run_dir) == []
+
+
+def test_patterns_only_never_imports_torch():
+    items = [{"id": "1", "text": RULE_EXAMPLES[0]}, {"id": "2", "text": "General question about node uptime"}]
+    code = ("import sys, infer_stage; infer_stage.main(['--patterns-only', '--no-cache']); "
+            "sys.stderr.write('heavy=%s' % any(m in sys.modules for m in ('torch', 'transformers', 'numpy')))")
+    proc = subprocess.run(
+        [sys.executable, "-c", code], cwd=INGEST_DIR,
+        input="".join(json.dumps(item) + "\n" for item in items),
+        capture_output=True, text=True, timeout=60,
+    )
+    assert proc.returncode == 0, proc.stderr
+    assert proc.stderr.endswith("heavy=False")
+
+    matched, unmatched = [json.loads(line) for line in proc.stdout.splitlines()]
+    assert matched["tier"] == "pattern"
+    assert unmatched == {"id": "2", "stage": None, "confidence": 0.0, "tier": "needs_nli", "needs_nli": True,
+                         "rules": infer_stage.rules_fingerprint()}
+
+
+def test_patterns_only_ignores_the_cascade(tmp_path):
+    pytest.importorskip("numpy")
+    path = str(tmp_path / "cascade.npz")
+    infer_stage.HashedLinearModel(dim=4096).fit(*zip(*CASCADE_TRAINING)).save(path)
+    records, stderr = run_script(["--patterns-only", "--no-cache", "--cascade", "--cascade-model", path],
+                                 [{"id": "1", "text": "Discussion of fee schedule idea"}])
+    assert "ignoring --cascade" in stderr
+    assert records[0]["tier"] == "needs_nli"
+
+
+def test_model_loads_only_when_an_item_needs_nli(tmp_path):
+    # A model path that does not exist: loading it would fail the run
+    missing = str(tmp_path / "no-model")
+    records, stderr = run_script(["--model", missing, "--no-cache"], [{"id": "1", "text": RULE_EXAMPLES[0]}])
+    assert records[0]["tier"] == "pattern"
+    assert "Loading NLI" not in stderr
+
+
+def test_pipeline_matches_serial(tiny_model_dir, tmp_path):
+    texts = RULE_EXAMPLES + SAMPLE_TEXTS + infer_stage.REFERENCE_CORPUS + ["", "  "]
+    items = [{"id": str(i), "text": text} for i, text in enumerate(texts)]
+    base_args = ["--model", tiny_model_dir, "--cache", str(tmp_path / "cache.sqlite3"), "--batch-size", "4"]
+
+    serial, _ = run_script(base_args + ["--no-cache"], items)
+    pipelined, _ = run_script(base_args + ["--no-cache", "--pipeline", "--pipeline-depth", "1"], items)
+    assert pipelined == serial
+
+    # Cache lookups happen in the reader stage; a second run is all hits
+    run_script(base_args + ["--pipeline"], items)
+    cached, stderr = run_script(base_args + ["--pipeline"], items)
+    assert cached == serial
+    assert "misses: 0" in stderr
+
+
+def test_workers_match_single_process(tiny_model_dir):
+    texts = RULE_EXAMPLES + SAMPLE_TEXTS + infer_stage.REFERENCE_CORPUS + ["", "  "]
+    items = [{"id": str(i), "text": text} for i, text in enumerate(texts)]
+    base_args = ["--model", tiny_model_dir, "--no-cache", "--batch-size", "4"]
+
+    single, _ = run_script(base_args, items)
+    sharded, stderr = run_script(base_args + ["--workers", "3", "--preserve-order"], items)
+
+    assert sharded == single
+    assert [record["id"] for record in sharded] == [item["id"] for item in items]
+    assert "with 3 workers" in stderr
+    assert "once for all workers" not in stderr
+
+    shared, stderr = run_script(base_args + ["--workers", "2", "--preserve-order", "--share-model"], items)
+    assert shared == single
+    assert "once for all workers" in stderr
+
+
+def test_workers_load_the_model_only_when_needed(tmp_path):
+    # A model path that does not exist: loading it anywhere would fail the run
+    items = [{"id": str(i), "text": text} for i, text in enumerate(RULE_EXAMPLES)]
+    records, stderr = run_script(["--model", str(tmp_path / "no-model"), "--no-cache", "--workers", "2"], items)
+    assert len(records) == len(items) and all(record["tier"] == "pattern" for record in records)
+    assert "Loading" not in stderr
+
+
+def test_worker_applies_flags_without_fork(tmp_path, monkeypatch):
+    import queue
+
+    # A spawned worker starts from the module defaults, not main()'s globals
+    monkeypatch.setattr(infer_stage, "CANONICALIZE", True)
+    monkeypatch.setattr(infer_stage.TELEMETRY, "enabled", False)
+    args = infer_stage.parse_args(["--model", str(tmp_path / "no-model"), "--no-cache", "--workers", "2",
+                                   "--no-canonicalize", "--telemetry"])
+    tasks, results = queue.Queue(), queue.Queue()
+    tasks.put((0, [{"id": "1", "text": RULE_EXAMPLES[0]}]))
+    tasks.put(None)
+    infer_stage._worker_main(0, args, 1, tasks, results)
+
+    assert infer_stage.CANONICALIZE is False and infer_stage.TELEMETRY.enabled
+    assert results.get()[2][0]["tier"] == "pattern"
+
+
+def test_workers_all_failing_to_load_exits_with_error(tmp_path):
+    items = [{"id": str(i), "text": f"question {i}"} for i in range(30)]
+    proc = subprocess.run(
+        [sys.executable, SCRIPT, "--backend", "onnx", "--model", str(tmp_path / "missing"), "--no-cache",
+         "--workers", "2", "--batch-size", "1"],
+        input="".join(json.dumps(item) + "\n" for item in items),
+        capture_output=True, text=True, timeout=120,
+    )
+    assert proc.returncode == 1
+    assert "2 of 2 workers exited with an error" in proc.stderr
+
+
+def test_benchmark_corpus_is_seeded_and_baseline_flags_regressions():
+    import bench_infer_stage
+
+    assert bench_infer_stage.synthetic_corpus(50, seed=7) == bench_infer_stage.synthetic_corpus(50, seed=7)
+    assert all(len(text.split("\n", 1)[-1].split()) == 40
+               for text in bench_infer_stage.synthetic_corpus(10, seed=7, body_words=40))
+
+    baseline = {"patterns": {"compiled_items_per_sec": 1000, "speedup": 3.0},
+                "startup": {"model_load_seconds": 2.0}, "memory": {"bench_peak_rss_mb": 500}}
+    current = {"patterns": {"compiled_items_per_sec": 800, "speedup": 1.0},
+               "startup": {"model_load_seconds": 2.1}, "memory": {"bench_peak_rss_mb": 700}}
+    regressions = bench_infer_stage.compare_to_baseline(current, baseline, threshold=0.15)
+
+    assert [r["metric"] for r in regressions] == ["patterns.compiled_items_per_sec", "memory.bench_peak_rss_mb"]
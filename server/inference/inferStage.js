@@ -3,6 +3,24 @@
  * 
  * Spawns Python process for zero-shot NLI classification.
  * Uses BATCH processing - loads model once, processes all topics via JSONL stream.
+ *
+ * With INFERENCE_DAEMON=true a single long-lived `infer_stage.py --serve`
+ * process is kept per server instead, so the model is loaded once and
+ * single-topic requests skip the multi-second model load.
+ *
+ * INFERENCE_FRAMING=length switches batch runs from JSONL to length-prefixed
+ * frames; INFERENCE_TELEMETRY=true adds JSON telemetry to the child's stderr.
+ * INFERENCE_MAX_RSS_MB sets the child's memory budget (--max-rss-mb).
+ * INFERENCE_ENGINE=knn classifies non-pattern items by nearest neighbours in
+ * the labelled example index (built with `infer_stage.py --build-index`), and
+ * INFERENCE_ENGINE=distilled with the single-pass classifier trained by
+ * `infer_stage.py --train-distilled`, instead of zero-shot NLI.
+ *
+ * INFERENCE_RESUME=true makes batch runs keep a journal of completed results
+ * (`--resume`, in INFERENCE_RUN_DIR or the script's default run directory),
+ * so a run killed by the timeout below is continued, not restarted, by the
+ * next call. A run that finishes drops only its own topics from the journal;
+ * single-topic inferStage() calls never use it.
  */
 
 import { spawn } from 'child_process';
@@ -14,6 +32,263 @@ const PYTHON_SCRIPT = path.resolve(process.cwd(), 'scripts', 'ingest', 'infer_st
 // Python executable - configurable via env
 const PYTHON_EXECUTABLE = process.env.INFERENCE_PYTHON || 'python3';
 
+// Structured JSON telemetry (phase timings, latency histograms) on the child's stderr,
+// the memory budget batches are sized against, and the engine for non-pattern items
+const PYTHON_ARGS = [
+  ...(process.env.INFERENCE_TELEMETRY === 'true' ? ['--telemetry'] : []),
+  ...(process.env.INFERENCE_MAX_RSS_MB ? ['--max-rss-mb', process.env.INFERENCE_MAX_RSS_MB] : []),
+  ...(process.env.INFERENCE_ENGINE ? ['--engine', process.env.INFERENCE_ENGINE] : []),
+];
+
+// Opt-in: batch runs resume from the journal of an earlier, interrupted run
+const RESUME_ARGS = process.env.INFERENCE_RESUME !== 'true' ? [] : [
+  '--resume',
+  ...(process.env.INFERENCE_RUN_DIR ? ['--run-dir', process.env.INFERENCE_RUN_DIR] : []),
+];
+
+// Length-prefixed framing (4-byte big-endian length + JSON) for batch runs
+// instead of JSONL - no line scanning on either side
+const LENGTH_FRAMING = process.env.INFERENCE_FRAMING === 'length';
+
+function encodeFrame(message) {
+  const payload = Buffer.from(JSON.stringify(message), 'utf8');
+  const header = Buffer.alloc(4);
+  header.writeUInt32BE(payload.length, 0);
+  return Buffer.concat([header, payload]);
+}
+
+/**
+ * Calls onMessage(object) for every complete length-prefixed frame read
+ * from `stream`; partial frames are carried over to the next chunk.
+ */
+function readFrames(stream, onMessage) {
+  let buffered = Buffer.alloc(0);
+  stream.on('data', (chunk) => {
+    buffered = buffered.length ? Buffer.concat([buffered, chunk]) : chunk;
+    while (buffered.length >= 4) {
+      const size = buffered.readUInt32BE(0);
+      if (buffered.length < 4 + size) break;
+      const payload = buffered.subarray(4, 4 + size).toString('utf8');
+      buffered = buffered.subarray(4 + size);
+      try {
+        onMessage(JSON.parse(payload));
+      } catch (e) {
+        // Skip invalid frames
+      }
+    }
+  });
+}
+
+// Keep one resident `infer_stage.py --serve` process instead of spawning per call
+const DAEMON_ENABLED = process.env.INFERENCE_DAEMON === 'true';
+
+// Topics per daemon request - smaller requests give progress updates and let
+// the daemon coalesce work from concurrent callers
+const DAEMON_CHUNK_SIZE = 50;
+// Requests a batch keeps in flight: enough to keep the daemon busy without
+// queueing chunks whose timeouts would run out before it reaches them
+const DAEMON_MAX_IN_FLIGHT = 2;
+const DAEMON_START_TIMEOUT_MS = 120000;
+const DAEMON_REQUEST_TIMEOUT_MS = 300000;
+
+function topicText(topic) {
+  return `${topic.subject}\n${topic.content || ''}`.trim();
+}
+
+/**
+ * Client for the resident inference server (infer_stage.py --serve).
+ *
+ * Requests are multiplexed over the child's stdin/stdout by request_id.
+ * The process is started lazily and respawned on the next request if it dies.
+ * A request that times out is cancelled, so the daemon drops its queued work.
+ */
+class InferenceDaemon {
+  constructor() {
+    this.proc = null;
+    this.ready = null;
+    this.pending = new Map();
+    this.nextRequestId = 0;
+  }
+
+  start() {
+    if (this.ready) return this.ready;
+
+    this.ready = new Promise((resolve, reject) => {
+      const proc = spawn(PYTHON_EXECUTABLE, [PYTHON_SCRIPT, '--serve', ...PYTHON_ARGS], {
+        stdio: ['pipe', 'pipe', 'pipe'],
+        env: { ...process.env },
+      });
+      this.proc = proc;
+
+      const startTimeout = setTimeout(() => {
+        reject(new Error('inference daemon did not become ready in time'));
+        proc.kill('SIGKILL');
+      }, DAEMON_START_TIMEOUT_MS);
+
+      proc.stdin.on('error', (err) => {
+        console.error('[inferStage] daemon stdin error:', err.message);
+      });
+
+      createInterface({ input: proc.stdout }).on('line', (line) => {
+        let msg;
+        try {
+          msg = JSON.parse(line);
+        } catch (e) {
+          return; // Skip invalid JSON lines
+        }
+        if (msg.event === 'ready') {
+          clearTimeout(startTimeout);
+          console.log(`[inferStage] Inference daemon ready (pid ${msg.pid})`);
+          resolve();
+          return;
+        }
+        const entry = this.pending.get(msg.request_id);
+        if (!entry) return;
+        this.pending.delete(msg.request_id);
+        clearTimeout(entry.timeout);
+        if (msg.error) entry.reject(new Error(msg.error));
+        else entry.resolve(msg);
+      });
+
+      proc.stderr.on('data', (data) => {
+        const msg = data.toString().trim();
+        if (msg) {
+          console.log('[inferStage]', msg);
+        }
+      });
+
+      const onExit = (err) => {
+        clearTimeout(startTimeout);
+        if (this.proc !== proc) return;
+        this.proc = null;
+        this.ready = null;
+        const reason = err || new Error('inference daemon exited');
+        reject(reason);
+        for (const entry of this.pending.values()) {
+          clearTimeout(entry.timeout);
+          entry.reject(reason);
+        }
+        this.pending.clear();
+      };
+      proc.on('close', (code) => {
+        if (code !== 0 && code !== null) {
+          console.error(`[inferStage] Inference daemon exited with code ${code}`);
+        }
+        onExit(null);
+      });
+      proc.on('error', (err) => {
+        console.error('[inferStage] Failed to spawn inference daemon:', err.message);
+        onExit(err);
+      });
+    });
+
+    return this.ready;
+  }
+
+  async request(payload, timeoutMs = DAEMON_REQUEST_TIMEOUT_MS) {
+    await this.start();
+    const requestId = `r${++this.nextRequestId}`;
+
+    return new Promise((resolve, reject) => {
+      const timeout = setTimeout(() => {
+        this.pending.delete(requestId);
+        this.cancel(requestId);
+        reject(new Error(`inference daemon request ${requestId} timed out`));
+      }, timeoutMs);
+      this.pending.set(requestId, { resolve, reject, timeout });
+      this.proc.stdin.write(JSON.stringify({ request_id: requestId, ...payload }) + '\n');
+    });
+  }
+
+  cancel(requestId) {
+    try {
+      this.proc?.stdin.write(JSON.stringify({ request_id: requestId, op: 'cancel' }) + '\n');
+    } catch (e) {
+      // The daemon is gone - nothing left to cancel
+    }
+  }
+
+  async classify(items) {
+    const response = await this.request({ op: 'classify', items });
+    return response.results;
+  }
+
+  async health() {
+    return this.request({ op: 'health' }, 10000);
+  }
+
+  /**
+   * Ask the daemon to drain and exit; SIGTERM if it does not go quietly.
+   */
+  async stop(graceMs = 10000) {
+    const proc = this.proc;
+    if (!proc) return;
+    const exited = new Promise((resolve) => proc.once('close', resolve));
+    try {
+      proc.stdin.end(JSON.stringify({ request_id: 'shutdown', op: 'shutdown' }) + '\n');
+    } catch (e) {
+      proc.kill('SIGTERM');
+    }
+    const timer = setTimeout(() => proc.kill('SIGTERM'), graceMs);
+    await exited;
+    clearTimeout(timer);
+  }
+}
+
+let daemon = null;
+
+function getDaemon() {
+  if (!daemon) {
+    daemon = new InferenceDaemon();
+    process.once('exit', () => daemon?.proc?.kill('SIGTERM'));
+  }
+  return daemon;
+}
+
+/**
+ * Stop the resident inference daemon (no-op when it is not running)
+ */
+export async function shutdownInferenceDaemon() {
+  if (daemon) {
+    await daemon.stop();
+  }
+}
+
+/**
+ * Classify topics through the daemon in chunks, at most DAEMON_MAX_IN_FLIGHT
+ * at a time. Each chunk's timeout starts when it is sent. After a failure no
+ * further chunks are sent; the results gathered so far are returned with it.
+ *
+ * @returns {Promise<{results: Map<string, {stage: string, confidence: number}>, failure: Error | null}>}
+ */
+async function inferStagesViaDaemon(topics, onProgress) {
+  const client = getDaemon();
+  const results = new Map();
+  let next = 0;
+  let failure = null;
+
+  const sendChunks = async () => {
+    while (!failure && next < topics.length) {
+      const chunk = topics.slice(next, next + DAEMON_CHUNK_SIZE);
+      next += chunk.length;
+      try {
+        const records = await client.classify(chunk.map(topic => ({ id: topic.id, text: topicText(topic) })));
+        for (const record of records) {
+          results.set(record.id, { stage: record.stage, confidence: record.confidence });
+        }
+        if (onProgress) {
+          onProgress(results.size, topics.length);
+        }
+      } catch (err) {
+        failure = failure || err;
+      }
+    }
+  };
+
+  await Promise.all(Array.from({ length: DAEMON_MAX_IN_FLIGHT }, sendChunks));
+  return { results, failure };
+}
+
 /**
  * Run batch inference on multiple governance messages
  * 
@@ -22,26 +297,57 @@ const PYTHON_EXECUTABLE = process.env.INFERENCE_PYTHON || 'python3';
  * 
  * @param {Array<{id: string, subject: string, content?: string}>} topics
  * @param {function} onProgress - Optional callback for progress updates
+ * @param {{resume?: boolean}} [options] - resume: use the run journal (with INFERENCE_RESUME=true)
  * @returns {Promise<Map<string, {stage: string, confidence: number}>>} - Map of id -> result
  */
-export async function inferStagesBatch(topics, onProgress = null) {
+export async function inferStagesBatch(topics, onProgress = null, { resume = true } = {}) {
   if (!topics || topics.length === 0) {
     return new Map();
   }
   
   console.log(`[inferStage] Starting batch inference for ${topics.length} topics...`);
   
+  if (!DAEMON_ENABLED) {
+    return inferStagesViaProcess(topics, onProgress, resume);
+  }
+  
+  const { results, failure } = await inferStagesViaDaemon(topics, onProgress);
+  if (!failure) {
+    console.log(`[inferStage] Batch complete: ${results.size}/${topics.length} classified`);
+    return results;
+  }
+  
+  // Keep what the daemon already classified; only the rest goes to the fallback
+  const remaining = topics.filter(topic => !results.has(topic.id));
+  console.error(`[inferStage] Inference daemon failed after ${results.size}/${topics.length} topics, ` +
+    `falling back to one-shot process for the rest:`, failure.message);
+  const fallbackProgress = onProgress && ((done) => onProgress(results.size + done, topics.length));
+  const rest = await inferStagesViaProcess(remaining, fallbackProgress, resume);
+  for (const [id, result] of rest) {
+    results.set(id, result);
+  }
+  return results;
+}
+
+/**
+ * Classify topics in a one-shot `infer_stage.py` process; resolves with the
+ * results gathered before it exits or times out.
+ */
+function inferStagesViaProcess(topics, onProgress, resume) {
   return new Promise((resolve, reject) => {
     const results = new Map();
     let processedCount = 0;
     let stdinClosed = false;
     
-    const proc = spawn(PYTHON_EXECUTABLE, [PYTHON_SCRIPT], {
+    const framingArgs = LENGTH_FRAMING ? ['--framing', 'length'] : [];
+    const resumeArgs = resume ? RESUME_ARGS : [];
+    const proc = spawn(PYTHON_EXECUTABLE, [PYTHON_SCRIPT, ...PYTHON_ARGS, ...resumeArgs, ...framingArgs], {
       stdio: ['pipe', 'pipe', 'pipe'],
       env: { ...process.env },
     });
     
-    // Set a generous timeout for batch processing (5 min for model load + processing)
+    // Set a generous timeout for batch processing (5 min for model load + processing);
+    // results journalled before the kill are replayed by the next call
     const timeout = setTimeout(() => {
       proc.kill('SIGKILL');
       console.error(`[inferStage] Batch process timeout after 5 minutes`);
@@ -58,27 +364,33 @@ export async function inferStagesBatch(topics, onProgress = null) {
       stdinClosed = true;
     });
     
-    // Read results line by line as they stream back
-    const rl = createInterface({ input: proc.stdout });
-    
-    rl.on('line', (line) => {
-      try {
-        const result = JSON.parse(line);
-        if (result.id) {
-          results.set(result.id, {
-            stage: result.stage,
-            confidence: result.confidence,
-          });
-          processedCount++;
-          
-          if (onProgress && processedCount % 50 === 0) {
-            onProgress(processedCount, topics.length);
-          }
+    const onResult = (result) => {
+      if (result.id) {
+        results.set(result.id, {
+          stage: result.stage,
+          confidence: result.confidence,
+        });
+        processedCount++;
+        
+        if (onProgress && processedCount % 50 === 0) {
+          onProgress(processedCount, topics.length);
         }
-      } catch (e) {
-        // Skip invalid JSON lines
       }
-    });
+    };
+    
+    // Read results as they stream back
+    if (LENGTH_FRAMING) {
+      readFrames(proc.stdout, onResult);
+    } else {
+      const rl = createInterface({ input: proc.stdout });
+      rl.on('line', (line) => {
+        try {
+          onResult(JSON.parse(line));
+        } catch (e) {
+          // Skip invalid JSON lines
+        }
+      });
+    }
     
     // Log stderr (model loading progress, etc)
     proc.stderr.on('data', (data) => {
@@ -112,10 +424,9 @@ export async function inferStagesBatch(topics, onProgress = null) {
           console.warn('[inferStage] Stopping writes - stdin closed');
           break;
         }
-        const text = `${topic.subject}\n${topic.content || ''}`.trim();
-        const jsonLine = JSON.stringify({ id: topic.id, text }) + '\n';
+        const message = { id: topic.id, text: topicText(topic) };
         try {
-          proc.stdin.write(jsonLine);
+          proc.stdin.write(LENGTH_FRAMING ? encodeFrame(message) : JSON.stringify(message) + '\n');
         } catch (e) {
           console.error('[inferStage] Write error:', e.message);
           break;
@@ -140,9 +451,10 @@ export async function inferStagesBatch(topics, onProgress = null) {
  * @returns {Promise<{stage: string, confidence: number} | null>}
  */
 export async function inferStage(subject, content = '') {
+  // Too short to need resuming, and must not touch the batch runs' journal
   const results = await inferStagesBatch([
     { id: 'single', subject, content }
-  ]);
+  ], null, { resume: false });
   
   return results.get('single') || null;
 }